@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+#
+#  A fake of the Subversion commands used by svndumpfilter3 to untangle, for
+#  the benchmarks.  See run.py.
+
+"""fakesvn.py
+
+A stand-in for 'svnadmin' and 'svnlook' that takes a dump file (in format 2,
+with full texts) as the repository.  It is run through links named after the
+commands, or with the command as its first argument ('fakesvn.py svnlook uuid
+REPOS'), and supports what svndumpfilter3 runs:
+
+  svnlook uuid REPOS
+  svnlook youngest REPOS
+  svnlook tree --full-paths -r REV REPOS PATH
+  svnlook proplist --verbose --xml -r REV REPOS PATH
+  svnlook cat -r REV REPOS PATH
+  svnadmin dump -r REV REPOS
+
+The history of the paths is parsed from the dump once and kept in a pickle
+next to it, so that the repeated calls made when untangling are cheap.
+"""
+
+import sys, os, re, bisect, hashlib, cPickle, base64
+from xml.sax.saxutils import escape, quoteattr
+
+
+def read_headers(f):
+    """
+    Read a block of headers, return a dict or None at the end of the file.
+    """
+    hdrs = {}
+    while 1:
+        line = f.readline()
+        if not line:
+            return None
+        if line == '\n':
+            if hdrs:
+                return hdrs
+            continue
+        key, value = line.rstrip('\n').split(': ', 1)
+        hdrs[key] = value
+
+def parse_props(data):
+    """
+    Parse a property block into a list of (name, value).
+    """
+    items = []
+    pos = 0
+    while not data.startswith('PROPS-END', pos):
+        nl = data.index('\n', pos)
+        n = int(data[pos + 2:nl])
+        name = data[nl + 1:nl + 1 + n]
+        pos = nl + 2 + n
+        nl = data.index('\n', pos)
+        n = int(data[pos + 2:nl])
+        value = data[nl + 1:nl + 1 + n]
+        pos = nl + 2 + n
+        items.append((name, value))
+    return items
+
+
+class Repository:
+    """
+    The history of a dump file: the properties of its revisions, and for
+    each path the list of its states, as (rev, entry) where 'entry' is None
+    if the path was deleted, else a (kind, props, text) tuple, 'text' being
+    the (offset, length) of the text in the dump file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.uuid = None
+        self.revprops = []
+        self.history = {}
+
+    def state(self, path, rev):
+        """
+        Return the entry of 'path' in revision 'rev', None if it does not
+        exist.
+        """
+        states = self.history.get(path)
+        if not states:
+            return None
+        # (rev + 1,) sorts before all the states of revision rev + 1.
+        i = bisect.bisect_left(states, (rev + 1,)) - 1
+        if i < 0:
+            return None
+        return states[i][1]
+
+    def tree(self, path, rev):
+        """
+        Return the sorted list of (path, entry) of 'path' and the paths below
+        it in revision 'rev'.
+        """
+        prefix = path + '/'
+        result = []
+        for p in self.history:
+            if p == path or p.startswith(prefix) or not path:
+                entry = self.state(p, rev)
+                if entry is not None:
+                    result.append((p, entry))
+        result.sort()
+        return result
+
+    def parse(self):
+        f = open(self.filename, 'rb')
+        f.readline()
+        f.readline()
+        self.uuid = f.readline().split(': ', 1)[1].strip()
+        current = {}
+        rev = None
+        while 1:
+            hdrs = read_headers(f)
+            if hdrs is None:
+                break
+            if 'Text-delta' in hdrs or 'Prop-delta' in hdrs:
+                raise SystemExit("fakesvn: deltas are not supported.")
+            plen = int(hdrs.get('Prop-content-length', -1))
+            tlen = int(hdrs.get('Text-content-length', -1))
+            props = None
+            if plen >= 0:
+                props = parse_props(f.read(plen))
+            text = None
+            if tlen >= 0:
+                text = (f.tell(), tlen)
+                f.seek(tlen, 1)
+
+            if 'Revision-number' in hdrs:
+                rev = int(hdrs['Revision-number'])
+                self.revprops.append(props or [])
+                continue
+
+            path = hdrs['Node-path']
+            action = hdrs['Node-action']
+            if action in ('delete', 'replace'):
+                prefix = path + '/'
+                for p in [p for p in current
+                          if p == path or p.startswith(prefix)]:
+                    del current[p]
+                    self.history[p].append((rev, None))
+                if action == 'delete':
+                    continue
+            if 'Node-copyfrom-path' in hdrs:
+                src = hdrs['Node-copyfrom-path']
+                srcrev = int(hdrs['Node-copyfrom-rev'])
+                for p, entry in self.tree(src, srcrev):
+                    dst = path + p[len(src):]
+                    current[dst] = entry
+                    self.history.setdefault(dst, []).append((rev, entry))
+            kind, oldprops, oldtext = current.get(path, (None, [], None))
+            kind = hdrs.get('Node-kind', kind)
+            if props is None:
+                props = oldprops
+            if text is None:
+                text = oldtext
+            entry = (kind, props, text)
+            current[path] = entry
+            self.history.setdefault(path, []).append((rev, entry))
+        f.close()
+
+    def load(self):
+        """
+        Load the history from its pickle, or parse it and save the pickle.
+        """
+        cache = self.filename + '.fakesvn'
+        mtime = os.path.getmtime(self.filename)
+        if os.path.exists(cache) and os.path.getmtime(cache) >= mtime:
+            f = open(cache, 'rb')
+            self.uuid, self.revprops, self.history = cPickle.load(f)
+            f.close()
+            return
+        self.parse()
+        tmp = '%s.%d' % (cache, os.getpid())
+        f = open(tmp, 'wb')
+        cPickle.dump((self.uuid, self.revprops, self.history), f, 2)
+        f.close()
+        os.rename(tmp, cache)
+
+    def dump(self, rev, out):
+        """
+        Write the dump of the tree of revision 'rev' to 'out', like
+        'svnadmin dump -r REV'.
+        """
+        out.write('SVN-fs-dump-format-version: 2\n\nUUID: %s\n\n' % self.uuid)
+        p = props(self.revprops[rev])
+        out.write('Revision-number: %d\nProp-content-length: %d\n'
+                  'Content-length: %d\n\n%s\n' % (rev, len(p), len(p), p))
+        f = open(self.filename, 'rb')
+        for path, (kind, items, text) in self.tree('', rev):
+            p = props(items)
+            out.write('Node-path: %s\nNode-kind: %s\nNode-action: add\n'
+                      'Prop-content-length: %d\n' % (path, kind, len(p)))
+            if kind == 'file':
+                data = ''
+                if text is not None:
+                    f.seek(text[0])
+                    data = f.read(text[1])
+                out.write('Text-content-length: %d\nText-content-md5: %s\n'
+                          'Content-length: %d\n\n%s%s\n\n' %
+                          (len(data), hashlib.md5(data).hexdigest(),
+                           len(p) + len(data), p, data))
+            else:
+                out.write('Content-length: %d\n\n%s\n\n' % (len(p), p))
+        f.close()
+
+    def lookup(self, path, rev):
+        """
+        Return the entry of 'path' in revision 'rev', exiting if it does not
+        exist, like svnlook.
+        """
+        entry = self.state(path, rev)
+        if entry is None and path:
+            raise SystemExit("svnlook: E160013: Path '/%s' does not exist" %
+                             path)
+        return entry or ('dir', [], None)
+
+    def cat(self, path, rev, out):
+        """
+        Write the text of file 'path' in revision 'rev' to 'out', like
+        'svnlook cat'.
+        """
+        kind, items, text = self.lookup(path, rev)
+        if kind != 'file':
+            raise SystemExit("svnlook: E160017: Path '/%s' is not a file" %
+                             path)
+        if text is not None:
+            f = open(self.filename, 'rb')
+            f.seek(text[0])
+            out.write(f.read(text[1]))
+            f.close()
+
+    def proplist(self, path, rev, out):
+        """
+        Write the properties of 'path' in revision 'rev' to 'out', like
+        'svnlook proplist --verbose --xml'.
+        """
+        kind, items, text = self.lookup(path, rev)
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<properties>\n')
+        out.write('<target\n   path=%s>\n' % quoteattr(path))
+        for name, value in items:
+            if xml_safe(value):
+                out.write('<property\n   name=%s>%s</property>\n' %
+                          (quoteattr(name), escape(value)))
+            else:
+                out.write('<property\n   name=%s\n   encoding="base64">%s'
+                          '</property>\n' %
+                          (quoteattr(name), base64.b64encode(value)))
+        out.write('</target>\n</properties>\n')
+
+    def listtree(self, path, rev, out):
+        """
+        Write 'path' and the paths below it in revision 'rev' to 'out', like
+        'svnlook tree --full-paths'.
+        """
+        self.lookup(path, rev)
+        for p, (kind, items, text) in self.tree(path, rev):
+            out.write(kind == 'dir' and p + '/\n' or p + '\n')
+
+
+def props(items):
+    parts = ['K %d\n%s\nV %d\n%s\n' % (len(k), k, len(v), v)
+             for k, v in items]
+    parts.append('PROPS-END\n')
+    return ''.join(parts)
+
+unsafe_re = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f\r]')
+
+def xml_safe(value):
+    """
+    Return true if 'value' can be written in XML as is, rather than in base64.
+    """
+    try:
+        value.decode('utf-8')
+    except UnicodeDecodeError:
+        return False
+    return not unsafe_re.search(value)
+
+
+def main():
+    cmd = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if cmd.startswith('fakesvn') and args:
+        cmd = args.pop(0)
+    if not args:
+        raise SystemExit("usage: %s SUBCOMMAND ... REPOS [PATH]" % cmd)
+
+    # Split the options from the repository and path.
+    sub = args[0]
+    rev = None
+    flags = set()
+    positional = []
+    i = 1
+    while i < len(args):
+        if args[i] == '-r':
+            rev = int(args[i + 1])
+            i += 1
+        elif args[i].startswith('-'):
+            flags.add(args[i])
+        else:
+            positional.append(args[i])
+        i += 1
+    if not positional:
+        raise SystemExit("usage: %s %s ... REPOS [PATH]" % (cmd, sub))
+    repos = Repository(positional[0])
+    repos.load()
+    if rev is None:
+        rev = len(repos.revprops) - 1
+    path = len(positional) > 1 and positional[1].strip('/') or ''
+
+    if cmd == 'svnlook' and sub == 'uuid':
+        print repos.uuid
+    elif cmd == 'svnlook' and sub == 'youngest':
+        print len(repos.revprops) - 1
+    elif cmd == 'svnlook' and sub == 'tree' and '--full-paths' in flags:
+        repos.listtree(path, rev, sys.stdout)
+    elif cmd == 'svnlook' and sub == 'cat':
+        repos.cat(path, rev, sys.stdout)
+    elif (cmd == 'svnlook' and sub in ('proplist', 'plist') and
+          '--xml' in flags):
+        repos.proplist(path, rev, sys.stdout)
+    elif cmd == 'svnadmin' and sub == 'dump':
+        repos.dump(rev, sys.stdout)
+    else:
+        raise SystemExit("fakesvn: unsupported command: %s %s" %
+                         (cmd, ' '.join(args)))
+
+
+if __name__ == '__main__':
+    main()
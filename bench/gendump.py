@@ -0,0 +1,590 @@
+#!/usr/bin/env python
+#
+#  Generator of synthetic Subversion dump files, for the benchmarks of
+#  svndumpfilter3.  See run.py.
+
+"""gendump.py [<options>]
+
+Write a synthetic Subversion dump file, made of a number of projects whose
+files are added, changed, deleted, copied and branched at random.  The dump is
+entirely determined by the options and the seed, so that benchmarks can be
+repeated on the same data.
+
+The files live under <project>/trunk, a number of directory levels deep, and
+their sizes are drawn from a distribution given as weighted sizes.  A fraction
+of them are binary, with an svn:mime-type, and huge binaries can be added at
+regular intervals.  Copies and branches go from one project to another with
+some probability, so that they cross the boundaries of the paths that are
+included or excluded by filtering on projects.
+
+Format 2 dumps hold full texts.  Format 3 dumps hold the texts as svndiff0
+deltas, and the property changes as property deltas, like the output of
+'svnadmin dump --deltas'.
+"""
+
+import sys, random, hashlib, bisect, optparse
+
+
+UUID = '6b5d6c3a-8a32-4f0e-9d3b-0c1f2e3d4c5b'
+
+WORDS = ('foo bar baz qux quux corge grault garply waldo fred plugh xyzzy '
+         'thud secret1 secret22 lorem ipsum dolor sit amet').split()
+
+BLOCK = 1 << 20
+"""Size of the blocks that the texts are sliced from."""
+
+
+def parse_size(s):
+    """
+    Parse a size with an optional K, M or G suffix.
+    """
+    s = s.strip().upper()
+    mult = 1
+    if s and s[-1] in 'KMG':
+        mult = 1 << (10 * ('KMG'.index(s[-1]) + 1))
+        s = s[:-1]
+    return int(float(s) * mult)
+
+def parse_distribution(s):
+    """
+    Parse a distribution of sizes given as comma-separated WEIGHT:SIZE items,
+    and return a list of (cumulative weight, size).
+    """
+    dist = []
+    total = 0
+    for item in s.split(','):
+        weight, size = item.split(':')
+        total += float(weight)
+        dist.append((total, parse_size(size)))
+    return [(w / total, size) for w, size in dist]
+
+
+class Texts:
+    """
+    The contents of the files, sliced from large random blocks so that huge
+    texts are cheap to make.  A text is known by its (seed, size, binary)
+    key and can be generated again in chunks, to checksum it before writing
+    it out.
+    """
+    def __init__(self, rnd):
+        lines = []
+        size = 0
+        while size < BLOCK * 2:
+            line = ' '.join(rnd.choice(WORDS)
+                            for i in xrange(rnd.randint(0, 12))) + '\n'
+            lines.append(line)
+            size += len(line)
+        self.text = ''.join(lines)
+        self.binary = ''.join(chr(rnd.getrandbits(8))
+                              for i in xrange(1 << 16)) * (BLOCK * 2 >> 16)
+
+    def chunks(self, key):
+        """
+        Generate the text with 'key' in chunks of at most BLOCK bytes.
+        """
+        seed, size, binary = key
+        block = binary and self.binary or self.text
+        offset = seed % BLOCK
+        while size > 0:
+            n = min(size, BLOCK)
+            yield block[offset:offset + n]
+            size -= n
+            offset = (offset + 7919) % BLOCK
+
+    def md5(self, key):
+        m = hashlib.md5()
+        for data in self.chunks(key):
+            m.update(data)
+        return m.hexdigest()
+
+
+def varint(n):
+    """
+    Encode 'n' as a variable-length integer of svndiff.
+    """
+    s = chr(n & 0x7f)
+    n >>= 7
+    while n:
+        s = chr(0x80 | (n & 0x7f)) + s
+        n >>= 7
+    return s
+
+def svndiff_windows(chunks):
+    """
+    Generate the svndiff0 delta of the text generated by 'chunks' against an
+    empty source: one window per chunk, holding the chunk as new data.
+    """
+    yield 'SVN\0'
+    for data in chunks:
+        n = len(data)
+        if n < 0x40:
+            insns = chr(0x80 | n)
+        else:
+            insns = chr(0x80) + varint(n)
+        yield (varint(0) + varint(0) + varint(n) + varint(len(insns)) +
+               varint(n) + insns)
+        yield data
+
+def svndiff_length(size):
+    """
+    Return the length of the delta of a text of 'size' bytes.
+    """
+    length = 4
+    while size > 0:
+        n = min(size, BLOCK)
+        insns = n < 0x40 and 1 or 1 + len(varint(n))
+        length += (2 + len(varint(n)) * 2 + len(varint(insns)) + insns + n)
+        size -= n
+    return length
+
+
+def props(items):
+    """
+    Return the property block with the (name, value) in 'items', a value of
+    None being a deletion.
+    """
+    parts = []
+    for name, value in items:
+        if value is None:
+            parts.append('D %d\n%s\n' % (len(name), name))
+        else:
+            parts.append('K %d\n%s\nV %d\n%s\n' %
+                         (len(name), name, len(value), value))
+    parts.append('PROPS-END\n')
+    return ''.join(parts)
+
+
+class Generator:
+    """
+    The generation of one dump, after the parsed options 'opts'.
+    """
+    def __init__(self, opts, out):
+        self.opts = opts
+        self.out = out
+        self.rnd = random.Random(opts.seed)
+        self.texts = Texts(self.rnd)
+        self.sizes = parse_distribution(opts.sizes)
+        self.deltas = opts.format == 3
+
+        self.files = {}
+        """Map of the existing files to the key of their text."""
+        self.props = {}
+        """Map of the existing files to their list of properties."""
+        self.fileslist = []
+        """The existing files, possibly with deleted ones, to pick from."""
+        self.dirs = set()
+        """Set of the existing directories."""
+        self.old = {}
+        """Map of the files changed in the current revision to their (key,
+        properties) in the previous one, or None if they did not exist."""
+        self.newdirs = set()
+        """Set of the directories added in the current revision."""
+        self.branches = 0
+        self.nodes = 0
+
+    def write(self, data):
+        self.out.write(data)
+
+    def revision(self, rev, log):
+        if rev == 0:
+            p = props([('svn:date', '2010-01-01T00:00:00.000000Z')])
+        else:
+            p = props([('svn:log', log), ('svn:author', 'bench'),
+                       ('svn:date', '2010-01-01T00:00:%02d.000000Z' %
+                        (rev % 60))])
+        self.write('Revision-number: %d\nProp-content-length: %d\n'
+                   'Content-length: %d\n\n%s\n' % (rev, len(p), len(p), p))
+
+    def node(self, path, kind, action, key=None, prop=None, propdelta=False,
+             copyfrom=None, base=None):
+        """
+        Write a node, with the text of 'key' if not None, and the property
+        block 'prop' if not None.
+        """
+        self.nodes += 1
+        hdrs = ['Node-path: %s' % path]
+        if kind is not None:
+            hdrs.append('Node-kind: %s' % kind)
+        hdrs.append('Node-action: %s' % action)
+        if copyfrom is not None:
+            hdrs.append('Node-copyfrom-rev: %d' % copyfrom[1])
+            hdrs.append('Node-copyfrom-path: %s' % copyfrom[0])
+        if propdelta:
+            hdrs.append('Prop-delta: true')
+        if prop is not None:
+            hdrs.append('Prop-content-length: %d' % len(prop))
+        textlen = 0
+        if key is not None:
+            if self.deltas:
+                textlen = svndiff_length(key[1])
+                hdrs.append('Text-delta: true')
+                if base is not None:
+                    hdrs.append('Text-delta-base-md5: %s' %
+                                self.texts.md5(base))
+            else:
+                textlen = key[1]
+            hdrs.append('Text-content-length: %d' % textlen)
+            hdrs.append('Text-content-md5: %s' % self.texts.md5(key))
+        if prop is not None or key is not None:
+            hdrs.append('Content-length: %d' % (len(prop or '') + textlen))
+        self.write('\n'.join(hdrs) + '\n\n')
+        if prop is not None:
+            self.write(prop)
+        if key is not None:
+            chunks = self.texts.chunks(key)
+            if self.deltas:
+                chunks = svndiff_windows(chunks)
+            for data in chunks:
+                self.write(data)
+        self.write('\n\n')
+
+    def mkdirs(self, path):
+        """
+        Add the missing parent directories of 'path'.
+        """
+        comps = path.split('/')
+        for i in xrange(1, len(comps)):
+            d = '/'.join(comps[:i])
+            if d not in self.dirs:
+                self.dirs.add(d)
+                self.newdirs.add(d)
+                self.node(d, 'dir', 'add', prop=props([]))
+
+    def newkey(self, binary=False, size=None):
+        if size is None:
+            r = self.rnd.random()
+            for weight, size in self.sizes:
+                if r <= weight:
+                    break
+        return (self.rnd.getrandbits(31), size, binary)
+
+    def newpath(self):
+        opts = self.opts
+        comps = ['proj%d' % self.rnd.randrange(opts.projects), 'trunk']
+        for i in xrange(opts.depth):
+            comps.append('d%d' % self.rnd.randrange(opts.fanout))
+        comps.append('f%d.%s' % (self.rnd.randrange(opts.fanout * 4),
+                                 self.rnd.choice(('c', 'h', 'txt', 'py'))))
+        return '/'.join(comps)
+
+    def pickfile(self):
+        while self.fileslist:
+            i = self.rnd.randrange(len(self.fileslist))
+            path = self.fileslist[i]
+            if path in self.files:
+                return path
+            # Drop the deleted files lazily.
+            self.fileslist[i] = self.fileslist[-1]
+            self.fileslist.pop()
+        return None
+
+    def touch(self, path):
+        """
+        Remember the state of 'path' in the previous revision before changing
+        it.
+        """
+        if path not in self.old:
+            if path in self.files:
+                self.old[path] = (self.files[path], self.props[path])
+            else:
+                self.old[path] = None
+
+    def previous(self, path):
+        """
+        Return the (key, properties) of file 'path' in the previous revision,
+        None if it did not exist.
+        """
+        if path in self.old:
+            return self.old[path]
+        if path in self.files:
+            return (self.files[path], self.props[path])
+        return None
+
+    def addfile(self, path, key, items):
+        self.touch(path)
+        if path not in self.files:
+            self.fileslist.append(path)
+        self.files[path] = key
+        self.props[path] = items
+
+    def change(self):
+        """
+        Add, change or delete a file.
+        """
+        r = self.rnd.random()
+        path = self.pickfile()
+        if path is None or r < 0.4:
+            path = self.newpath()
+            if path in self.files or path in self.dirs:
+                return
+            self.mkdirs(path)
+            binary = self.rnd.random() < self.opts.binary_fraction
+            items = []
+            if binary:
+                items.append(('svn:mime-type', 'application/octet-stream'))
+            elif self.rnd.random() < 0.3:
+                items.append(('svn:eol-style', 'native'))
+            key = self.newkey(binary)
+            self.node(path, 'file', 'add', key, props(items))
+            self.addfile(path, key, items)
+        elif r < 0.93:
+            self.touch(path)
+            base = self.files[path]
+            key = self.newkey(base[2])
+            prop = None
+            if self.rnd.random() < 0.1:
+                # Set a property: format 3 only has the change.
+                items = [item for item in self.props[path]
+                         if item[0] != 'svn:keywords']
+                items.append(('svn:keywords', 'Id %d' % self.nodes))
+                self.props[path] = items
+                if self.deltas:
+                    prop = props(items[-1:])
+                else:
+                    prop = props(items)
+            self.node(path, 'file', 'change', key, prop,
+                      self.deltas and prop is not None, base=base)
+            self.files[path] = key
+        else:
+            self.node(path, None, 'delete')
+            self.touch(path)
+            del self.files[path]
+            del self.props[path]
+
+    def copy(self, rev):
+        """
+        Copy a file, or branch a directory, from the previous revision.  The
+        sources are taken as they were in that revision, before the changes
+        of this one.
+        """
+        if self.rnd.random() < 0.5:
+            src = self.pickfile()
+            if src is None:
+                return
+            prev = self.previous(src)
+            if prev is None:
+                return
+            dst = self.newpath()
+            if dst in self.files or dst in self.dirs:
+                return
+            self.mkdirs(dst)
+            self.node(dst, 'file', 'add', copyfrom=(src, rev - 1))
+            self.addfile(dst, prev[0], prev[1])
+            return
+
+        # Branch a directory under the trunk of a project.
+        candidates = [d for d in self.dirs
+                      if '/trunk/' in d and d not in self.newdirs]
+        if not candidates:
+            return
+        src = self.rnd.choice(sorted(candidates))
+        self.branches += 1
+        dst = 'proj%d/branches/b%d' % (self.rnd.randrange(self.opts.projects),
+                                       self.branches)
+        self.mkdirs(dst)
+        self.node(dst, 'dir', 'add', copyfrom=(src, rev - 1))
+        self.dirs.add(dst)
+        self.newdirs.add(dst)
+        prefix = src + '/'
+        for d in list(self.dirs):
+            if d.startswith(prefix) and d not in self.newdirs:
+                self.dirs.add(dst + d[len(src):])
+                self.newdirs.add(dst + d[len(src):])
+        for path in set(self.files) | set(self.old):
+            if path.startswith(prefix):
+                prev = self.previous(path)
+                if prev is not None:
+                    self.addfile(dst + path[len(src):], prev[0], prev[1])
+
+    def generate(self):
+        opts = self.opts
+        self.write('SVN-fs-dump-format-version: %d\n\nUUID: %s\n\n' %
+                   (opts.format, UUID))
+        self.revision(0, None)
+        for rev in xrange(1, opts.revisions + 1):
+            log = 'Commit %d: %s' % (rev, ' '.join(self.rnd.choice(WORDS)
+                                                    for i in xrange(6)))
+            self.revision(rev, log)
+            self.old = {}
+            self.newdirs = set()
+            for i in xrange(self.rnd.randint(1, 2 * opts.nodes - 1)):
+                self.change()
+            if rev > 1 and self.rnd.random() < opts.copy_density:
+                self.copy(rev)
+            if opts.huge_every and rev % opts.huge_every == 0:
+                path = 'proj%d/trunk/huge%d.bin' % (rev % opts.projects, rev)
+                self.mkdirs(path)
+                key = self.newkey(True, opts.huge_size)
+                items = [('svn:mime-type', 'application/octet-stream')]
+                self.node(path, 'file', 'add', key, props(items))
+                self.addfile(path, key, items)
+
+
+class CopyChecker:
+    """
+    The replay of the paths of a dump file, to check that its copies are
+    from paths that exist in their source revision.
+    """
+    def __init__(self):
+        self.history = {}
+        """Map of the paths to the list of (rev, exists) of their changes."""
+        self.children = {}
+        """Map of the directories to the set of the paths ever below them."""
+        self.bad = []
+        """The invalid copies, as (rev, path, srcpath, srcrev)."""
+
+    def exists(self, path, rev):
+        states = self.history.get(path)
+        if not states:
+            return False
+        i = bisect.bisect_left(states, (rev + 1,)) - 1
+        return i >= 0 and states[i][1]
+
+    def tree(self, path, rev):
+        """
+        Return 'path' and the paths below it that exist in revision 'rev'.
+        """
+        result = []
+        todo = [path]
+        while todo:
+            p = todo.pop()
+            if self.exists(p, rev):
+                result.append(p)
+                todo.extend(self.children.get(p, ()))
+        return result
+
+    def set(self, path, rev, exists):
+        if path not in self.history:
+            parent = path.rpartition('/')[0]
+            self.children.setdefault(parent, set()).add(path)
+        self.history.setdefault(path, []).append((rev, exists))
+
+    def node(self, rev, hdrs):
+        path = hdrs['Node-path']
+        action = hdrs['Node-action']
+        if action in ('delete', 'replace'):
+            for p in self.tree(path, rev):
+                self.set(p, rev, False)
+            if action == 'delete':
+                return
+        if 'Node-copyfrom-path' in hdrs:
+            src = hdrs['Node-copyfrom-path']
+            srcrev = int(hdrs['Node-copyfrom-rev'])
+            if not self.exists(src, srcrev):
+                self.bad.append((rev, path, src, srcrev))
+            for p in self.tree(src, srcrev):
+                self.set(path + p[len(src):], rev, True)
+        if not self.exists(path, rev):
+            self.set(path, rev, True)
+
+    def check(self, f):
+        """
+        Replay the dump file 'f', and return the list of its invalid copies.
+        """
+        rev = None
+        hdrs = {}
+        while 1:
+            line = f.readline()
+            if line and line != '\n':
+                key, value = line.rstrip('\n').split(': ', 1)
+                hdrs[key] = value
+                continue
+            if 'Revision-number' in hdrs:
+                rev = int(hdrs['Revision-number'])
+            elif 'Node-path' in hdrs:
+                self.node(rev, hdrs)
+            f.seek(int(hdrs.get('Content-length', 0)), 1)
+            hdrs = {}
+            if not line:
+                break
+        return self.bad
+
+
+def parse_options(argv=None):
+    parser = optparse.OptionParser(__doc__.strip())
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="Write the dump to FILE rather than stdout.")
+    parser.add_option('--format', type='int', default=2,
+                      help="Dump format, 2 (full texts) or 3 (deltas) "
+                           "(default: %default).")
+    parser.add_option('--revisions', type='int', default=1000, metavar='N',
+                      help="Number of revisions (default: %default).")
+    parser.add_option('--nodes', type='int', default=4, metavar='N',
+                      help="Average number of changed files per revision "
+                           "(default: %default).")
+    parser.add_option('--sizes', default='60:1K,30:8K,9:64K,1:1M',
+                      metavar='DIST',
+                      help="Distribution of the file sizes, as "
+                           "comma-separated WEIGHT:SIZE items (default: "
+                           "%default).")
+    parser.add_option('--binary-fraction', type='float', default=0.1,
+                      metavar='F',
+                      help="Fraction of the files that are binary (default: "
+                           "%default).")
+    parser.add_option('--huge-every', type='int', default=0, metavar='N',
+                      help="Add a huge binary file every N revisions "
+                           "(default: never).")
+    parser.add_option('--huge-size', default='64M', metavar='SIZE',
+                      help="Size of the huge binary files (default: "
+                           "%default).")
+    parser.add_option('--projects', type='int', default=4, metavar='N',
+                      help="Number of top-level projects (default: "
+                           "%default).")
+    parser.add_option('--depth', type='int', default=3, metavar='N',
+                      help="Directory levels under the trunk of the projects "
+                           "(default: %default).")
+    parser.add_option('--fanout', type='int', default=4, metavar='N',
+                      help="Number of directories at each level (default: "
+                           "%default).")
+    parser.add_option('--copy-density', type='float', default=0.1,
+                      metavar='F',
+                      help="Probability that a revision copies a file or "
+                           "branches a directory, most of the time across "
+                           "projects (default: %default).")
+    parser.add_option('--seed', type='int', default=1,
+                      help="Seed of the random generator (default: "
+                           "%default).")
+    parser.add_option('--check', action='store_true',
+                      help="Check that the copies of the dump are from paths "
+                           "that exist in their source revision (needs "
+                           "--output).")
+    opts, args = parser.parse_args(argv)
+    if args:
+        parser.error("No arguments expected.")
+    if opts.format not in (2, 3):
+        parser.error("Invalid format: %d" % opts.format)
+    if opts.check and not opts.output:
+        parser.error("--check needs --output.")
+    try:
+        opts.huge_size = parse_size(opts.huge_size)
+        parse_distribution(opts.sizes)
+    except ValueError, e:
+        parser.error("Invalid size: %s" % e)
+    return opts
+
+
+def main():
+    opts = parse_options()
+    if opts.output:
+        out = open(opts.output, 'wb')
+    else:
+        out = sys.stdout
+    gen = Generator(opts, out)
+    gen.generate()
+    if opts.output:
+        out.close()
+    print >> sys.stderr, ("Generated %d revisions, %d nodes, %d files." %
+                          (opts.revisions, gen.nodes, len(gen.files)))
+    if opts.check:
+        f = open(opts.output, 'rb')
+        bad = CopyChecker().check(f)
+        f.close()
+        for rev, path, src, srcrev in bad:
+            print >> sys.stderr, ("r%d: copy of '%s' from '%s'@%d, which "
+                                  "does not exist." % (rev, path, src, srcrev))
+        if bad:
+            raise SystemExit("Error: %d invalid copies." % len(bad))
+
+
+if __name__ == '__main__':
+    main()
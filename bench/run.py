@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+#  Benchmarks of svndumpfilter3.
+
+"""run.py [<options>]
+
+Time the main scenarios of svndumpfilter3 on synthetic dumps, and write the
+results as JSON so that they can be compared from one version to the next.
+
+The dumps are made by gendump.py from the parameters of a preset (see
+--preset) and kept in the work directory, so that later runs reuse them.  Each
+scenario is run --repeat times; the best and median wall-clock times are
+reported, along with the throughput and the --stats-json report of the best
+run.  The untangle scenarios use fakesvn.py as 'svnadmin' and 'svnlook', with
+the dump itself as the repository.
+
+  bench/run.py --preset small
+  bench/run.py --preset medium --compare bench/work/results-old.json
+"""
+
+import sys, os, re, time, json, hashlib, platform, optparse, subprocess
+
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+
+presets = {
+    'small': ['--revisions', '500', '--nodes', '4'],
+    'medium': ['--revisions', '3000', '--nodes', '6',
+               '--huge-every', '1000', '--huge-size', '16M'],
+    'large': ['--revisions', '20000', '--nodes', '8', '--depth', '5',
+              '--huge-every', '2000', '--huge-size', '128M'],
+    }
+"""Arguments of gendump.py for the presets."""
+
+
+def exclude_patterns(n):
+    """
+    Return 'n' patterns to exclude, most of them matching nothing, so that
+    the path matching is what the exclude scenario measures.
+    """
+    patterns = ['proj1', 'proj2/trunk/d1/.*']
+    for i in xrange(n - len(patterns)):
+        patterns.append('proj%d/trunk/d%d/x%d.*' % (i % 4, i % 7, i))
+    return patterns
+
+# Each scenario is (name, dump format, arguments), where %(...)s are replaced
+# by the files of the run.  The copies across projects are dropped with -k
+# unless untangled.
+scenarios = [
+    ('include', 2, ['-k', 'proj0']),
+    ('include-format3', 3, ['-k', 'proj0']),
+    ('exclude-many', 2, ['-k', '--exclude-from', '%(patterns)s']),
+    ('filter-contents-logs', 2,
+     ['-k', '-e', 'proj3',
+      '--filter-contents', r'\.(c|h|txt)$', r'secret[0-9]+', 'XXX',
+      '--filter-logs', r'secret[0-9]*', 'XXX']),
+    ('split', 2, ['-k', '--split', '%(splitmap)s']),
+    ('untangle', 2, ['-u', '%(repos)s', 'proj0']),
+    ('untangle-svnlook', 2,
+     ['-u', '%(repos)s', '--untangle-backend', 'svnlook', 'proj0']),
+    ('untangle-from-dump', 2, ['-U', 'proj0']),
+    ]
+
+
+def git_commit(script):
+    """
+    Return the commit of the tree of 'script', if it is in a git checkout.
+    """
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                             cwd=os.path.dirname(os.path.abspath(script)),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0].strip()
+    except OSError:
+        return None
+    return p.returncode == 0 and out or None
+
+
+def make_dump(opts, fmt):
+    """
+    Return the name of the dump of format 'fmt' for the preset, generating
+    it if needed.
+    """
+    # The dumps made before the copies were checked are not reused.
+    args = presets[opts.preset] + opts.gen + ['--format', str(fmt),
+                                              '--check']
+    key = hashlib.md5(' '.join(args)).hexdigest()[:8]
+    filename = os.path.join(opts.workdir, 'dump-%s-f%d-%s.dump' %
+                            (opts.preset, fmt, key))
+    if not os.path.exists(filename):
+        print >> sys.stderr, "Generating %s..." % filename
+        tmp = filename + '.tmp'
+        subprocess.check_call([opts.python,
+                               os.path.join(benchdir, 'gendump.py'),
+                               '-o', tmp] + args)
+        os.rename(tmp, filename)
+    return filename, args
+
+
+def make_fakesvn(opts):
+    """
+    Create the 'svnadmin' and 'svnlook' wrappers of fakesvn.py, and return
+    their directory.
+    """
+    bindir = os.path.join(opts.workdir, 'bin')
+    if not os.path.isdir(bindir):
+        os.makedirs(bindir)
+    for cmd in 'svnadmin', 'svnlook':
+        fn = os.path.join(bindir, cmd)
+        f = open(fn, 'w')
+        f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' %
+                (opts.python, os.path.join(benchdir, 'fakesvn.py'), cmd))
+        f.close()
+        os.chmod(fn, 0755)
+    return bindir
+
+
+def run_scenario(opts, name, dump, args, files, env):
+    """
+    Run a scenario --repeat times, and return its results.
+    """
+    statsfn = os.path.join(opts.workdir, 'stats.json')
+    outfn = os.path.join(opts.workdir, 'out.dump')
+    cmd = [opts.python, opts.script, '-i', dump, '--quiet',
+           '--stats-json', statsfn] + [a % files for a in args]
+    if '--split' not in args:
+        cmd += ['-o', outfn]
+
+    times = []
+    best = None
+    result = {'scenario': name, 'args': cmd[2:], 'dump': dump,
+              'input-bytes': os.path.getsize(dump)}
+    for i in xrange(opts.repeat):
+        errfn = os.path.join(opts.workdir, 'err.log')
+        ferr = open(errfn, 'w')
+        t = time.time()
+        p = subprocess.Popen(cmd, cwd=opts.workdir, env=env, stderr=ferr)
+        p.wait()
+        dt = time.time() - t
+        ferr.close()
+        if p.returncode != 0:
+            result['error'] = open(errfn).read()[-2000:]
+            return result
+        times.append(dt)
+        if best is None or dt < best:
+            best = dt
+            f = open(statsfn)
+            result['stats'] = json.load(f)
+            f.close()
+
+    times.sort()
+    result['seconds'] = times
+    result['best'] = best
+    result['median'] = times[len(times) // 2]
+    result['mb-per-second'] = result['input-bytes'] / 1048576.0 / best
+    return result
+
+
+def compare(old, new):
+    """
+    Print the best times of the results 'new' against those of 'old'.
+    """
+    before = dict((r['scenario'], r) for r in old['results'])
+    print '%-24s %10s %10s %8s' % ('scenario', 'old (s)', 'new (s)', 'ratio')
+    for r in new['results']:
+        o = before.get(r['scenario'])
+        if 'best' not in r or o is None or 'best' not in o:
+            print '%-24s %10s %10s' % (r['scenario'], '-', r.get('best', '-'))
+            continue
+        print '%-24s %10.3f %10.3f %8.2f' % (r['scenario'], o['best'],
+                                             r['best'], r['best'] / o['best'])
+
+
+def parse_options():
+    parser = optparse.OptionParser(__doc__.strip())
+    parser.add_option('--preset', choices=sorted(presets), default='small',
+                      help="Size of the dumps: %s (default: %%default)." %
+                           ', '.join(sorted(presets)))
+    parser.add_option('--gen', action='append', default=[], metavar='ARG',
+                      help="Extra argument for gendump.py, e.g. "
+                           "--gen=--copy-density=0.3 (repeatable).")
+    parser.add_option('--scenario', action='append', default=[],
+                      metavar='REGEXP',
+                      help="Only run the scenarios matching REGEXP "
+                           "(repeatable).")
+    parser.add_option('--repeat', type='int', default=3, metavar='N',
+                      help="Number of runs of each scenario (default: "
+                           "%default).")
+    parser.add_option('--python', default=sys.executable,
+                      help="Python interpreter to run svndumpfilter3 with "
+                           "(default: %default).")
+    parser.add_option('--script',
+                      default=os.path.join(os.path.dirname(benchdir),
+                                           'svndumpfilter3.py'),
+                      help="Script to benchmark (default: %default).")
+    parser.add_option('--workdir', default=os.path.join(benchdir, 'work'),
+                      metavar='DIR',
+                      help="Directory of the dumps and outputs (default: "
+                           "%default).")
+    parser.add_option('-o', '--output', metavar='FILE',
+                      help="Write the results to FILE (default: "
+                           "results-DATE.json in the work directory).")
+    parser.add_option('--compare', metavar='FILE',
+                      help="Compare the results with those of FILE.")
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("No arguments expected.")
+    if opts.repeat <= 0:
+        parser.error("Invalid number of runs: %d" % opts.repeat)
+    opts.script = os.path.abspath(opts.script)
+    opts.workdir = os.path.abspath(opts.workdir)
+    return opts
+
+
+def main():
+    opts = parse_options()
+    if not os.path.isdir(opts.workdir):
+        os.makedirs(opts.workdir)
+
+    # The files the scenarios refer to.
+    files = {}
+    files['patterns'] = os.path.join(opts.workdir, 'patterns.txt')
+    f = open(files['patterns'], 'w')
+    f.write('\n'.join(exclude_patterns(200)) + '\n')
+    f.close()
+    files['splitmap'] = os.path.join(opts.workdir, 'split.map')
+    f = open(files['splitmap'], 'w')
+    for i in xrange(4):
+        f.write('split%d.dump proj%d\n' % (i, i))
+    f.close()
+
+    env = dict(os.environ)
+    env['PATH'] = make_fakesvn(opts) + os.pathsep + env.get('PATH', '')
+
+    report = {
+        'version': 1,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': opts.python,
+        'platform': platform.platform(),
+        'script': opts.script,
+        'commit': git_commit(opts.script),
+        'preset': opts.preset,
+        'dumps': {},
+        'results': [],
+        }
+    for name, fmt, args in scenarios:
+        if opts.scenario and not [rx for rx in opts.scenario
+                                  if re.search(rx, name)]:
+            continue
+        dump, genargs = make_dump(opts, fmt)
+        report['dumps'][dump] = genargs
+        files['repos'] = dump
+        print >> sys.stderr, "Running %s..." % name,
+        result = run_scenario(opts, name, dump, args, files, env)
+        if 'error' in result:
+            print >> sys.stderr, "failed."
+        else:
+            print >> sys.stderr, ("%.3fs, %.1f MB/s." %
+                                  (result['best'], result['mb-per-second']))
+        report['results'].append(result)
+
+    output = opts.output or os.path.join(
+        opts.workdir, 'results-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    f = open(output, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.write('\n')
+    f.close()
+    print >> sys.stderr, "Results written to %s." % output
+
+    if opts.compare:
+        f = open(opts.compare)
+        compare(json.load(f), report)
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -46,6 +46,9 @@ need a live repository and to use --untangle=REPOS_PATH.  Like this::
 
   cat dumpfile | svndumpfilter3 --untangle=/my/svnroot project1 project2
 
+The copy sources are read with 'svnadmin dump' by default; with
+--untangle-backend=svnlook, only the copied subtrees are read, with 'svnlook'.
+
 The paths can include wildcards, and can consist of multiple parts, like::
 
   cat dumpfile | svndumpfilter3 tags/proj.*/subproj trunk/subproj
@@ -219,11 +222,13 @@ __contributors__ = ('Martin Blais <blais@furius.ca>',
 
 
 import sys
-if sys.version_info[:2] < (2, 4):
-    raise SystemExit("Error: You need Python 2.4 or over.")
+if sys.version_info[:2] < (2, 5):
+    raise SystemExit("Error: You need Python 2.5 or over.")
 
 # stdlib imports
-import os, re, string, hashlib, warnings
+import os, re, string, hashlib, warnings, tempfile, shutil, threading, Queue
+import bisect, collections, StringIO, sre_parse, sre_constants, array
+import time
 from os.path import basename
 from subprocess import Popen, PIPE
 
@@ -257,14 +262,7 @@ def splitpath(s):
     """
     Split a string path into a path-as-list (a list of its components).
     """
-    thelist = string.split(s, "/")
-    # Simplest way to remove all empty elements!
-    try:
-        while 1:
-            thelist.remove("")
-    except ValueError:
-        pass
-    return thelist
+    return [c for c in s.split("/") if c]
 
 def joinpath(thelist, prefix=""):
     """
@@ -279,148 +277,525 @@ def catpath(path1, path2, prefix=""):
     return joinpath(splitpath(path1) + splitpath(path2), prefix)
 
 
+# Characters that make a path component a regular expression rather than a
+# literal name.
+regex_chars_re = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+class PathTrieNode:
+    """
+    A node of the compiled path matcher: one level of path components.
+    """
+    def __init__(self):
+        self.terminal = False
+        """True if a pattern ends at this node."""
+
+        self.literal = {}
+        """Children for literal components, by name."""
+
+        self.wild = []
+        """List of (regexp, child) for components that are regexps."""
+
+        self.wild_index = {}
+        """Children for regexp components, by regexp source, so that patterns
+        sharing a component share a child."""
+
+        self.wild_re = None
+        """A single regexp that matches whatever any of the (group-free) regexp
+        components matches, used to rule them out all at once."""
+
+        self.wild_rest = []
+        """List of (regexp, child) for the components that could not be folded
+        into 'wild_re'."""
+
+    def child(self, component):
+        """
+        Return the child node for pattern component 'component', creating it
+        if needed.
+        """
+        if not regex_chars_re.search(component):
+            try:
+                return self.literal[component]
+            except KeyError:
+                node = self.literal[component] = PathTrieNode()
+                return node
+        try:
+            return self.wild_index[component]
+        except KeyError:
+            node = self.wild_index[component] = PathTrieNode()
+            self.wild.append((re.compile('^' + component + '$'), node))
+            return node
+
+    def compile(self):
+        """
+        Build the combined regexps of this node and its descendants.
+        """
+        simple = [rx.pattern for rx, node in self.wild if rx.groups == 0]
+        if len(simple) > 1:
+            self.wild_re = re.compile('|'.join('(?:%s)' % p for p in simple))
+            self.wild_rest = [(rx, node) for rx, node in self.wild
+                              if rx.groups > 0]
+        else:
+            self.wild_rest = self.wild
+        for node in self.literal.itervalues():
+            node.compile()
+        for rx, node in self.wild:
+            node.compile()
+
+
 # Note: from Simon Tatham.
 class InterestingPaths:
     """
     Decide whether a pathname is interesting or not.
+
+    Each pattern is a list of per-component regular expressions, which must
+    match the leading components of a path.  The patterns are compiled into a
+    trie, in which literal components are looked up by name and the regexp
+    components at each level are tried with a single combined regexp first.
+    Results are memoized by path.
     """
-    def __init__(self, args, reverse):
+    def __init__(self, args, reverse, cachesize=65536):
         self.reverse = reverse
         """True if we should reverse the matches, e.g. true means exclude on the
         list of paths rather than include."""
 
-        self.res = []
+        self.root = PathTrieNode()
         for a in args:
-            self.res.append([])
+            node = self.root
             for component in splitpath(a):
-                self.res[-1].append(re.compile('^' + component + '$'))
-        """List of regular expressions to match against/exclude."""
+                node = node.child(component)
+            node.terminal = True
+        self.root.compile()
+        """Trie of the path components to match against/exclude."""
+
+        self.cachesize = cachesize
+        self.cache = {}
+        self.oldcache = {}
+        """Memo of the results, by path.  When the cache fills up it becomes
+        the old generation, which is kept until the next turnover and from
+        which paths that are still in use get promoted; this approximates a
+        least-recently-used policy using plain dicts."""
 
     def interesting(self, path):
         """
         Return true if this path is considered included.
         """
-        match = False
+        try:
+            return self.cache[path]
+        except KeyError:
+            pass
+        try:
+            match = self.oldcache[path]
+        except KeyError:
+            match = self.match(path)
+            if self.reverse:
+                match = not match
+        if len(self.cache) >= self.cachesize // 2:
+            self.oldcache = self.cache
+            self.cache = {}
+        self.cache[path] = match
+        return match
+
+    def match(self, path):
+        """
+        Return true if one of the patterns matches 'path', regardless of
+        whether we include or exclude.
+        """
         acomps = splitpath(path)
         assert len(acomps) > 0
-        for rcomps in self.res:
-            # if rcomps has more components than acomps
-            # then we  cannot have a match, so skip this case
-            if len(rcomps) > len(acomps):
-                continue
-            # see if rcomps matches acomps
-            for r, a in zip(rcomps, acomps):
-                if not r.match(a):
-                    break
-            else:
-                # everything matches
-                match = True
-                break
-        if self.reverse:
-            match = not match
-        return match
+        nodes = [self.root]
+        for a in acomps:
+            nextnodes = []
+            for node in nodes:
+                if node.terminal:
+                    return True
+                try:
+                    nextnodes.append(node.literal[a])
+                except KeyError:
+                    pass
+                if node.wild_re is not None and node.wild_re.match(a):
+                    for r, child in node.wild:
+                        if r.match(a):
+                            nextnodes.append(child)
+                else:
+                    for r, child in node.wild_rest:
+                        if r.match(a):
+                            nextnodes.append(child)
+            if not nextnodes:
+                return False
+            nodes = nextnodes
+        for node in nodes:
+            if node.terminal:
+                return True
+        return False
+
+
+def read_patterns(filename):
+    """
+    Read a list of path patterns from a file, one per line.  Blank lines and
+    lines starting with '#' are ignored.
+    """
+    patterns = []
+    f = open(filename)
+    try:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                patterns.append(line)
+    finally:
+        f.close()
+    return patterns
+
+
+class LazyText:
+    """
+    A handle on a node text that has not been read from the input yet.  Large
+    texts are copied from the input to their destination in fixed-size chunks,
+    so that a huge file never has to be held in memory as a whole.  The text
+    must be consumed (copied, read or discarded) before the next lump is read
+    from the same input.  It can only be consumed more than once if the input
+    is seekable.
+    """
+    def __init__(self, f, length, chunksize, offset=None):
+        self.f = f
+        self.length = length
+        self.chunksize = chunksize
+        self.offset = offset
+        """Offset of the text in the input, or None if it is not seekable."""
+        self.remaining = length
+        """Number of bytes that have not been consumed from the input yet."""
+
+    def __len__(self):
+        return self.length
+
+    def chunks(self, view=False):
+        """
+        Generate the text from the input, one chunk at a time.  If 'view' is
+        true, the chunks may be views on the buffer of a DumpReader.
+        """
+        if self.remaining != self.length:
+            assert self.offset is not None, "Node text was already consumed."
+            self.f.seek(self.offset)
+            self.remaining = self.length
+        read = self.f.read
+        if view and isinstance(self.f, DumpReader):
+            read = self.f.readview
+        while self.remaining > 0:
+            data = read(min(self.chunksize, self.remaining))
+            if not data:
+                raise SystemExit("Error: Unexpected end of file in node text.")
+            self.remaining -= len(data)
+            yield data
+
+    def head(self, size):
+        """
+        Return the first 'size' bytes of the text, reading only those.
+        """
+        if self.remaining != self.length:
+            assert self.offset is not None, "Node text was already consumed."
+            self.f.seek(self.offset)
+        data = self.f.read(min(size, self.length))
+        self.remaining = self.length - len(data)
+        return data
+
+    def copyto(self, f):
+        """
+        Copy the text to the output file 'f'.
+        """
+        for data in self.chunks(True):
+            f.write(data)
+
+    def read(self):
+        """
+        Materialize the text in memory and return it as a string.
+        """
+        return ''.join(self.chunks())
+
+    def discard(self):
+        """
+        Skip over whatever has not been consumed of the text.
+        """
+        if self.remaining > 0 and self.offset is not None:
+            self.f.seek(self.offset + self.length)
+            self.remaining = 0
+        while self.remaining > 0:
+            data = self.f.read(min(self.chunksize, self.remaining))
+            if not data:
+                raise SystemExit("Error: Unexpected end of file in node text.")
+            self.remaining -= len(data)
 
 
 # Note: from Simon Tatham.
-class Lump:
+class Lump(object):
     """
     A class and some functions to handle a single lump of
     RFC822-ish-headers-plus-data read from an SVN dump file.
+
+    The headers and the properties are kept in dicts, along with the lists of
+    their keys in order.  Deleted keys are left in the lists until a key is
+    added again or the keys are listed, so that every edit is constant-time.
     """
-    def __init__(self):
-        self.hdrlist = []
-        self.hdrdict = {}
+    __slots__ = ('hdrdict', '_hdrkeys', '_hdrstale', 'prop', 'text',
+                 '_propdict', '_propkeys', '_propstale', 'hasprop', 'hastext',
+                 'rawhdr', 'offset', 'hdrdirty', 'propdirty', 'textdirty')
+
+    def __init__(self, hdrdict=None, hdrkeys=None):
+        if hdrdict is None:
+            hdrdict, hdrkeys = {}, []
+        self.hdrdict = hdrdict
+        self._hdrkeys = hdrkeys
+        self._hdrstale = False
         self.prop = ""
         self.text = ""
-        self.proplist = []
-        self.propdict = {}
+        self._propdict = {}
+        """The properties, None until 'prop' is parsed."""
+        self._propkeys = []
+        self._propstale = False
+
+        self.hasprop = False
+        self.hastext = False
+        """Whether the lump has a properties and a text block, even empty."""
+
+        self.rawhdr = ""
+        """The headers block as it was read from the input."""
+
+        self.offset = None
+        """Offset of the headers block in the input, if it is seekable.  The
+        original bytes of the lump are 'rawhdr', a blank line, 'prop' and
+        'text', so they do not need to be copied to be kept around."""
+
+        self.hdrdirty = True
+        self.propdirty = False
+        self.textdirty = False
+        """Flags that track which parts of the lump were modified since it was
+        read.  Clean parts are written out verbatim."""
+
+    def hdrkeys(self):
+        """
+        Return the list of the header keys, in order.
+        """
+        if self._hdrstale:
+            self._hdrkeys = [k for k in self._hdrkeys if k in self.hdrdict]
+            self._hdrstale = False
+        return self._hdrkeys
 
     def sethdr(self, key, val):
         """
         Set header 'key' to 'val'.
         """
-        if not self.hdrdict.has_key(key):
-            self.hdrlist.append(key)
-        self.hdrdict[key] = val
+        hdrdict = self.hdrdict
+        if key not in hdrdict:
+            # Drop a deleted entry of the same key before appending it.
+            if self._hdrstale:
+                self.hdrkeys()
+            self._hdrkeys.append(key)
+        elif hdrdict[key] == val:
+            return
+        hdrdict[key] = val
+        self.hdrdirty = True
 
     def delhdr(self, key):
         """
         Delete the header 'key'.
         """
-        if self.hdrdict.has_key(key):
+        if key in self.hdrdict:
             del self.hdrdict[key]
-            self.hdrlist.remove(key)
+            self._hdrstale = True
+            self.hdrdirty = True
+
+    @property
+    def propdict(self):
+        """
+        The dict of the properties, parsed from 'prop' when first used.
+        """
+        if self._propdict is None:
+            self.propparse()
+        return self._propdict
+
+    def propkeys(self):
+        """
+        Return the list of the property keys, in order.
+        """
+        propdict = self.propdict
+        if self._propstale:
+            self._propkeys = [k for k in self._propkeys if k in propdict]
+            self._propstale = False
+        return self._propkeys
 
     def propparse(self):
         """
         Parse the properties of the lump.
         """
+        prop = self.prop
+        propdict = {}
+        propkeys = []
         index = 0
         while 1:
-            if self.prop[index:index+2] == "K ":
+            tag = prop[index:index+2]
+            if tag == "K ":
                 wantval = 1
-            elif self.prop[index:index+2] == "D ":
+            elif tag == "D ":
                 wantval = 0
-            elif self.prop[index:index+9] == "PROPS-END":
+            elif prop.startswith("PROPS-END", index):
                 break
             else:
-                raise "Unrecognised record in props section"
-            nlpos = string.find(self.prop, "\n", index)
+                raise SystemExit("Error: Unrecognised record in props section")
+            nlpos = prop.find("\n", index)
             assert nlpos > 0
-            namelen = string.atoi(self.prop[index+2:nlpos])
-            assert self.prop[nlpos+1+namelen] == "\n"
-            name = self.prop[nlpos+1:nlpos+1+namelen]
+            namelen = int(prop[index+2:nlpos])
+            assert prop[nlpos+1+namelen] == "\n"
+            name = prop[nlpos+1:nlpos+1+namelen]
             index = nlpos+2+namelen
             if wantval:
-                assert self.prop[index:index+2] == "V "
-                nlpos = string.find(self.prop, "\n", index)
+                assert prop[index:index+2] == "V "
+                nlpos = prop.find("\n", index)
                 assert nlpos > 0
-                proplen = string.atoi(self.prop[index+2:nlpos])
-                assert self.prop[nlpos+1+proplen] == "\n"
-                prop = self.prop[nlpos+1:nlpos+1+proplen]
+                proplen = int(prop[index+2:nlpos])
+                assert prop[nlpos+1+proplen] == "\n"
+                val = prop[nlpos+1:nlpos+1+proplen]
                 index = nlpos+2+proplen
             else:
-                prop = None
-            self.proplist.append(name)
-            self.propdict[name] = prop
+                val = None
+            if name not in propdict:
+                propkeys.append(name)
+            propdict[name] = val
+        self._propdict = propdict
+        self._propkeys = propkeys
+        self._propstale = False
 
     def setprop(self, key, val):
         """
         Set property 'key' to 'val'.
         """
-        if not self.propdict.has_key(key):
-            self.proplist.append(key)
-        self.propdict[key] = val
+        propdict = self.propdict
+        if key not in propdict:
+            if self._propstale:
+                self.propkeys()
+            self._propkeys.append(key)
+        propdict[key] = val
         self.hasprop = True
+        self.propdirty = True
 
     def delprop(self, key):
         """
         Delete property 'key'.
         """
-        if self.propdict.has_key(key):
-            del self.propdict[key]
-            self.proplist.remove(key)
+        propdict = self.propdict
+        if key in propdict:
+            del propdict[key]
+            self._propstale = True
+            self.propdirty = True
+
+    def settext(self, text):
+        """
+        Replace the text of the lump with 'text'.
+        """
+        self.text = text
+        self.hastext = True
+        self.textdirty = True
+
+    def loadtext(self):
+        """
+        Make sure the text of the lump is held in memory, reading it from the
+        input if it is still being streamed.
+        """
+        if isinstance(self.text, LazyText):
+            self.text = self.text.read()
+
+    def spooltext(self):
+        """
+        Make sure that a streamed text can be read more than once, by copying
+        it to a temporary file if the input is not seekable.
+        """
+        if isinstance(self.text, LazyText) and self.text.offset is None:
+            f = tempfile.TemporaryFile()
+            self.text.copyto(f)
+            f.seek(0)
+            self.text = LazyText(f, self.text.length, self.text.chunksize, 0)
+
+    def detach(self):
+        """
+        Make the lump independent of the dump it was read from, copying a text
+        still streamed from it to a temporary file.
+        """
+        if (isinstance(self.text, LazyText) and
+            isinstance(self.text.f, DumpReader)):
+            f = tempfile.TemporaryFile()
+            self.text.copyto(f)
+            f.seek(0)
+            self.text = LazyText(f, self.text.length, self.text.chunksize, 0)
+
+    def clone(self):
+        """
+        Return a copy of the lump whose headers and properties can be modified
+        independently.
+        """
+        lump = Lump.__new__(Lump)
+        for name in Lump.__slots__:
+            setattr(lump, name, getattr(self, name))
+        lump.hdrdict = dict(self.hdrdict)
+        lump._hdrkeys = list(self._hdrkeys)
+        if self._propdict is not None:
+            lump._propdict = dict(self._propdict)
+            lump._propkeys = list(self._propkeys)
+        return lump
+
+    def hashtext(self):
+        """
+        Set the length and checksum headers from the text, which is read in
+        chunks if it is streamed.  The SHA-1 checksum is only set if the lump
+        had one.
+        """
+        hashes = [("Text-content-md5", hashlib.new('md5'))]
+        if "Text-content-sha1" in self.hdrdict:
+            hashes.append(("Text-content-sha1", hashlib.new('sha1')))
+        if isinstance(self.text, LazyText):
+            chunks = self.text.chunks()
+        else:
+            chunks = [self.text]
+        for data in chunks:
+            for key, m in hashes:
+                m.update(data)
+        self.sethdr("Text-content-length", str(len(self.text)))
+        for key, m in hashes:
+            self.sethdr(key, m.hexdigest())
+
+    def discard(self):
+        """
+        Skip the remainder of a streamed text that was not written out, so that
+        the input is positioned at the next lump.
+        """
+        if isinstance(self.text, LazyText):
+            self.text.discard()
 
     def correct_headers(self):
         """
         Adjust the headers, from updated contents.
         """
-        # First reconstitute the properties block.
-        self.prop = ""
-
-        # JT if there's a delete of something that got added in the same transaction
-        #    (ie, it was added and then renamed), there must be no properties created for it
-        #if not opts.prune_properties or len(self.proplist) > 0:
-        if (not opts.prune_properties or len(self.proplist) > 0) and self.hdrdict.get('Node-action') != "delete":
-            for key in self.proplist:
-                val = self.propdict[key]
-                if val is None:
-                    self.prop += "D %d\n%s\n" % (len(key), key)
-                else:
-                    self.prop += "K %d\n%s\n" % (len(key), key)
-                    self.prop += "V %d\n%s\n" % (len(val), val)
-            if self.hasprop:
-                self.prop = self.prop + "PROPS-END\n"
+        hdrdict = self.hdrdict
+        isdelete = hdrdict.get('Node-action') == "delete"
+
+        # First reconstitute the properties block, unless it is unmodified.
+        if self.propdirty or (self.hasprop and
+                              (isdelete or (opts.prune_properties and
+                                            len(self.propdict) == 0))):
+            parts = []
+
+            # JT if there's a delete of something that got added in the same transaction
+            #    (ie, it was added and then renamed), there must be no properties created for it
+            #if not opts.prune_properties or len(self.proplist) > 0:
+            propdict = self.propdict
+            if (not opts.prune_properties or len(propdict) > 0) and not isdelete:
+                for key in self.propkeys():
+                    val = propdict[key]
+                    if val is None:
+                        parts.append("D %d\n%s\n" % (len(key), key))
+                    else:
+                        parts.append("K %d\n%s\nV %d\n%s\n" %
+                                     (len(key), key, len(val), val))
+                if self.hasprop:
+                    parts.append("PROPS-END\n")
+            self.prop = "".join(parts)
+            self.propdirty = False
 
         # Now fix up the content length headers.
         if len(self.prop) > 0:
@@ -428,15 +803,24 @@ class Lump:
         else:
             self.delhdr("Prop-content-length")
 
-        if self.hastext and len(self.text) >= 0 or \
-           (self.hdrdict.get('Node-action', None) == 'add' and
-            self.hdrdict.get('Node-kind', None) == 'file' and
-            not self.hdrdict.get('Node-copyfrom-path', None)):
-
-            self.sethdr("Text-content-length", str(len(self.text)))
-            m = hashlib.new('md5')
-            m.update(self.text)
-            self.sethdr("Text-content-md5", m.hexdigest())
+        if isinstance(self.text, LazyText) and not self.textdirty:
+            # The text is streamed through unmodified, so its length and
+            # checksum headers from the input are still valid.
+            pass
+
+        elif self.hastext and len(self.text) >= 0 or \
+           (hdrdict.get('Node-action', None) == 'add' and
+            hdrdict.get('Node-kind', None) == 'file' and
+            not hdrdict.get('Node-copyfrom-path', None)):
+
+            # Only rehash texts that were modified or lack a checksum.  The
+            # checksums of a delta are those of the text it expands to, they
+            # cannot be computed from it.
+            if self.textdirty or not self.hastext or \
+               ("Text-content-md5" not in hdrdict and
+                hdrdict.get('Text-delta') != 'true'):
+                self.hashtext()
+            self.textdirty = False
         else:
             self.delhdr("Text-content-length")
             self.delhdr("Text-content-md5")
@@ -447,6 +831,549 @@ class Lump:
             self.delhdr("Content-length")
 
 
+class DumpReader:
+    """
+    A reader of dump files that pulls large blocks from the binary input and
+    finds the header blocks of the lumps by scanning its buffer, rather than
+    reading them line by line.  It also provides the file methods used on the
+    input (readline, read, seek, tell), keeping track of its position.
+    """
+    def __init__(self, f, blocksize=1 << 16, prefix=""):
+        self.f = f
+        self.blocksize = blocksize
+        self.buf = prefix
+        """Buffered data, starting with 'prefix' that was already read."""
+        self.pos = 0
+        """Position of the next byte to hand out in 'buf'."""
+        self.base = tell(f)
+        """Offset of 'buf' in the input, None if it is not seekable."""
+        if self.base is not None:
+            self.base -= len(prefix)
+        self.nread = len(prefix)
+        """Number of bytes read from the input so far."""
+
+    def fill(self):
+        """
+        Read another block from the input into the buffer, dropping what was
+        already consumed.  Return false at the end of the input.
+        """
+        data = self.f.read(self.blocksize)
+        self.nread += len(data)
+        if self.pos:
+            if self.base is not None:
+                self.base += self.pos
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        if not data:
+            return False
+        self.buf += data
+        return True
+
+    def read_headers(self):
+        """
+        Return the next headers block, up to the blank line that ends it (the
+        line is consumed but not returned), or None at the end of the input.
+        Blank lines before the headers are skipped.
+        """
+        while 1:
+            # Skip the newlines before the headers.
+            buf, pos = self.buf, self.pos
+            while pos < len(buf) and buf[pos] == '\n':
+                pos += 1
+            self.pos = pos
+            if pos == len(buf):
+                if not self.fill():
+                    return None
+                continue
+
+            end = buf.find('\n\n', pos)
+            if end >= 0:
+                self.pos = end + 2
+                return buf[pos:end + 1]
+            if not self.fill():
+                # The last headers block of the input is not terminated.
+                block, self.pos = self.buf[self.pos:], len(self.buf)
+                if not block.endswith('\n'):
+                    block += '\n'
+                return block
+
+    def readline(self):
+        while 1:
+            end = self.buf.find('\n', self.pos)
+            if end >= 0:
+                line = self.buf[self.pos:end + 1]
+                self.pos = end + 1
+                return line
+            if not self.fill():
+                line = self.buf[self.pos:]
+                self.pos = len(self.buf)
+                return line
+
+    def read(self, size):
+        avail = len(self.buf) - self.pos
+        if size <= avail:
+            data = self.buf[self.pos:self.pos + size]
+            self.pos += size
+            return data
+
+        # Hand out the rest of the buffer and read the remainder directly.
+        data = self.buf[self.pos:]
+        rest = self.f.read(size - avail)
+        if len(rest) < size - avail:
+            raise SystemExit("Error: Unexpected end of file.")
+        if self.base is not None:
+            self.base += len(self.buf) + len(rest)
+        self.buf = ""
+        self.pos = 0
+        return data + rest
+
+    def readview(self, size):
+        """
+        Like read(), but return a view on the buffer if the data is held in it,
+        to avoid copying it.  This is a buffer object rather than a memoryview,
+        which text mode files like sys.stdout do not accept.
+        """
+        if size <= len(self.buf) - self.pos:
+            view = buffer(self.buf, self.pos, size)
+            self.pos += size
+            return view
+        return self.read(size)
+
+    def tell(self):
+        if self.base is None:
+            raise IOError("Input is not seekable.")
+        return self.base + self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset, whence = self.tell() + offset, 0
+        if (whence == 0 and self.base is not None and
+            self.base <= offset <= self.base + len(self.buf)):
+            self.pos = offset - self.base
+            return
+        self.f.seek(offset, whence)
+        self.base = self.f.tell()
+        self.buf = ""
+        self.pos = 0
+
+    def close(self):
+        self.f.close()
+
+
+class DumpWriter:
+    """
+    An output for a filtered dump that coalesces what is written to it into
+    large writes to the file descriptor, bypassing the stdio buffer of the
+    file.  The 'flush' policy says when the buffer is written out: 'size' only
+    when it is full, 'revision' also before each revision, so that a reader
+    like 'svnadmin load' gets whole revisions as they are filtered, and
+    'lump' after every write.
+
+    If 'direct' is true, the file is written with O_DIRECT: the buffer is then
+    page-aligned memory and only written in whole blocks, except for the
+    remainder at the end.  This falls back to normal writes if the file system
+    does not support it.
+    """
+    blocksize = 4096
+    """Alignment of the writes done with O_DIRECT."""
+
+    def __init__(self, f, bufsize=1 << 20, flush='size', direct=False):
+        self.f = f
+        self.name = getattr(f, 'name', None)
+        self.fd = None
+        """Descriptor written to, None to use the write method of 'f'."""
+        if hasattr(f, 'fileno'):
+            self.fd = f.fileno()
+        self.flushpolicy = flush
+
+        self.bufsize = max(bufsize, self.blocksize)
+        self.parts = []
+        self.size = 0
+        """Pending data, and its size."""
+        self.nwritten = 0
+        """Number of bytes written out so far."""
+
+        self.block = None
+        """Aligned buffer of the O_DIRECT writes, None if not using them."""
+        if direct:
+            self.bufsize -= self.bufsize % self.blocksize
+            self.setdirect(True)
+
+    def setdirect(self, enable):
+        """
+        Turn O_DIRECT on or off for the file, returning true if it succeeded.
+        """
+        if not hasattr(os, 'O_DIRECT') or self.fd is None:
+            return False
+        import stat
+        if not stat.S_ISREG(os.fstat(self.fd).st_mode):
+            return False # Not for pipes, where it means packet mode.
+        import fcntl
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+        if enable:
+            flags |= os.O_DIRECT
+        else:
+            flags &= ~os.O_DIRECT
+        try:
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags)
+        except IOError:
+            return False
+        if enable:
+            import mmap
+            self.block = mmap.mmap(-1, self.bufsize)
+        return True
+
+    def write(self, data):
+        if self.block is not None:
+            self.writedirect(data)
+        elif not isinstance(data, str):
+            # The views on the input buffer of streamed texts cannot be
+            # joined, they are large enough to be written out directly.
+            self.flush()
+            self.writeall(data)
+        else:
+            self.parts.append(data)
+            self.size += len(data)
+            if self.size >= self.bufsize:
+                self.flush()
+        if self.flushpolicy == 'lump':
+            self.flush()
+
+    def writedirect(self, data):
+        """
+        Copy 'data' to the aligned buffer, writing it out whenever it is full.
+        """
+        pos, length = 0, len(data)
+        while pos < length:
+            n = min(length - pos, self.bufsize - self.size)
+            self.block[self.size:self.size + n] = data[pos:pos + n]
+            self.size += n
+            pos += n
+            if self.size == self.bufsize:
+                self.writeall(self.block)
+                self.size = 0
+
+    def writeall(self, data):
+        """
+        Write 'data' to the file descriptor, retrying short writes.
+        """
+        self.nwritten += len(data)
+        if self.fd is None:
+            self.f.write(data)
+            return
+        pos = 0
+        while pos < len(data):
+            pos += os.write(self.fd, buffer(data, pos))
+
+    def revision(self):
+        """
+        Called before each revision written out, to apply the flush policy.
+        """
+        if self.flushpolicy == 'revision':
+            self.flush()
+
+    def flush(self):
+        if self.block is not None:
+            # Only whole blocks can be written, keep the remainder.
+            n = self.size - self.size % self.blocksize
+            if n:
+                self.writeall(buffer(self.block, 0, n))
+                self.block[0:self.size - n] = self.block[n:self.size]
+                self.size -= n
+        elif self.parts:
+            data = ''.join(self.parts)
+            self.parts = []
+            self.size = 0
+            self.writeall(data)
+
+    def close(self):
+        self.flush()
+        if self.block is not None:
+            # Write the last partial block without O_DIRECT.
+            self.setdirect(False)
+            self.writeall(buffer(self.block, 0, self.size))
+            self.block.close()
+            self.block = None
+        self.f.close()
+
+
+codec_magics = [('\x1f\x8b', 'gzip'), ('BZh', 'bzip2'),
+                ('\xfd7zXZ\x00', 'xz'), ('\x28\xb5\x2f\xfd', 'zstd')]
+"""Leading bytes of the compressed files, and their codec."""
+
+codec_suffixes = {'.gz': 'gzip', '.bz2': 'bzip2', '.xz': 'xz', '.zst': 'zstd'}
+"""Extensions of the compressed files, and their codec."""
+
+codec_commands = {'xz': ('xz', '-T0'), 'zstd': ('zstd', '-q', '-T0')}
+"""Commands run to compress with the codecs that are not in the standard
+library; they decompress with an additional -d."""
+
+
+def make_decompressor(codec):
+    """
+    Return a new decompressor object for 'codec', one of gzip or bzip2.
+    """
+    if codec == 'gzip':
+        import zlib
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        import bz2
+        return bz2.BZ2Decompressor()
+
+def stream_ended(d):
+    """
+    Return true if the decompressor 'd' has reached the end of its stream:
+    the data given after it is left unused by zlib, and refused with an
+    EOFError by bz2.
+    """
+    try:
+        d.decompress('\0')
+    except EOFError:
+        return True
+    except Exception:
+        return False
+    return bool(getattr(d, 'unused_data', ''))
+
+def make_compressor(codec):
+    """
+    Return a new compressor object for 'codec', one of gzip or bzip2.
+    """
+    if codec == 'gzip':
+        import zlib
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        import bz2
+        return bz2.BZ2Compressor(9)
+
+
+class CodecThread(threading.Thread):
+    """
+    A thread that moves data between a file and a bounded queue, compressing
+    or decompressing it on the way, so that the codec works in parallel with
+    the filtering (zlib and bz2 release the GIL while they work).  Errors are
+    passed through the queue to the other end.
+    """
+    def __init__(self, target, *args):
+        threading.Thread.__init__(self, target=self.guard,
+                                  args=(target,) + args)
+        self.setDaemon(True)
+        self.error = None
+
+    def guard(self, target, *args):
+        try:
+            target(*args)
+        except Exception, e:
+            self.error = e
+
+
+class DecompressReader:
+    """
+    A file-like object that reads the decompressed data of the file 'f',
+    compressed with 'codec', which is decompressed by a background thread.
+    'prefix' are the bytes that were already read from 'f'.
+    """
+    def __init__(self, f, codec, prefix="", blocksize=1 << 20, depth=8):
+        self.f = f
+        self.codec = codec
+        self.blocksize = blocksize
+        self.queue = Queue.Queue(depth)
+        self.data = ""
+        self.pos = 0
+        """Decompressed data not read yet, from 'pos' in 'data'."""
+        self.eof = False
+        self.thread = CodecThread(self.run, prefix)
+        self.thread.start()
+
+    def run(self, data):
+        try:
+            d = make_decompressor(self.codec)
+            while 1:
+                if not data:
+                    data = self.f.read(self.blocksize)
+                    if not data:
+                        if not stream_ended(d):
+                            raise IOError("The compressed data is truncated.")
+                        break
+                try:
+                    out = d.decompress(data)
+                except EOFError:
+                    # The previous stream ended exactly at the end of a block,
+                    # so nothing was left over to start the next one with.
+                    d = make_decompressor(self.codec)
+                    continue
+                if out:
+                    self.queue.put(out)
+
+                # Start over after the end of a stream, for the files made
+                # of several concatenated streams.
+                data = getattr(d, 'unused_data', '')
+                if data:
+                    d = make_decompressor(self.codec)
+        finally:
+            self.queue.put(None)
+
+    def read(self, size):
+        if len(self.data) - self.pos >= size:
+            # Hand out a piece of the current block without copying the rest.
+            data = self.data[self.pos:self.pos + size]
+            self.pos += size
+            return data
+
+        parts = [self.data[self.pos:]]
+        length = len(parts[0])
+        while length < size and not self.eof:
+            data = self.queue.get()
+            if data is None:
+                self.eof = True
+                # The error is only recorded after the end was queued.
+                self.thread.join()
+                if self.thread.error is not None:
+                    raise SystemExit("Error: Decompressing the input: %s" %
+                                     self.thread.error)
+                break
+            parts.append(data)
+            length += len(data)
+        self.data = ''.join(parts)
+        self.pos = min(size, len(self.data))
+        return self.data[:size]
+
+    def tell(self):
+        raise IOError("Compressed input is not seekable.")
+
+    def close(self):
+        self.f.close()
+
+
+class CompressWriter:
+    """
+    A file-like object that writes the data written to it to file 'f',
+    compressed with 'codec' by a background thread.
+    """
+    def __init__(self, f, codec, depth=8):
+        self.f = f
+        self.name = getattr(f, 'name', None)
+        self.codec = codec
+        self.queue = Queue.Queue(depth)
+        self.thread = CodecThread(self.run)
+        self.thread.start()
+
+    def run(self):
+        c = make_compressor(self.codec)
+        while 1:
+            data = self.queue.get()
+            if data is None:
+                break
+            out = c.compress(data)
+            if out:
+                self.f.write(out)
+        self.f.write(c.flush())
+
+    def write(self, data):
+        if self.thread.error is not None:
+            raise SystemExit("Error: Compressing the output: %s" %
+                             self.thread.error)
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.f.close()
+        if self.thread.error is not None:
+            raise SystemExit("Error: Compressing the output: %s" %
+                             self.thread.error)
+
+
+class CodecProcess:
+    """
+    A file-like object that pipes the data through the command of 'codec',
+    for the codecs not in the standard library.  If 'write' is true, the data
+    written to it is compressed to file 'f', otherwise the data of 'f' is
+    decompressed to be read from it, 'prefix' being the bytes that were
+    already read from 'f'.
+    """
+    def __init__(self, f, codec, write, prefix=""):
+        self.codec = codec
+        self.name = getattr(f, 'name', None)
+        cmd = codec_commands[codec]
+        try:
+            if write:
+                self.p = Popen(cmd + ('-c',), stdin=PIPE, stdout=f)
+                self.pipe = self.p.stdin
+            else:
+                self.p = Popen(cmd + ('-d', '-c'), stdin=PIPE, stdout=PIPE)
+                self.pipe = self.p.stdout
+        except OSError, e:
+            raise SystemExit("Error: Could not run '%s': %s" % (cmd[0], e))
+
+        self.thread = None
+        self.eof = False
+        """Whether all the decompressed data was read."""
+        if write:
+            f.close()
+        else:
+            # Feed the command from a thread, starting with the prefix.
+            self.thread = CodecThread(self.feed, f, prefix)
+            self.thread.start()
+
+    def feed(self, f, data):
+        try:
+            while data:
+                self.p.stdin.write(data)
+                data = f.read(1 << 20)
+        finally:
+            self.p.stdin.close()
+            f.close()
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def read(self, size):
+        data = self.pipe.read(size)
+        if not data and size:
+            self.eof = True
+        return data
+
+    def write(self, data):
+        self.pipe.write(data)
+
+    def tell(self):
+        raise IOError("Compressed input is not seekable.")
+
+    def close(self):
+        self.pipe.close()
+        # A decompression stopped early is expected to fail, but not one
+        # that was read to the end.
+        if self.p.wait() != 0 and (self.thread is None or self.eof):
+            raise SystemExit("Error: '%s' failed." %
+                             codec_commands[self.codec][0])
+        if self.thread is not None and self.eof:
+            self.thread.join()
+            if self.thread.error is not None:
+                raise SystemExit("Error: Reading the input: %s" %
+                                 self.thread.error)
+
+
+def open_input(filename=None):
+    """
+    Open the input dump 'filename' (stdin if None) as a DumpReader,
+    decompressing it if it starts like a compressed file.
+    """
+    if filename is None:
+        f = sys.stdin
+    else:
+        f = open(filename, 'rb')
+    prefix = f.read(6)
+    for magic, codec in codec_magics:
+        if prefix.startswith(magic):
+            break
+    else:
+        return DumpReader(f, prefix=prefix)
+
+    if codec in codec_commands:
+        return DumpReader(CodecProcess(f, codec, False, prefix))
+    return DumpReader(DecompressReader(f, codec, prefix))
+
+
 format_re = re.compile('SVN-fs-dump-format-version: (\d+)\s*$')
 uuid_re = re.compile('UUID: ([0-9a-fA-F\-]+)\s*$')
 
@@ -466,38 +1393,57 @@ def read_dump_header(f):
     return mo_version.group(1), mo_uuid.group(1), text
 
 
+def dump_format(f):
+    """
+    Return the format of the dump in seekable file 'f', positioned at its
+    start, without moving it.
+    """
+    start = f.tell()
+    format = read_dump_header(f)[0]
+    f.seek(start)
+    return format
+
+
 header_re = re.compile('([a-zA-Z0-9\-]+): (.*)$')
+headers_re = re.compile('^([a-zA-Z0-9\-]+): (.*)$', re.M)
 
 # Note: from Simon Tatham.
 def read_rfc822_headers(f):
     """
-    Read a set of RFC822 headers from the given file.  We return a dict and the
-    set of original lines that were parsed to obtain the contents.
+    Read a set of RFC822 headers from the given DumpReader.  We return a lump
+    and the original headers block that was parsed to obtain the contents, or
+    None and an empty block at the end of the file.
     """
-    ret = Lump()
-
-    lines = []
-    while 1:
-        s = f.readline()
-        if not s:
-            return None, [] # end of file
-
-        # Watch for the newline char that ends the headers.
-        if s == '\n':
-            if len(ret.hdrlist) > 0:
-                break # newline after headers ends them
-            else:
-                continue # newline before headers is simply ignored
-
-        lines.append(s)
-
-        mo = header_re.match(s)
-        if mo is None:
-            raise SystemExit("Error: Parsing header: %s" % s)
-
-        ret.sethdr(*mo.groups())
+    block = f.read_headers()
+    if block is None:
+        return None, "" # end of file
+
+    # Parse the whole block at once, then check that no line was left out.
+    items = headers_re.findall(block)
+    if len(items) != block.count('\n'):
+        for s in block.splitlines():
+            if header_re.match(s) is None:
+                raise SystemExit("Error: Parsing header: %s" % s)
+
+    hdrdict = dict(items)
+    if len(hdrdict) == len(items):
+        hdrkeys = [key for key, val in items]
+    else:
+        hdrkeys = []
+        for key, val in items:
+            if key not in hdrkeys:
+                hdrkeys.append(key)
+    return Lump(hdrdict, hdrkeys), block
 
-    return ret, lines
+def tell(f):
+    """
+    Return the current offset in file 'f', or None if it is not seekable (e.g.
+    a pipe).
+    """
+    try:
+        return f.tell()
+    except IOError:
+        return None
 
 # Note: from Simon Tatham.
 def read_lump(f):
@@ -510,49 +1456,307 @@ def read_lump(f):
     the length of the content length.  Then follows two newline characters and
     then the next lump starts.
     """
-    lump, lines = read_rfc822_headers(f)
+    lump = read_lump_headers(f)
+    if lump is not None:
+        read_lump_body(f, lump)
+    return lump
+
+def read_lump_headers(f):
+    """
+    Read the headers of a single lump from the given file, leaving the file at
+    the start of its properties and text.
+    """
+    lump, block = read_rfc822_headers(f)
     if lump is None:
         return None
+
+    # Keep the original headers, to write the lump verbatim if unmodified.
+    lump.rawhdr = block
+    offset = tell(f)
+    if offset is not None:
+        lump.offset = offset - len(lump.rawhdr) - 1
+    return lump
+
+def read_lump_body(f, lump):
+    """
+    Read the properties and text of 'lump', whose headers were just read.
+    """
     pcl = int(lump.hdrdict.get("Prop-content-length", "-1"))
     tcl = int(lump.hdrdict.get("Text-content-length", "-1"))
     lump.hasprop = pcl >= 0
     if lump.hasprop:
+        # Leave the properties to be parsed when they are used.
         lump.prop = f.read(pcl)
-        lump.propparse()
+        if len(lump.prop) != pcl:
+            raise SystemExit("Error: Unexpected end of file in node "
+                             "properties.")
+        lump._propdict = None
     lump.hastext = tcl >= 0
     if lump.hastext:
-        lump.text = f.read(tcl)
+        if tcl > opts.chunk_size:
+            # Do not load large texts in memory, stream them instead.
+            lump.text = LazyText(f, tcl, opts.chunk_size, tell(f))
+        else:
+            lump.text = f.read(tcl)
+            if len(lump.text) != tcl:
+                raise SystemExit("Error: Unexpected end of file in node "
+                                 "text.")
 
-    lump.orig_text = os.linesep.join(lines) + lump.prop + lump.text
+    lump.hdrdirty = lump.propdirty = lump.textdirty = False
 
-    return lump
+def skip_lump_body(f, lump):
+    """
+    Skip the properties and text of 'lump', whose headers were just read,
+    seeking past them if possible.
+    """
+    d = lump.hdrdict
+    length = (max(int(d.get("Prop-content-length", "0")), 0) +
+              max(int(d.get("Text-content-length", "0")), 0))
+    LazyText(f, length, opts.chunk_size, tell(f)).discard()
 
 
 def write_lump(f, lump):
     """
     Write a single lump to the given file.
     """
+    if isinstance(f, PipelineWriter):
+        # Leave it to the writer thread.
+        f.putlump(lump)
+        return
+
     # Make sure that the lengths are adjusted appropriately.
     lump.correct_headers()
-    for key in lump.hdrlist:
-        val = lump.hdrdict[key]
-        f.write(key + ": " + val + "\n")
-    f.write("\n")
+    hdrdict = lump.hdrdict
+    if lump.hdrdirty:
+        parts = [key + ": " + hdrdict[key] + "\n" for key in lump.hdrkeys()]
+    else:
+        # Pass the original headers through.
+        parts = [lump.rawhdr]
+    parts.append("\n")
+
+    # Render the payload, with newlines at the end of chunks for readers, in
+    # a single write unless the text is streamed.
+    parts.append(lump.prop)
+    if "Revision-number" in hdrdict:
+        trailer = "\n"
+    else:
+        trailer = "\n\n"
+    if isinstance(lump.text, LazyText):
+        f.write("".join(parts))
+        lump.text.copyto(f)
+        f.write(trailer)
+    else:
+        parts.append(lump.text)
+        parts.append(trailer)
+        f.write("".join(parts))
+
+
+class UntangleCache:
+    """
+    An on-disk cache of the revisions dumped from the repository to untangle
+    copies.  Each source revision is dumped with 'svnadmin dump' only once, and
+    all the paths copied from it are then read from that dump.
+
+    Entries are keyed by the repository UUID and the revision number, and since
+    a revision never changes once committed, the cache can be kept and reused
+    across runs, even if the repository is moved.  The least recently used
+    entries are evicted when the cache grows over its size limit.
+
+    This is the default untangle backend of --untangle.  The backends (see
+    open_untangle_backend()) provide fetch() to write out the additions of a
+    copy source, prefetch() and close().
+    """
+    def __init__(self, repos, directory=None, maxsize=1 << 30):
+        self.repos = repos
+        self.maxsize = maxsize
+
+        # Checked first, so that an error leaves no temporary directory.
+        p = Popen(('svnlook', 'uuid', repos), stdout=PIPE)
+        self.uuid = p.communicate()[0].strip()
+        if p.returncode != 0 or not self.uuid:
+            raise SystemExit("Error: Could not get the UUID of repository "
+                             "'%s'." % repos)
+
+        self.temporary = directory is None
+        """True if the cache only lives for this run."""
+        if self.temporary:
+            directory = tempfile.mkdtemp(prefix='svndumpfilter3-')
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        """Map of revisions being fetched in the background to an event that
+        is set when they are done."""
+        self.errors = {}
+        """Map of revisions whose background fetch failed to the error."""
+        self.pinned = {}
+        """Map of prefetched revisions to the number of times they are still
+        going to be used, which protects them from eviction."""
+
+    def filename(self, srcrev):
+        """
+        Return the name of the cache file for revision 'srcrev'.
+        """
+        key = hashlib.sha1('%s@%d' % (self.uuid, srcrev)).hexdigest()
+        return os.path.join(self.directory, key + '.dump')
+
+    def get(self, srcrev, flog):
+        """
+        Return an open file with the dump of revision 'srcrev', fetching it
+        from the repository if it is not in the cache yet.
+        """
+        # Pin the entry until it is open, so that it cannot be evicted.
+        self.lock.acquire()
+        try:
+            event = self.pending.get(srcrev)
+            self.pinned[srcrev] = self.pinned.get(srcrev, 0) + 1
+        finally:
+            self.lock.release()
+        try:
+            if event is not None:
+                event.wait()
+                error = self.errors.pop(srcrev, None)
+                if error is not None:
+                    raise SystemExit(error)
+            return open(self.dump(srcrev, flog), 'rb')
+        finally:
+            # Unpin, once more if this was a prefetched use.
+            self.lock.acquire()
+            try:
+                count = self.pinned[srcrev] - 1
+                if event is not None and count > 0:
+                    count -= 1
+                if count > 0:
+                    self.pinned[srcrev] = count
+                else:
+                    del self.pinned[srcrev]
+            finally:
+                self.lock.release()
+
+    def prefetch(self, srcrevs, jobs, flog):
+        """
+        Start fetching the revisions in the list 'srcrevs' in the background,
+        using 'jobs' worker threads.  Revisions listed more than once stay in
+        the cache until they have been used that many times.
+        """
+        queue = Queue.Queue()
+        self.lock.acquire()
+        try:
+            for srcrev in srcrevs:
+                if srcrev not in self.pinned:
+                    self.pending[srcrev] = threading.Event()
+                    queue.put(srcrev)
+                self.pinned[srcrev] = self.pinned.get(srcrev, 0) + 1
+        finally:
+            self.lock.release()
+
+        def worker():
+            while 1:
+                try:
+                    srcrev = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    try:
+                        self.dump(srcrev, flog)
+                    except SystemExit, e:
+                        self.errors[srcrev] = str(e)
+                    except Exception, e:
+                        self.errors[srcrev] = ("Error: Fetching revision %d: "
+                                               "%s" % (srcrev, e))
+                finally:
+                    self.pending[srcrev].set()
+
+        for i in xrange(min(jobs, queue.qsize())):
+            t = threading.Thread(target=worker)
+            t.setDaemon(True)
+            t.start()
+
+    def fetch(self, srcrev, srcpath, path, fout, flog, format):
+        """
+        Write additions of 'srcpath' at revision 'srcrev' and all the paths
+        below it to 'fout', renaming the root of all the paths to 'path'.
+        'format' is the format of the dump being filtered.
+        """
+        fetch_rev_rename(self, srcrev, srcpath, path, fout, flog, format)
 
-    # Render the payload.
-    f.write(lump.prop)
-    f.write(lump.text)
+    def dump(self, srcrev, flog):
+        """
+        Dump revision 'srcrev' in the cache if it is not there yet, and return
+        the name of its file.
+        """
+        fn = self.filename(srcrev)
+        if os.path.exists(fn):
+            # Mark the entry as recently used.
+            os.utime(fn, None)
+            return fn
+
+        cmd = ('svnadmin', 'dump', '-r', str(srcrev), self.repos)
+        if opts.debug:
+            print >> flog, "Running command: '%s'" % ' '.join(cmd)
+        tmpfn = '%s.%d.tmp' % (fn, os.getpid())
+        fout = open(tmpfn, 'wb')
+        fnull = open(os.devnull, 'w')
+        try:
+            p = Popen(cmd, stdout=fout, stderr=fnull)
+            p.wait()
+        finally:
+            fout.close()
+            fnull.close()
+        if p.returncode != 0:
+            os.remove(tmpfn)
+            raise SystemExit("Error: Running %s" % " ".join(cmd))
+        os.rename(tmpfn, fn)
+
+        self.evict(keep=fn)
+        return fn
+
+    def evict(self, keep):
+        """
+        Remove the least recently used entries until the cache fits in its size
+        limit, never removing the entry 'keep' or those that were prefetched
+        and not used yet.
+        """
+        self.lock.acquire()
+        try:
+            keep = set([keep] + [self.filename(srcrev)
+                                 for srcrev in self.pinned])
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith('.dump'):
+                    continue
+                fn = os.path.join(self.directory, name)
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, fn))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, fn in entries:
+                if total <= self.maxsize:
+                    break
+                if fn not in keep:
+                    os.remove(fn)
+                    total -= size
+        finally:
+            self.lock.release()
 
-    # Add newlines at the end of chunks, for readers.
-    f.write('\n')
-    if not lump.hdrdict.has_key("Revision-number"):
-        f.write('\n')
+    def close(self):
+        """
+        Remove the cache if it only lives for this run.
+        """
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
 
 
-def fetch_rev_rename(repos, srcrev, srcpath, path, fout, flog, format):
+def fetch_rev_rename(cache, srcrev, srcpath, path, fout, flog, format):
     """
-    Dumps 'srcpath' at revision 'srcrev' from repository 'repos',
-    renaming the root of all the paths in it to 'path', and
+    Dumps 'srcpath' at revision 'srcrev' from the repository of untangle cache
+    'cache', renaming the root of all the paths in it to 'path', and
     outputting the lumps in 'fout' (without the header and revision
     lump).
     """
@@ -560,16 +1764,7 @@ def fetch_rev_rename(repos, srcrev, srcpath, path, fout, flog, format):
 
     # Must find the source node, as it existed in the given revision, and copy
     # it in full.
-    cmd = ('svnadmin', 'dump', '-r', str(srcrev), opts.repos)
-    cmd_filter = ('svndumpfilter', 'include', srcpath)
-    if opts.debug:
-        print >> flog, ("Running command: '%s | %s'" %
-                        (' '.join(cmd), ' '.join(cmd_filter)))
-    fnull = open(os.devnull, 'w')
-    p1 = Popen(cmd, stdout=PIPE, stderr=fnull)
-    p2 = Popen(cmd_filter, stdin=p1.stdout,
-               stdout=PIPE, stderr=fnull)
-    fs = p2.stdout
+    fs = DumpReader(cache.get(srcrev, flog))
 
     #
     # Process the subdump.
@@ -588,20 +1783,26 @@ def fetch_rev_rename(repos, srcrev, srcpath, path, fout, flog, format):
     # Read and drpo the revision.
     lump_sub = read_lump(fs)
     assert lump_sub is not None
-    assert lump_sub.hdrdict.has_key('Revision-number')
+    assert 'Revision-number' in lump_sub.hdrdict
 
     while 1:
+        # Skip whatever was not written out of the previous lump's text.
+        lump_sub.discard()
+
         # Read one lump at a time
         lump_sub = read_lump(fs)
         if lump_sub is None:
             break # At EOF
 
         # Make sure all the rest are file/dir lumps.
-        assert not lump_sub.hdrdict.has_key('Revision-number')
+        assert 'Revision-number' not in lump_sub.hdrdict
 
-        # Translate filename to its new location.
+        # Only keep the source node and what is below it.
         path_sub = lump_sub.hdrdict['Node-path']
-        assert path_sub.startswith(srcpath)
+        if path_sub != srcpath and not path_sub.startswith(srcpath + '/'):
+            continue
+
+        # Translate filename to its new location.
         path_sub_new = path + path_sub[len(srcpath):]
         lump_sub.sethdr('Node-path', path_sub_new)
         print >> flog, ("%s:    Converted  '%s' to '%s'" %
@@ -617,59 +1818,1784 @@ def fetch_rev_rename(repos, srcrev, srcpath, path, fout, flog, format):
 
         write_lump(fout, lump_sub)
 
-    p2.wait()
-    if p2.returncode != 0:
-        raise SystemExit("Error: Running %s" % " ".join(cmd))
+    fs.close()
 
 
-def parse_options():
+def untangled_lump(srcrev, srcpath, path, path_sub, kind, props, text,
+                   textkey, flog):
     """
-    Parse and validate the options.
+    Return the addition of 'path_sub', 'srcpath' or a path below it as it was
+    in revision 'srcrev', with the root of the paths renamed to 'path'.  The
+    node has the properties block 'props' (None if empty) and, if it is a
+    file, the text 'text' whose MD5 checksum is 'textkey'.
     """
-    global progname
-    progname = basename(sys.argv[0])
-
-    import optparse
-    parser = optparse.OptionParser(__doc__.strip())
+    lump = Lump()
+    path_sub_new = path + path_sub[len(srcpath):]
+    lump.sethdr('Node-path', path_sub_new)
+    lump.sethdr('Node-kind', kind)
+    lump.sethdr('Node-action', 'add')
+    print >> flog, ("%s:    Converted  '%s' to '%s'" %
+                    (progname, path_sub, path_sub_new))
+
+    lump.prop = props or "PROPS-END\n"
+    lump.hasprop = True
+    lump.propparse()
+    lump.sethdr('Prop-content-length', str(len(lump.prop)))
+
+    lump.hastext = kind == 'file'
+    if lump.hastext:
+        lump.text = text
+        lump.sethdr('Text-content-length', str(len(lump.text)))
+        lump.sethdr('Text-content-md5', textkey)
 
-    # Original svndumpfilter options.
-    #
-    # FIXME: we still need to implement these 3 options.
-    #
-    # FIXME: we could convert this script to use subcommands and add the same
-    # subcommand options that are present in svndumpfilter.
-    parser.add_option('--drop-empty-revs', action='store_true',
-                      help="Remove revisions emptied by filtering.")
-    parser.add_option('--renumber-revs', action='store_true',
-                      help="Renumber revisions left after filtering.")
-    parser.add_option('--preserve-revprops', action='store_true',
-                      help="Don't filter revision properties.")
+    if path_sub_new == path:
+        print >> flog, ("%s:    Marked '%s' as untangled." %
+                        (progname, path))
 
+        lines = ("Node-copyfrom-path: %s" % srcpath,
+                 "Node-copyfrom-rev: %d" % srcrev)
+        lump.setprop('svn:untangled', "\n".join(lines))
+    return lump
 
-    parser.add_option('--quiet', action='store_true',
-                      help="Do not display filtering statistics.")
 
-    parser.add_option('-e', '--exclude', action='store_true',
-                      help="The given paths are to be excluded rather than "
-                      "included (the default is to include).")
+def imap_threaded(func, items, jobs):
+    """
+    Generate the results of 'func' on each of the list 'items', in order,
+    computed by 'jobs' worker threads.  The workers never get more than
+    2 * 'jobs' items ahead of the consumer, so that the results waiting to be
+    consumed stay bounded.
+    """
+    tasks = Queue.Queue()
+    results = {}
+    cond = threading.Condition()
 
-    parser.add_option('-p', '--prune-properties', action='store_true',
-                      help="Prune empty properties if empty. This makes the "
-                           "dump file smaller, but does not match latest "
-                           "version of svnadmin dump, so don't use if e.g. "
-                           "you want to diff the input and output dump.")
+    def worker():
+        while 1:
+            task = tasks.get()
+            if task is None:
+                return
+            i, item = task
+            try:
+                result = True, func(item)
+            except SystemExit, e:
+                result = False, str(e)
+            except Exception, e:
+                result = False, "Error: %s" % e
+            cond.acquire()
+            try:
+                results[i] = result
+                cond.notifyAll()
+            finally:
+                cond.release()
+
+    threads = []
+    for j in xrange(min(jobs, len(items))):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    try:
+        queued = 0
+        for i in xrange(len(items)):
+            while queued < len(items) and queued < i + 2 * jobs:
+                tasks.put((queued, items[queued]))
+                queued += 1
+            cond.acquire()
+            try:
+                while i not in results:
+                    cond.wait()
+                ok, result = results.pop(i)
+            finally:
+                cond.release()
+            if not ok:
+                raise SystemExit(result)
+            yield result
+    finally:
+        for t in threads:
+            tasks.put(None)
+
+
+class SvnlookBackend:
+    """
+    An untangle backend that reads the copy sources from the repository with
+    'svnlook', rather than dumping their whole revision: the copied subtree is
+    listed with 'svnlook tree', then the properties and texts of its nodes are
+    read with 'svnlook proplist' and 'svnlook cat', by a bounded pool of
+    threads.  Copying a small directory out of a large revision then costs
+    time in proportion to the directory.
+    """
+    directory = None
+    """The backend keeps no cache."""
 
-    parser.add_option('-u', '--untangle', action='store', dest='repos',
-                      metavar='REPOS_PATH',
-                      help="If True, convert move/copy from filtered paths "
-                      "to additions.  You need to specify the repository to "
-                      "fetch the missing files from.")
+    def __init__(self, repos, jobs=4):
+        self.repos = repos
+        self.jobs = jobs
 
-    parser.add_option('-n', '--no-filter', action='store_true',
-                      help="Do not actually apply filters, but just "
-                      "perform the requested conversions.  This can be used "
-                      "as a test by running the output into svndumpfilter, "
-                      "which should now succeed.")
+        p = Popen(('svnlook', 'uuid', repos), stdout=PIPE)
+        self.uuid = p.communicate()[0].strip()
+        if p.returncode != 0 or not self.uuid:
+            raise SystemExit("Error: Could not get the UUID of repository "
+                             "'%s'." % repos)
+
+    def command(self, subcommand, srcrev, path, options=()):
+        """
+        Return the command line of 'svnlook' for 'path' in revision 'srcrev'.
+        """
+        return (('svnlook', subcommand) + tuple(options) +
+                ('-r', str(srcrev), self.repos, path))
+
+    def run(self, cmd, stdout):
+        """
+        Run command 'cmd' with its output to 'stdout', and return the process.
+        The descriptors of the other threads' pipes are not inherited, so that
+        their commands see the end of their input in time.
+        """
+        if opts.debug:
+            print >> sys.stderr, "Running command: '%s'" % ' '.join(cmd)
+        fnull = open(os.devnull, 'w')
+        try:
+            return Popen(cmd, stdout=stdout, stderr=fnull, close_fds=True)
+        finally:
+            fnull.close()
+
+    def output(self, cmd):
+        """
+        Return the output of command 'cmd'.
+        """
+        p = self.run(cmd, PIPE)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise SystemExit("Error: Running %s" % " ".join(cmd))
+        return output
+
+    def tree(self, srcrev, srcpath):
+        """
+        Return the list of (path, kind) of 'srcpath' and all the paths below it
+        in revision 'srcrev', parents first.
+        """
+        cmd = self.command('tree', srcrev, srcpath, ['--full-paths'])
+        p = self.run(cmd, PIPE)
+        output = p.communicate()[0]
+        if p.returncode != 0:
+            raise SystemExit("Error: Copy source '%s' in revision %d was not "
+                             "found in the repository." % (srcpath, srcrev))
+        rows = []
+        for line in output.splitlines():
+            if line.endswith('/'):
+                rows.append((line.strip('/'), 'dir'))
+            else:
+                rows.append((line.lstrip('/'), 'file'))
+        return rows
+
+    def proplist(self, srcrev, path):
+        """
+        Return the properties block of 'path' in revision 'srcrev'.
+        """
+        try:
+            from xml.etree import ElementTree
+        except ImportError:
+            raise SystemExit("Error: The svnlook untangle backend needs the "
+                             "xml.etree module.")
+        output = self.output(self.command('proplist', srcrev, path,
+                                          ['--verbose', '--xml']))
+        parts = []
+        for prop in ElementTree.fromstring(output).findall('target/property'):
+            key = prop.get('name').encode('utf-8')
+            val = prop.text or ""
+            if prop.get('encoding') == 'base64':
+                import base64
+                val = base64.b64decode(val)
+            else:
+                val = val.encode('utf-8')
+            parts.append("K %d\n%s\nV %d\n%s\n" %
+                         (len(key), key, len(val), val))
+        parts.append("PROPS-END\n")
+        return "".join(parts)
+
+    def cat(self, srcrev, path):
+        """
+        Return the text of file 'path' in revision 'srcrev', spooled to a
+        temporary file, and its MD5 checksum.
+        """
+        cmd = self.command('cat', srcrev, path)
+        f = tempfile.TemporaryFile()
+        m = hashlib.new('md5')
+        p = self.run(cmd, PIPE)
+        while 1:
+            data = p.stdout.read(opts.chunk_size)
+            if not data:
+                break
+            m.update(data)
+            f.write(data)
+        p.wait()
+        if p.returncode != 0:
+            f.close()
+            raise SystemExit("Error: Running %s" % " ".join(cmd))
+        length = f.tell()
+        f.seek(0)
+        return LazyText(f, length, opts.chunk_size, 0), m.hexdigest()
+
+    def lookup(self, node):
+        """
+        Return the (props, text, textkey) of 'node', a (srcrev, path, kind)
+        tuple, 'text' and 'textkey' being None for a directory.
+        """
+        srcrev, path, kind = node
+        props = self.proplist(srcrev, path)
+        text = textkey = None
+        if kind == 'file':
+            text, textkey = self.cat(srcrev, path)
+        return props, text, textkey
+
+    def fetch(self, srcrev, srcpath, path, fout, flog, format):
+        """
+        Write additions of 'srcpath' at revision 'srcrev' and all the paths
+        below it to 'fout', renaming the root of all the paths to 'path'.
+        """
+        nodes = [(srcrev, path_sub, kind)
+                 for path_sub, kind in self.tree(srcrev, srcpath)]
+        results = imap_threaded(self.lookup, nodes, self.jobs)
+        for srcrev, path_sub, kind in nodes:
+            props, text, textkey = results.next()
+            write_lump(fout, untangled_lump(srcrev, srcpath, path, path_sub,
+                                            kind, props, text, textkey, flog))
+
+    def prefetch(self, srcrevs, jobs, flog):
+        """
+        Nothing is fetched ahead, the lookups are made when untangling.
+        """
+
+    def close(self):
+        """
+        Nothing is left behind by the backend.
+        """
+
+
+def open_untangle_backend(directory):
+    """
+    Return the untangle backend of --untangle selected by --untangle-backend,
+    keeping its cache, if it has one, in 'directory' (None for a temporary
+    one).
+    """
+    if opts.untangle_backend == 'svnlook':
+        return SvnlookBackend(opts.repos, opts.untangle_jobs)
+    return UntangleCache(opts.repos, directory, opts.untangle_cache_size)
+
+
+def svndiff_int(data, pos):
+    """
+    Decode the variable-length integer of svndiff at 'pos' in 'data'.  Return
+    it with the position past it, or None if 'data' ends before it does.
+    """
+    n = 0
+    end = len(data)
+    while pos < end:
+        c = ord(data[pos])
+        pos += 1
+        n = (n << 7) | (c & 0x7f)
+        if not c & 0x80:
+            return n, pos
+    return None
+
+def svndiff_field(data, pos):
+    """
+    Like svndiff_int(), for data that must hold the integer.
+    """
+    decoded = svndiff_int(data, pos)
+    if decoded is None:
+        raise SystemExit("Error: Truncated svndiff data.")
+    return decoded
+
+def svndiff_windows(chunks):
+    """
+    Generate the windows of the svndiff delta in the strings generated by
+    'chunks', as (version, source view offset, source view length, target
+    view length, instructions, new data) tuples.  Only one window is held in
+    memory at a time.
+    """
+    buf = ""
+    pos = 0
+    version = None
+    chunks = iter(chunks)
+    while 1:
+        if version is None:
+            if len(buf) >= 4:
+                if buf[:3] != "SVN" or buf[3] not in "\0\1\2":
+                    raise SystemExit("Error: Invalid svndiff header.")
+                version = ord(buf[3])
+                if version == 2:
+                    raise SystemExit("Error: svndiff2 (LZ4) deltas are not "
+                                     "supported.")
+                pos = 4
+                continue
+        else:
+            fields = []
+            end = pos
+            while len(fields) < 5:
+                decoded = svndiff_int(buf, end)
+                if decoded is None:
+                    break
+                n, end = decoded
+                fields.append(n)
+            if len(fields) == 5 and len(buf) >= end + fields[3] + fields[4]:
+                sview_offset, sview_len, tview_len, ins_len, new_len = fields
+                instructions = buf[end:end+ins_len]
+                newdata = buf[end+ins_len:end+ins_len+new_len]
+                pos = end + ins_len + new_len
+                yield (version, sview_offset, sview_len, tview_len,
+                       instructions, newdata)
+                continue
+
+        try:
+            data = chunks.next()
+        except StopIteration:
+            break
+        buf = buf[pos:] + data
+        pos = 0
+    if version is None or pos < len(buf):
+        raise SystemExit("Error: Truncated svndiff data.")
+
+def svndiff_section(data, version):
+    """
+    Return the instructions or new data section 'data' of a window, which are
+    zlib-compressed in svndiff1 unless that did not make them smaller.
+    """
+    if version == 0:
+        return data
+    length, pos = svndiff_field(data, 0)
+    if len(data) - pos == length:
+        return data[pos:]
+    import zlib
+    try:
+        data = zlib.decompress(data[pos:])
+    except zlib.error, e:
+        raise SystemExit("Error: Corrupt svndiff data: %s" % e)
+    if len(data) != length:
+        raise SystemExit("Error: Corrupt svndiff data.")
+    return data
+
+def svndiff_apply(chunks, source, write):
+    """
+    Apply the svndiff0 or svndiff1 delta in the strings generated by 'chunks'
+    to the text in seekable file 'source' (None for an empty text), writing
+    the target text with 'write', one window at a time.
+    """
+    for (version, sview_offset, sview_len, tview_len,
+         instructions, newdata) in svndiff_windows(chunks):
+        instructions = svndiff_section(instructions, version)
+        newdata = svndiff_section(newdata, version)
+        sview = ""
+        if sview_len > 0:
+            if source is None:
+                raise SystemExit("Error: svndiff delta against a missing "
+                                 "source.")
+            source.seek(sview_offset)
+            sview = source.read(sview_len)
+
+        # Instructions copy from the source view, from the target view built
+        # so far, or from the new data.
+        parts = []
+        pos = 0
+        newpos = 0
+        while pos < len(instructions):
+            c = ord(instructions[pos])
+            pos += 1
+            op = c >> 6
+            length = c & 0x3f
+            if length == 0:
+                length, pos = svndiff_field(instructions, pos)
+            if op == 0:
+                offset, pos = svndiff_field(instructions, pos)
+                parts.append(sview[offset:offset+length])
+            elif op == 1:
+                offset, pos = svndiff_field(instructions, pos)
+                target = "".join(parts)
+                parts = [target]
+                if offset >= len(target):
+                    raise SystemExit("Error: Corrupt svndiff data.")
+                # The copy may overlap what it produces, repeating a pattern.
+                pattern = target[offset:offset+length]
+                if len(pattern) < length:
+                    pattern *= length // len(pattern) + 1
+                parts.append(pattern[:length])
+            elif op == 2:
+                parts.append(newdata[newpos:newpos+length])
+                newpos += length
+            else:
+                raise SystemExit("Error: Invalid svndiff instruction.")
+
+        target = "".join(parts)
+        if len(target) != tview_len:
+            raise SystemExit("Error: Corrupt svndiff data.")
+        write(target)
+
+
+class NodeStore:
+    """
+    An on-disk store of the nodes read from the input dump, used to untangle
+    copies without access to the original repository.
+
+    The history of every path is kept in an SQLite database, as one row per
+    revision in which the path changed, with its kind, properties and a key to
+    its text.  Texts are stored in files named after their MD5 checksum, so
+    that identical texts are stored only once, and the deltas of the dumps
+    made with --deltas are expanded against them to full texts.  Copies from
+    excluded paths are then synthesized as additions of the source subtree, as
+    it was in the copy source revision.
+
+    If the copies to untangle are known in advance (see plan_untangle()), only
+    the paths they depend on are recorded, versions of a path that no planned
+    copy can see are evicted as soon as they are superseded, and the store is
+    released after the last planned copy.
+    """
+    def __init__(self, directory=None):
+        try:
+            import sqlite3
+        except ImportError:
+            raise SystemExit("Error: Untangling from the dump needs the "
+                             "sqlite3 module.")
+
+        self.temporary = directory is None
+        """True if the store only lives for this run."""
+        if self.temporary:
+            directory = tempfile.mkdtemp(prefix='svndumpfilter3-')
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+        self.db = sqlite3.connect(os.path.join(directory, 'nodes.db'))
+        self.db.text_factory = str
+        if self.temporary:
+            self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS nodes "
+                        "(path TEXT, rev INTEGER, kind TEXT, textkey TEXT, "
+                        " props TEXT, PRIMARY KEY (path, rev))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS texts "
+                        "(textkey TEXT PRIMARY KEY, refs INTEGER)")
+
+        self.revs = None
+        """Sorted list of the planned copy source revisions, or None if
+        unknown (in which case nothing is ever evicted)."""
+
+        self.needed = None
+        """Set of the paths whose history the planned copies depend on."""
+
+        self.ancestors = None
+        """Set of the ancestors of the paths in 'needed'."""
+
+        self.remaining = None
+        """Number of planned copies that have not been untangled yet."""
+
+        self.modified = set()
+        """Keys of the texts that --filter-contents modified, the deltas
+        against which are expanded (see filter_contents())."""
+
+    def setplan(self, plan, copies):
+        """
+        Restrict the store to what the copies to untangle, in the list of
+        (srcrev, srcpath, dstpath) tuples 'plan', can depend on.  'copies' is
+        the list of all the copies in the dump, in the same format.
+        """
+        self.remaining = len(plan)
+
+        # Follow the copies back from the sources to untangle, to find all the
+        # paths that they may have been copied from themselves, and the
+        # revisions in which these are read.
+        revs = set(srcrev for srcrev, srcpath, dstpath in plan)
+        needed = set(srcpath for srcrev, srcpath, dstpath in plan)
+        changed = True
+        while changed:
+            changed = False
+            for srcrev, srcpath, dstpath in copies:
+                for path in list(needed):
+                    if path == dstpath or path.startswith(dstpath + '/'):
+                        new = srcpath + path[len(dstpath):]
+                    elif dstpath.startswith(path + '/'):
+                        new = srcpath
+                    else:
+                        continue
+                    revs.add(srcrev)
+                    if new not in needed:
+                        needed.add(new)
+                        changed = True
+        self.revs = sorted(revs)
+        self.needed = needed
+        self.ancestors = set()
+        for path in needed:
+            comps = splitpath(path)
+            for i in xrange(len(comps)):
+                self.ancestors.add(joinpath(comps[:i]))
+
+    def wanted(self, path):
+        """
+        Return true if the history of 'path' may be needed.
+        """
+        if self.needed is None:
+            return True
+        if path in self.ancestors:
+            return True
+        comps = splitpath(path)
+        for i in xrange(len(comps), 0, -1):
+            if joinpath(comps[:i]) in self.needed:
+                return True
+        return False
+
+    def textfile(self, textkey):
+        """
+        Return the name of the file that holds the text with key 'textkey'.
+        """
+        return os.path.join(self.directory, 'texts', textkey[:2], textkey)
+
+    def record(self, lump, rev):
+        """
+        Record node 'lump' of revision 'rev'.  If the text of the lump is
+        streamed, it is replaced by a stream from the store.
+        """
+        if self.remaining == 0:
+            return # All the planned copies were untangled.
+
+        d = lump.hdrdict
+        path = d['Node-path']
+        action = d['Node-action']
+        if action in ('delete', 'replace'):
+            for row in self.tree(path):
+                self.put(row[0], rev, None, None, None)
+            if action == 'delete':
+                return
+        if not self.wanted(path):
+            return
+
+        if 'Node-copyfrom-path' in d:
+            srcpath = d['Node-copyfrom-path']
+            srcrev = int(d['Node-copyfrom-rev'])
+            for p, kind, textkey, props in self.tree(srcpath, srcrev):
+                self.put(path + p[len(srcpath):], rev, kind, textkey, props)
+
+        row = self.db.execute("SELECT kind, textkey, props FROM nodes "
+                              "WHERE path = ? AND rev <= ? "
+                              "ORDER BY rev DESC LIMIT 1",
+                              (path, rev)).fetchone()
+        if row is None or row[0] is None:
+            kind, textkey, props = None, None, None
+        else:
+            kind, textkey, props = row
+        kind = d.get('Node-kind', kind)
+        if lump.hasprop:
+            if d.get('Prop-delta') == 'true':
+                props = self.mergeprops(props, lump)
+            else:
+                props = lump.prop
+        if lump.hastext:
+            if d.get('Text-delta') == 'true':
+                textkey = self.storedelta(lump, textkey)
+            else:
+                textkey = self.storetext(lump)
+        self.put(path, rev, kind, textkey, props)
+
+    def mergeprops(self, props, lump):
+        """
+        Return the properties block 'props' (None if empty) with the changes
+        of the property delta of 'lump' applied.
+        """
+        base = Lump()
+        base.prop = props or "PROPS-END\n"
+        base.hasprop = True
+        base.propparse()
+        for key in lump.propkeys():
+            val = lump.propdict[key]
+            if val is None:
+                base.delprop(key)
+            else:
+                base.setprop(key, val)
+        base.correct_headers()
+        return base.prop
+
+    def storetext(self, lump):
+        """
+        Store the text of 'lump' if it is not stored yet, and return its key.
+        """
+        textkey = lump.hdrdict.get('Text-content-md5')
+        if isinstance(lump.text, str):
+            if textkey is None:
+                textkey = hashlib.new('md5', lump.text).hexdigest()
+            fn = self.textfile(textkey)
+            if not os.path.exists(fn):
+                self.writetext(fn, [lump.text])
+            return textkey
+
+        if textkey is None or not os.path.exists(self.textfile(textkey)):
+            tmpfn = os.path.join(self.directory, 'text.tmp')
+            m = hashlib.new('md5')
+            fout = open(tmpfn, 'wb')
+            try:
+                for data in lump.text.chunks():
+                    m.update(data)
+                    fout.write(data)
+            finally:
+                fout.close()
+            textkey = m.hexdigest()
+            fn = self.textfile(textkey)
+            if not os.path.isdir(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            os.rename(tmpfn, fn)
+        else:
+            lump.text.discard()
+
+        # The input text may have been consumed, read it from the store.
+        fn = self.textfile(textkey)
+        lump.text = LazyText(open(fn, 'rb'), len(lump.text),
+                             lump.text.chunksize, 0)
+        return textkey
+
+    def storedelta(self, lump, prevkey):
+        """
+        Store the text that the delta of 'lump' expands to if it is not stored
+        yet, and return its key.  The delta is against the text whose key is
+        in Text-delta-base-md5, else 'prevkey' (that of the previous text of
+        the path, None if there is none).  The delta is left in the lump, to
+        be passed through.
+        """
+        d = lump.hdrdict
+        textkey = d.get('Text-content-md5')
+        if textkey is not None and os.path.exists(self.textfile(textkey)):
+            return textkey
+
+        source = None
+        basekey = d.get('Text-delta-base-md5', prevkey)
+        if basekey == hashlib.new('md5', "").hexdigest():
+            basekey = None
+        if basekey is not None:
+            fn = self.textfile(basekey)
+            if not os.path.exists(fn):
+                raise SystemExit("Error: The base of the delta of '%s' was "
+                                 "not found in the dump." % d['Node-path'])
+            source = open(fn, 'rb')
+
+        # Make sure that the delta can still be written out once expanded.
+        lump.spooltext()
+        if isinstance(lump.text, LazyText):
+            chunks = lump.text.chunks()
+        else:
+            chunks = [lump.text]
+        tmpfn = os.path.join(self.directory, 'text.tmp')
+        m = hashlib.new('md5')
+        fout = open(tmpfn, 'wb')
+        def write(data):
+            m.update(data)
+            fout.write(data)
+        try:
+            svndiff_apply(chunks, source, write)
+        finally:
+            fout.close()
+            if source is not None:
+                source.close()
+        if textkey is not None and m.hexdigest() != textkey:
+            raise SystemExit("Error: The delta of '%s' does not expand to "
+                             "its checksum." % d['Node-path'])
+        textkey = m.hexdigest()
+        fn = self.textfile(textkey)
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        os.rename(tmpfn, fn)
+        return textkey
+
+    def fulltext(self, lump):
+        """
+        Return the text that the delta of recorded node 'lump' expands to, as a
+        LazyText, or None if it is not stored.
+        """
+        textkey = lump.hdrdict.get('Text-content-md5')
+        if textkey is None or not os.path.exists(self.textfile(textkey)):
+            return None
+        fn = self.textfile(textkey)
+        return LazyText(open(fn, 'rb'), os.path.getsize(fn),
+                        opts.chunk_size, 0)
+
+    def writetext(self, fn, chunks):
+        """
+        Write text file 'fn' from the strings in 'chunks'.
+        """
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        tmpfn = os.path.join(self.directory, 'text.tmp')
+        fout = open(tmpfn, 'wb')
+        try:
+            for data in chunks:
+                fout.write(data)
+        finally:
+            fout.close()
+        os.rename(tmpfn, fn)
+
+    def put(self, path, rev, kind, textkey, props):
+        """
+        Record the state of 'path' in revision 'rev' ('kind' is None if it was
+        deleted), evicting the previous state if no planned copy can see it.
+        """
+        # Reference the new text first, it may be the one of the evicted state.
+        if textkey is not None:
+            self.db.execute("INSERT OR IGNORE INTO texts VALUES (?, 0)",
+                            (textkey,))
+            self.db.execute("UPDATE texts SET refs = refs + 1 "
+                            "WHERE textkey = ?", (textkey,))
+
+        row = self.db.execute("SELECT rev, textkey FROM nodes "
+                              "WHERE path = ? AND rev <= ? "
+                              "ORDER BY rev DESC LIMIT 1",
+                              (path, rev)).fetchone()
+        if row is not None:
+            prevrev, prevkey = row
+            if prevrev == rev or self.unreachable(prevrev, rev):
+                self.db.execute("DELETE FROM nodes WHERE path = ? AND rev = ?",
+                                (path, prevrev))
+                self.unref(prevkey)
+
+        self.db.execute("INSERT INTO nodes VALUES (?, ?, ?, ?, ?)",
+                        (path, rev, kind, textkey, props))
+
+    def unreachable(self, prevrev, rev):
+        """
+        Return true if no planned copy source revision lies in the range
+        [prevrev, rev).
+        """
+        if self.revs is None:
+            return False
+        i = bisect.bisect_left(self.revs, prevrev)
+        return i == len(self.revs) or self.revs[i] >= rev
+
+    def unref(self, textkey):
+        """
+        Drop a reference to text 'textkey', removing it when unused.
+        """
+        if textkey is None:
+            return
+        self.db.execute("UPDATE texts SET refs = refs - 1 WHERE textkey = ?",
+                        (textkey,))
+        row = self.db.execute("SELECT refs FROM texts WHERE textkey = ?",
+                              (textkey,)).fetchone()
+        if row is not None and row[0] <= 0:
+            self.db.execute("DELETE FROM texts WHERE textkey = ?", (textkey,))
+            try:
+                os.remove(self.textfile(textkey))
+            except OSError:
+                pass
+
+    def tree(self, path, rev=None):
+        """
+        Return a list of (path, kind, textkey, props) for 'path' and all the
+        paths below it that exist in revision 'rev' (the latest revision if
+        None), sorted by path.
+        """
+        if rev is None:
+            rev = sys.maxint
+        return self.db.execute(
+            "SELECT path, kind, textkey, props FROM nodes AS n "
+            "WHERE (path = ? OR (path > ? AND path < ?)) "
+            "AND rev = (SELECT MAX(rev) FROM nodes "
+            "           WHERE path = n.path AND rev <= ?) "
+            "AND kind IS NOT NULL ORDER BY path",
+            (path, path + '/', path + '0', rev)).fetchall()
+
+    def commit(self):
+        """
+        Commit what was recorded so far to disk.
+        """
+        self.db.commit()
+
+    def fetch(self, srcrev, srcpath, path, fout, flog):
+        """
+        Write additions of 'srcpath' at revision 'srcrev' and all the paths
+        below it to 'fout', renaming the root of all the paths to 'path'.
+        """
+        rows = self.tree(srcpath, srcrev)
+        if not rows:
+            raise SystemExit("Error: Copy source '%s' in revision %d was not "
+                             "found in the dump." % (srcpath, srcrev))
+        for path_sub, kind, textkey, props in rows:
+            text = None
+            if kind == 'file':
+                if textkey is None:
+                    text = ""
+                    textkey = hashlib.new('md5', "").hexdigest()
+                else:
+                    fn = self.textfile(textkey)
+                    text = LazyText(open(fn, 'rb'), os.path.getsize(fn),
+                                    opts.chunk_size, 0)
+            write_lump(fout, untangled_lump(srcrev, srcpath, path, path_sub,
+                                            kind, props, text, textkey, flog))
+
+        if self.remaining is not None:
+            self.remaining -= 1
+            if self.remaining == 0:
+                # Nothing will be needed from the store anymore.
+                self.db.execute("DELETE FROM nodes")
+                self.db.execute("DELETE FROM texts")
+                shutil.rmtree(os.path.join(self.directory, 'texts'),
+                              ignore_errors=True)
+
+    def close(self):
+        """
+        Close the store, and remove it if it only lives for this run.
+        """
+        self.db.commit()
+        self.db.close()
+        if self.temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def skipped_revision(rev):
+    """
+    Return true if revision 'rev' is not to be written out.
+    """
+    return (rev < opts.rev_start or
+            (opts.rev_end is not None and rev > opts.rev_end) or
+            rev in opts.skip_rev)
+
+
+def scan_headers(f):
+    """
+    Generate the lumps of the dump in seekable file 'f', from its current
+    position, as (lump, offset, bodyoffset) tuples.  Only the headers of the
+    lumps are read, their contents are seeked past.  'offset' and 'bodyoffset'
+    are the offsets of the headers and of the contents in the file.
+    """
+    while 1:
+        lump, block = read_rfc822_headers(f)
+        if lump is None:
+            break # At EOF
+        d = lump.hdrdict
+        pos = f.tell()
+
+        # Seek past the properties and text.
+        length = (max(int(d.get("Prop-content-length", "0")), 0) +
+                  max(int(d.get("Text-content-length", "0")), 0))
+        f.seek(length, 1)
+
+        yield lump, pos - len(block) - 1, pos
+
+
+class DumpIndex:
+    """
+    An index of the lumps of a dump file, kept in a side file so that later
+    runs on the same dump do not have to scan it again.  It records the offset
+    of every revision, and the offsets of the headers and contents, the path,
+    action, kind and copy source of every node.
+
+    The index is a text file, with a header line, a line describing the dump
+    file it belongs to (to detect when it is out of date), and then one
+    tab-separated line per lump, in the order of the dump::
+
+      R <rev> <offset>
+      N <offset> <bodyoffset> <proplen> <textlen> <action> <kind> <srcrev> <path> <srcpath>
+
+    Missing values are written as '-'.
+    """
+    magic = 'SVNDUMPFILTER3-INDEX 1'
+
+    def __init__(self, filename, dumpfilename):
+        self.filename = filename
+        self.dumpfilename = dumpfilename
+
+        self.revisions = []
+        """List of (rev, offset) of the revisions, in the order of the dump."""
+
+    def stamp(self):
+        """
+        Return the line that identifies the version of the dump file.
+        """
+        st = os.stat(self.dumpfilename)
+        return 'D\t%d\t%d' % (st.st_size, int(st.st_mtime))
+
+    def load(self):
+        """
+        Load the revisions from the index file.  Return false if the index
+        does not exist or is out of date.
+        """
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return False
+        try:
+            if (f.readline().rstrip('\n') != self.magic or
+                f.readline().rstrip('\n') != self.stamp()):
+                return False
+            self.revisions = [(int(rev), int(offset))
+                              for tag, rev, offset in
+                              (line.rstrip('\n').split('\t')
+                               for line in f if line.startswith('R\t'))]
+        finally:
+            f.close()
+        return True
+
+    def build(self, f):
+        """
+        Build the index of the dump in seekable file 'f', reading only its
+        headers, and write it out.  The file is rewound.
+        """
+        start = f.tell()
+        f.seek(0)
+        read_dump_header(f)
+
+        self.revisions = []
+        tmpfn = '%s.%d.tmp' % (self.filename, os.getpid())
+        fout = open(tmpfn, 'wb')
+        try:
+            fout.write(self.magic + '\n')
+            fout.write(self.stamp() + '\n')
+            for lump, offset, bodyoffset in scan_headers(f):
+                d = lump.hdrdict
+                if 'Revision-number' in d:
+                    rev = int(d['Revision-number'])
+                    self.revisions.append((rev, offset))
+                    fout.write('R\t%d\t%d\n' % (rev, offset))
+                else:
+                    fields = (offset, bodyoffset,
+                              d.get('Prop-content-length', '-'),
+                              d.get('Text-content-length', '-'),
+                              d['Node-action'],
+                              d.get('Node-kind', '-'),
+                              d.get('Node-copyfrom-rev', '-'),
+                              d['Node-path'],
+                              d.get('Node-copyfrom-path', '-'))
+                    fout.write('N\t%s\n' % '\t'.join(map(str, fields)))
+        finally:
+            fout.close()
+        os.rename(tmpfn, self.filename)
+        f.seek(start)
+
+    def headers(self):
+        """
+        Generate the lumps of the dump as (hdrdict, offset) tuples, where
+        'hdrdict' holds the headers recorded in the index.
+        """
+        f = open(self.filename, 'rb')
+        try:
+            f.readline()
+            f.readline()
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'R':
+                    yield {'Revision-number': fields[1]}, int(fields[2])
+                    continue
+                d = {'Node-path': fields[8], 'Node-action': fields[5]}
+                for key, value in (('Prop-content-length', fields[3]),
+                                   ('Text-content-length', fields[4]),
+                                   ('Node-kind', fields[6]),
+                                   ('Node-copyfrom-rev', fields[7]),
+                                   ('Node-copyfrom-path', fields[9])):
+                    if value != '-':
+                        d[key] = value
+                yield d, int(fields[1])
+        finally:
+            f.close()
+
+    def revision_offset(self, rev):
+        """
+        Return the offset of the first revision numbered 'rev' or above, or
+        None if there is none.
+        """
+        i = bisect.bisect_left(self.revisions, (rev, -1))
+        if i == len(self.revisions):
+            return None
+        return self.revisions[i][1]
+
+
+def open_index(filename, f, dumpfilename, flog):
+    """
+    Return the index 'filename' of the dump in seekable file 'f', whose name is
+    'dumpfilename', building it if it is missing or out of date.
+    """
+    index = DumpIndex(filename, dumpfilename)
+    if not index.load():
+        print >> flog, "Building index '%s'." % filename
+        index.build(f)
+    return index
+
+
+def dump_headers(f, index=None):
+    """
+    Generate the lumps of the dump in seekable file 'f' from its current
+    position, or of all the dump from DumpIndex 'index' if not None, as
+    (hdrdict, offset) tuples.
+    """
+    if index is not None:
+        return index.headers()
+    return ((lump.hdrdict, offset)
+            for lump, offset, bodyoffset in scan_headers(f))
+
+
+def plan_untangle(f, pathslist, index=None):
+    """
+    Pre-scan the dump in seekable file 'f' for the copies that will have to be
+    untangled for each of the path filters in 'pathslist', reading only the
+    headers and seeking past the contents, or reading DumpIndex 'index' if not
+    None.  Return two lists of (srcrev, srcpath, dstpath) tuples, for the
+    copies to untangle (once per filter) and for all the copies, and rewind
+    the file.
+    """
+    start = f.tell()
+    read_dump_header(f)
+
+    plan = []
+    copies = []
+    skipping = False
+    for d, offset in dump_headers(f, index):
+        if 'Revision-number' in d:
+            skipping = skipped_revision(int(d['Revision-number']))
+            continue
+        if 'Node-copyfrom-path' not in d:
+            continue
+
+        # The copies of the skipped revisions still shape the tree that the
+        # node store records, only those written out are untangled.
+        path = d['Node-path']
+        srcpath = d['Node-copyfrom-path']
+        copyinfo = (int(d['Node-copyfrom-rev']), srcpath, path)
+        copies.append(copyinfo)
+        if skipping:
+            continue
+        for paths in pathslist:
+            if paths.interesting(path) and not paths.interesting(srcpath):
+                plan.append(copyinfo)
+
+    f.seek(start)
+    return plan, copies
+
+
+def required_literal(p):
+    """
+    Return the longest literal string that every match of the parsed regular
+    expression 'p' contains, or an empty string.
+    """
+    best = run = ''
+    for op, av in p:
+        if op == sre_constants.LITERAL:
+            run += chr(av)
+            continue
+        best = max(best, run, key=len)
+        run = ''
+        if op == sre_constants.SUBPATTERN:
+            best = max(best, required_literal(av[1]), key=len)
+        elif (op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and
+              av[0] >= 1):
+            best = max(best, required_literal(av[2]), key=len)
+    return max(best, run, key=len)
+
+def context_free(p):
+    """
+    Return true if the matches of the parsed regular expression 'p' do not
+    depend on the text around them: no anchors, lookarounds or references.
+    """
+    for op, av in p:
+        if op in (sre_constants.AT, sre_constants.ASSERT,
+                  sre_constants.ASSERT_NOT, sre_constants.GROUPREF,
+                  sre_constants.GROUPREF_EXISTS):
+            return False
+        if op == sre_constants.SUBPATTERN:
+            subs = [av[1]]
+        elif op == sre_constants.BRANCH:
+            subs = av[1]
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            subs = [av[2]]
+        else:
+            continue
+        for sub in subs:
+            if not context_free(sub):
+                return False
+    return True
+
+
+class ContentFilter:
+    """
+    A regular expression substitution of --filter-contents.  A literal string
+    that every match contains is looked for first, to skip the texts that
+    cannot match without running the expression.  Texts too large to be held
+    in memory are filtered in overlapping chunks, provided the matches have a
+    bounded width and do not depend on the text around them.
+    """
+    maxchunkwidth = 1 << 16
+    """Largest width of the matches filtered in chunks."""
+
+    def __init__(self, pattern, sub):
+        self.rx = re.compile(pattern)
+        self.sub = sub
+
+        p = sre_parse.parse(pattern)
+        self.literal = None
+        """A string that every match contains, if any."""
+        if not self.rx.flags & re.IGNORECASE:
+            self.literal = required_literal(p) or None
+
+        self.maxwidth = None
+        """Width of the longest match, if the text can be filtered in chunks."""
+        lo, hi = p.getwidth()
+        if lo > 0 and hi <= self.maxchunkwidth and context_free(p):
+            self.maxwidth = hi
+
+    def subn(self, text):
+        """
+        Apply the substitution to string 'text', like re.subn().
+        """
+        if self.literal is not None and self.literal not in text:
+            return text, 0
+        return self.rx.subn(self.sub, text)
+
+    def contains_literal(self, chunks):
+        """
+        Return true if the text generated by 'chunks' contains the literal,
+        which may straddle several chunks.
+        """
+        n = len(self.literal) - 1
+        tail = ''
+        for data in chunks:
+            if self.literal in tail + data[:n]:
+                return True
+            if self.literal in data:
+                return True
+            if n:
+                # The chunks may be shorter than the literal.
+                tail = (tail + data)[-n:]
+        return False
+
+    def substream(self, chunks, write):
+        """
+        Apply the substitution to the text generated by 'chunks', passing the
+        result to 'write' piece by piece, and return the number of
+        substitutions.  Only the matches that start far enough from the end of
+        a chunk to fit in it are replaced, the rest of the chunk is carried
+        over to the next one.
+        """
+        margin = self.maxwidth + 1
+        count = 0
+        buf = ''
+        chunks = iter(chunks)
+        data = nextchunk(chunks)
+        while data is not None:
+            buf += data
+            data = nextchunk(chunks)
+            if data is None:
+                safe = len(buf) # The last chunk
+            else:
+                safe = len(buf) - margin
+            pos = 0
+            for mo in self.rx.finditer(buf):
+                if mo.start() >= safe:
+                    break
+                write(buf[pos:mo.start()])
+                write(mo.expand(self.sub))
+                pos = mo.end()
+                count += 1
+            cut = max(pos, safe)
+            write(buf[pos:cut])
+            buf = buf[cut:]
+        return count
+
+
+def nextchunk(chunks):
+    """
+    Return the next item of iterator 'chunks', or None at its end.
+    """
+    try:
+        return chunks.next()
+    except StopIteration:
+        return None
+
+def is_binary(lump):
+    """
+    Return true if the text of node 'lump' is binary: from its svn:mime-type
+    if the node sets it, else if its start contains a NUL byte, as Subversion
+    guesses it.
+    """
+    if lump.hasprop:
+        mimetype = lump.propdict.get('svn:mime-type')
+        if mimetype is not None:
+            return not (mimetype.startswith('text/') or
+                        mimetype in ('image/x-xbitmap', 'image/x-xpixmap'))
+    if isinstance(lump.text, LazyText):
+        head = lump.text.head(1024)
+    else:
+        head = lump.text[:1024]
+    return '\0' in head
+
+def filter_contents(lump, path, store=None):
+    """
+    Apply the --filter-contents substitutions that apply to 'path' to the text
+    of node 'lump', and return the number of substitutions made.  Binary texts
+    are left alone.  Streamed texts are filtered in chunks to a temporary file
+    if the expression allows it, else loaded in memory.
+
+    Deltas are replaced by the full texts they expand to, from node store
+    'store', when they are filtered or when their base text was modified, as
+    it then differs in the output.  Other deltas are passed through.
+    """
+    filters = [cfilter for rx_file, cfilter in opts.filter_contents
+               if rx_file.search(path)]
+    if not lump.hastext:
+        return 0
+
+    d = lump.hdrdict
+    if d.get('Text-delta') == 'true':
+        if not filters and (store is None or
+                            d.get('Text-delta-base-md5') not in
+                            store.modified):
+            return 0
+        text = None
+        if store is not None:
+            text = store.fulltext(lump)
+        if text is None:
+            raise SystemExit("Error: The delta of '%s' cannot be expanded "
+                             "to filter its contents." % path)
+        lump.discard()
+        lump.text = text
+        lump.sethdr('Text-content-length', str(len(text)))
+        lump.delhdr('Text-delta')
+        lump.delhdr('Text-delta-base-md5')
+        lump.delhdr('Text-delta-base-sha1')
+        stats.count('deltas-expanded')
+    if not filters:
+        return 0
+    textkey = d.get('Text-content-md5')
+
+    # Make sure that a streamed text can be read more than once.
+    lump.spooltext()
+    if is_binary(lump):
+        return 0
+
+    num_subs = 0
+    for cfilter in filters:
+        if isinstance(lump.text, LazyText) and cfilter.maxwidth is None:
+            lump.loadtext()
+
+        if not isinstance(lump.text, LazyText):
+            text, subs = cfilter.subn(lump.text)
+            if subs:
+                lump.settext(text)
+
+        elif (cfilter.literal is None or
+              cfilter.contains_literal(lump.text.chunks())):
+            f = tempfile.TemporaryFile()
+            subs = cfilter.substream(lump.text.chunks(), f.write)
+            if subs:
+                length = f.tell()
+                f.seek(0)
+                lump.settext(LazyText(f, length, opts.chunk_size, 0))
+            else:
+                f.close()
+        else:
+            subs = 0
+        num_subs += subs
+    if num_subs and store is not None and textkey is not None:
+        store.modified.add(textkey)
+    return num_subs
+
+
+def parse_size(s):
+    """
+    Parse a size in bytes, with an optional K, M or G suffix.
+    """
+    s = s.strip().upper()
+    mult = 1
+    for suffix, m in (('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30)):
+        if s.endswith(suffix):
+            s, mult = s[:-1], m
+            break
+    return int(s) * mult
+
+
+def parse_revision_range(s):
+    """
+    Parse a revision range 'N', 'N:M' or 'N:' (or 'N:HEAD') into a pair
+    (start, end), where end is None for an open range.
+    """
+    s = s.strip()
+    if ':' not in s:
+        start = end = int(s)
+    else:
+        start, end = s.split(':', 1)
+        start = int(start)
+        if end.strip() in ('', 'HEAD'):
+            end = None
+        else:
+            end = int(end)
+    if start < 0 or (end is not None and end < start):
+        raise ValueError(s)
+    return start, end
+
+
+class RevisionRanges:
+    """
+    A set of revisions made of ranges, each one a single revision or a range
+    of consecutive revisions, possibly open ended.
+    """
+    def __init__(self, specs=()):
+        self.starts = []
+        """Sorted list of the first revisions of the disjoint ranges."""
+
+        self.ends = []
+        """Last revisions of the ranges matching 'starts' (None if open)."""
+
+        for spec in specs:
+            for s in spec.split(','):
+                self.add(*parse_revision_range(s))
+
+    def add(self, start, end):
+        """
+        Add the revisions 'start' to 'end' (None for all following ones).
+        """
+        ranges = zip(self.starts, self.ends) + [(start, end)]
+        ranges.sort()
+        self.starts, self.ends = [], []
+        for start, end in ranges:
+            if self.starts and (self.ends[-1] is None or
+                                start <= self.ends[-1] + 1):
+                # Merge with the previous range.
+                if self.ends[-1] is not None and (end is None or
+                                                  end > self.ends[-1]):
+                    self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, rev):
+        i = bisect.bisect_right(self.starts, rev) - 1
+        return i >= 0 and (self.ends[i] is None or rev <= self.ends[i])
+
+    def __nonzero__(self):
+        return bool(self.starts)
+
+
+class RevisionMap:
+    """
+    Map of the revision numbers of the input to those of a filtered dump, for
+    --renumber-revs and --drop-empty-revs.  It is kept as the runs of
+    consecutive revisions written out, in arrays, so that it stays small even
+    over millions of revisions.  A revision that is not written out maps to the
+    last one written before it, whose tree is the same in the filtered dump.
+    """
+    def __init__(self, runs=()):
+        self.starts = array.array('l')
+        """First input revisions of the runs, in increasing order."""
+        self.news = array.array('l')
+        """Output revisions of the first revisions of the runs."""
+        self.lengths = array.array('l')
+        """Number of revisions in the runs."""
+        for start, new, length in runs:
+            self.starts.append(start)
+            self.news.append(new)
+            self.lengths.append(length)
+
+    def last(self):
+        """
+        Return the last output revision, or None if none was written yet.
+        """
+        if not self.starts:
+            return None
+        return self.news[-1] + self.lengths[-1] - 1
+
+    def add(self, rev, new):
+        """
+        Record that input revision 'rev' is written out as revision 'new'.
+        """
+        if (self.starts and rev == self.starts[-1] + self.lengths[-1] and
+            new == self.news[-1] + self.lengths[-1]):
+            self.lengths[-1] += 1
+        else:
+            self.starts.append(rev)
+            self.news.append(new)
+            self.lengths.append(1)
+
+    def get(self, rev):
+        """
+        Return the output revision of input revision 'rev', or None if it is
+        before the first one written out.
+        """
+        i = bisect.bisect_right(self.starts, rev) - 1
+        if i < 0:
+            return None
+        return self.news[i] + min(rev - self.starts[i], self.lengths[i] - 1)
+
+    def runs(self):
+        """
+        Return the list of (start, new, length) runs of the map.
+        """
+        return zip(self.starts, self.news, self.lengths)
+
+
+class Stats:
+    """
+    The instrumentation of a run: counters, and timers of the stages of the
+    filter (the time spent in them and the number of calls).  The functions
+    and methods of the stages are wrapped with timers by instrument() only
+    when the timings are asked for, so that they cost nothing otherwise.  The
+    timers are inclusive: a stage called from another one counts in both.
+    """
+    stages = (
+        ('read', None, 'read_lump_headers'),
+        ('read', None, 'read_lump_body'),
+        ('read', None, 'skip_lump_body'),
+        ('match', 'InterestingPaths', 'interesting'),
+        ('filter-contents', None, 'filter_contents'),
+        ('hash', 'Lump', 'hashtext'),
+        ('write', None, 'write_lump'),
+        ('store', 'NodeStore', 'record'),
+        ('untangle', 'NodeStore', 'fetch'),
+        ('untangle', None, 'fetch_rev_rename'),
+        ('svnadmin', 'UntangleCache', 'dump'),
+        ('untangle', 'SvnlookBackend', 'fetch'),
+        ('svnlook', 'SvnlookBackend', 'lookup'),
+        )
+    """List of (stage, class name or None, function name) to time."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.counters = collections.defaultdict(int)
+        self.timers = {}
+        """Map of stage to a list of the seconds spent in it and of the
+        number of calls."""
+        self.lock = threading.Lock()
+
+        self.reader = None
+        """DumpReader of the input, for the progress."""
+        self.interval = None
+        """Seconds between progress lines, None for none."""
+        self.last = self.start
+        self.lastread = 0
+        self.lastrevs = 0
+        """Time, bytes read and revisions at the last progress line."""
+
+    def count(self, name, n=1):
+        """
+        Add 'n' to counter 'name'.
+        """
+        self.counters[name] += n
+
+    def timed(self, stage, func):
+        """
+        Return a wrapper of 'func' that adds the time spent in it to 'stage'.
+        """
+        timers = self.timers.setdefault(stage, [0.0, 0])
+        lock = self.lock
+        def wrapper(*args, **kw):
+            t = time.time()
+            try:
+                return func(*args, **kw)
+            finally:
+                dt = time.time() - t
+                lock.acquire()
+                timers[0] += dt
+                timers[1] += 1
+                lock.release()
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+    def instrument(self):
+        """
+        Wrap the functions and methods of the stages with timers.
+        """
+        namespace = globals()
+        for stage, clsname, name in self.stages:
+            if clsname is None:
+                namespace[name] = self.timed(stage, namespace[name])
+            else:
+                cls = namespace[clsname]
+                func = cls.__dict__[name]
+                setattr(cls, name, self.timed(stage, func))
+
+    def progress(self, rev, flog):
+        """
+        Print a progress line if it is due, at revision 'rev'.
+        """
+        self.counters['revisions'] += 1
+        if self.interval is None:
+            return
+        now = time.time()
+        if now - self.last < self.interval:
+            return
+        nread = self.reader and self.reader.nread or 0
+        revs = self.counters['revisions']
+        dt = now - self.last
+        print >> flog, ("Progress: revision %d, %.1f MB read, %.1f MB/s, "
+                        "%.1f revisions/s." %
+                        (rev, nread / 1048576.0,
+                         (nread - self.lastread) / 1048576.0 / dt,
+                         (revs - self.lastrevs) / dt))
+        self.last, self.lastread, self.lastrevs = now, nread, revs
+
+    def reset(self):
+        """
+        Zero the counters and timers, keeping the wrappers in place.
+        """
+        self.counters.clear()
+        for timer in self.timers.itervalues():
+            timer[0], timer[1] = 0.0, 0
+
+    def export(self):
+        """
+        Return the counters and timers as plain dicts, to be merged.
+        """
+        return dict(self.counters), dict(self.timers)
+
+    def merge(self, exported):
+        """
+        Add the counters and timers exported by another process.
+        """
+        counters, timers = exported
+        for name, n in counters.iteritems():
+            self.counters[name] += n
+        for stage, (seconds, calls) in timers.iteritems():
+            timer = self.timers.setdefault(stage, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+
+    def report(self):
+        """
+        Return the report of the run, as a dict.
+        """
+        elapsed = time.time() - self.start
+        counters = dict(self.counters)
+        report = {
+            'elapsed': elapsed,
+            'counters': counters,
+            'stages': dict((stage, {'seconds': seconds, 'calls': calls})
+                           for stage, (seconds, calls) in
+                           self.timers.iteritems()),
+            }
+        if elapsed > 0:
+            report['mb-per-second'] = (counters.get('bytes-in', 0) /
+                                       1048576.0 / elapsed)
+            report['revisions-per-second'] = (counters.get('revisions', 0) /
+                                              elapsed)
+        return report
+
+    def write_json(self, filename):
+        """
+        Write the report to file 'filename' as JSON.
+        """
+        try:
+            import json
+        except ImportError:
+            raise SystemExit("Error: --stats-json needs the json module.")
+        f = open(filename, 'w')
+        try:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
+            f.write('\n')
+        finally:
+            f.close()
+
+stats = Stats()
+"""The instrumentation of the run."""
+
+
+def run_profiled(filename, flog, func, *args):
+    """
+    Call 'func' with 'args' under cProfile, saving the profile to 'filename'
+    (to be read with the pstats module) and printing the functions where the
+    most time was spent to 'flog'.
+    """
+    try:
+        import cProfile as profile
+    except ImportError:
+        import profile
+    import pstats
+    prof = profile.Profile()
+    try:
+        return prof.runcall(func, *args)
+    finally:
+        prof.dump_stats(filename)
+        p = pstats.Stats(filename, stream=flog)
+        p.sort_stats('cumulative').print_stats(25)
+
+
+def parse_options():
+    """
+    Parse and validate the options.
+    """
+    global progname
+    progname = basename(sys.argv[0])
+
+    import optparse
+    parser = optparse.OptionParser(__doc__.strip())
+
+    # Original svndumpfilter options.
+    #
+    # FIXME: we still need to implement --preserve-revprops.
+    #
+    # FIXME: we could convert this script to use subcommands and add the same
+    # subcommand options that are present in svndumpfilter.
+    parser.add_option('--drop-empty-revs', action='store_true',
+                      help="Remove revisions emptied by filtering.")
+    parser.add_option('--renumber-revs', action='store_true',
+                      help="Renumber revisions left after filtering.")
+    parser.add_option('--preserve-revprops', action='store_true',
+                      help="Don't filter revision properties.")
+
+
+    parser.add_option('--quiet', action='store_true',
+                      help="Do not display filtering statistics.")
+
+    parser.add_option('--summary', action='store', metavar='FILE',
+                      help="Write the summary of the dropped and converted "
+                           "nodes to FILE instead of stderr, with the number "
+                           "of nodes and bytes dropped at each path.")
+
+    parser.add_option('--summary-budget', type='int', default=1 << 20,
+                      metavar='N',
+                      help="Keep at most N paths in the summary of the "
+                           "dropped nodes, rolling the deepest ones up into "
+                           "their parent directories beyond that (default: "
+                           "%default).")
+
+    parser.add_option('-e', '--exclude', action='store_true',
+                      help="The given paths are to be excluded rather than "
+                      "included (the default is to include).")
+
+    parser.add_option('--include-from', action='append', default=[],
+                      metavar='FILE',
+                      help="Read paths to include from FILE, one per line, "
+                           "in addition to those given as arguments.")
+
+    parser.add_option('--exclude-from', action='append', default=[],
+                      metavar='FILE',
+                      help="Read paths to exclude from FILE, one per line, "
+                           "in addition to those given as arguments.  This "
+                           "implies --exclude.")
+
+    parser.add_option('-i', '--input', action='store', metavar='FILE',
+                      help="Read the dump from FILE rather than from stdin.  "
+                           "Dumps compressed with gzip, bzip2, xz or zstd "
+                           "are recognized and decompressed on the fly.")
+
+    parser.add_option('-o', '--output', action='store', metavar='FILE',
+                      help="Write the dump to FILE rather than to stdout.  "
+                           "It is compressed if its extension is .gz, .bz2, "
+                           ".xz or .zst (as are the files of --split).")
+
+    parser.add_option('--output-buffer', action='store', default='1M',
+                      metavar='SIZE',
+                      help="Size of the buffer in which the output is "
+                           "coalesced into large writes, with an optional "
+                           "K, M or G suffix (default: %default).")
+
+    parser.add_option('--flush', type='choice', default='size',
+                      choices=['size', 'revision', 'lump'],
+                      help="When to write the output buffer out: when it is "
+                           "full ('size'), also before every revision "
+                           "('revision'), or after every lump ('lump') "
+                           "(default: %default).")
+
+    parser.add_option('--direct', action='store_true',
+                      help="Write the output files with O_DIRECT, in large "
+                           "aligned blocks that bypass the page cache.")
+
+    parser.add_option('--pipeline', action='store_true',
+                      help="Read, filter and write the lumps in three "
+                           "threads, so that the I/O, the decompression and "
+                           "the hashing overlap with the filtering.")
+
+    parser.add_option('--max-inflight', action='store', default='64M',
+                      metavar='SIZE',
+                      help="Bound on the bytes of the lumps held between the "
+                           "threads of --pipeline, with an optional K, M or G "
+                           "suffix, at least 64K (default: %default).")
+
+    parser.add_option('-j', '--jobs', type='int', default=1, metavar='N',
+                      help="Filter with N worker processes, each working on "
+                           "a range of revisions of the input file (needs "
+                           "--input).")
+
+    parser.add_option('--index', action='store', metavar='FILE',
+                      help="Use the index of the revisions and nodes of the "
+                           "input file kept in FILE, building it first if it "
+                           "is missing or out of date (needs --input).  The "
+                           "index saves the scans of the input done by "
+                           "--plan and --jobs.")
+
+    parser.add_option('--split', action='store', metavar='FILE',
+                      help="Write several filtered dumps in a single pass "
+                           "over the input.  Each line of FILE holds the "
+                           "name of an output file followed by the paths to "
+                           "write to it.  No paths can be given as arguments "
+                           "then.")
+
+    parser.add_option('-p', '--prune-properties', action='store_true',
+                      help="Prune empty properties if empty. This makes the "
+                           "dump file smaller, but does not match latest "
+                           "version of svnadmin dump, so don't use if e.g. "
+                           "you want to diff the input and output dump.")
+
+    parser.add_option('-u', '--untangle', action='store', dest='repos',
+                      metavar='REPOS_PATH',
+                      help="If True, convert move/copy from filtered paths "
+                      "to additions.  You need to specify the repository to "
+                      "fetch the missing files from.")
+
+    parser.add_option('--untangle-cache', action='store', metavar='DIR',
+                      help="Keep the revisions dumped from the repository to "
+                           "untangle copies in DIR, so that they can be "
+                           "reused by later runs.  By default they are kept "
+                           "in a temporary directory for the duration of the "
+                           "run only.")
+
+    parser.add_option('--untangle-cache-size', action='store',
+                      default='1G', metavar='SIZE',
+                      help="Maximum size of the untangle cache; the least "
+                           "recently used revisions are removed beyond it "
+                           "(default: %default).")
+
+    parser.add_option('--untangle-backend', type='choice',
+                      default='svnadmin', choices=['svnadmin', 'svnlook'],
+                      help="How --untangle reads the copy sources from the "
+                           "repository: by dumping their whole revision with "
+                           "'svnadmin dump', kept in the untangle cache "
+                           "('svnadmin'), or by reading only the copied "
+                           "subtree with 'svnlook' ('svnlook'), which is "
+                           "faster for small copies out of large revisions "
+                           "(default: %default).")
+
+    parser.add_option('--untangle-jobs', type='int', default=4, metavar='N',
+                      help="Number of concurrent 'svnlook' lookups of "
+                           "--untangle-backend=svnlook (default: %default).")
+
+    parser.add_option('-U', '--untangle-from-dump', action='store_true',
+                      help="Convert move/copy from filtered paths to "
+                           "additions like --untangle, but take the missing "
+                           "files from the input dump itself, which is "
+                           "recorded in a node store as it is read.  This "
+                           "needs neither the repository nor Subversion.")
+
+    parser.add_option('--node-store', action='store', metavar='DIR',
+                      help="Keep the node store of --untangle-from-dump in "
+                           "DIR.  By default it is kept in a temporary "
+                           "directory for the duration of the run only.  "
+                           "Without --plan, it holds every text of the "
+                           "history.")
+
+    parser.add_option('--state', action='store', metavar='FILE',
+                      help="Save the state of the filter to FILE at the end "
+                           "of the run, and start from it if it exists, to "
+                           "filter the incremental dumps of a repository one "
+                           "after the other.  The revisions up to the last "
+                           "one filtered are skipped, and the untangle cache "
+                           "and node store are kept next to FILE unless "
+                           "given.")
+
+    parser.add_option('--plan', action='store_true',
+                      help="Pre-scan the (seekable) input for the copies to "
+                           "untangle.  With --untangle, their sources are "
+                           "fetched from the repository in the background "
+                           "while filtering; with --untangle-from-dump, only "
+                           "what they depend on is kept in the node store.")
+
+    parser.add_option('--plan-jobs', type='int', default=4, metavar='N',
+                      help="Number of revisions to fetch from the repository "
+                           "in parallel when using --plan (default: "
+                           "%default).")
+
+    parser.add_option('-n', '--no-filter', action='store_true',
+                      help="Do not actually apply filters, but just "
+                      "perform the requested conversions.  This can be used "
+                      "as a test by running the output into svndumpfilter, "
+                      "which should now succeed.")
 
     parser.add_option('-k', '--ignore-missing', action='store_true',
                       help="Continue as much as possible after an error due to "
@@ -688,7 +3614,10 @@ def parse_options():
                            "spaces): a regular expression that specifies the "
                            "files to be processed (eg: \"*.[ch]\"); the regexp "
                            "that matches the text; the replacement regexp. You "
-                           "can specify this option as many times as you need.")
+                           "can specify this option as many times as you need. "
+                           "In a dump made with --deltas, the filtered texts "
+                           "are written in full, which needs a node store "
+                           "(see --node-store).")
 
     parser.add_option("--filter-logs", type="string", nargs=2, default=[],
                       action="append", metavar="RX_MATCH SUB",
@@ -699,10 +3628,39 @@ def parse_options():
                            "that matches the text; the replacement regexp. You "
                            "can specify this option as many times as you need.")
 
-    parser.add_option("--skip-rev", type="int", action="append", default=[],
-                      metavar="REV",
-                      help="Skip (filter out) a specific revision. You can "
-                           "specify this option as many times as you need.")
+    parser.add_option("--skip-rev", type="string", action="append",
+                      default=[], metavar="REVS",
+                      help="Skip (filter out) a specific revision, a range "
+                           "of revisions N:M, or a comma separated list of "
+                           "them. You can specify this option as many times "
+                           "as you need.")
+
+    parser.add_option('-r', '--revision', action='store', metavar='START:END',
+                      help="Only write out the revisions START to END (END "
+                           "may be omitted or HEAD).  The revisions before "
+                           "START are skipped without being parsed, and the "
+                           "input is not read past END.")
+
+    parser.add_option('--progress', type='float', metavar='SECONDS',
+                      help="Print a progress line with the throughput in "
+                           "MB/s and revisions/s every SECONDS.")
+
+    parser.add_option('--stats-json', action='store', metavar='FILE',
+                      help="Write a report of the run to FILE as JSON: the "
+                           "bytes read and written, the nodes kept and "
+                           "dropped, and the time spent in each stage of the "
+                           "filter and the number of calls.")
+
+    parser.add_option('--profile', action='store', metavar='FILE',
+                      help="Run the filter under cProfile, saving the profile "
+                           "to FILE and printing the costliest functions.")
+
+    parser.add_option('--chunk-size', type='int', default=1 << 20,
+                      metavar='BYTES',
+                      help="Node texts larger than this are streamed from "
+                           "the input to the output in chunks of this size, "
+                           "rather than being loaded in memory (default: "
+                           "%default).")
 
     parser.add_option('--debug', action='store_true',
                       help=optparse.SUPPRESS_HELP)
@@ -714,202 +3672,1275 @@ def parse_options():
     # (= all paths are included).
     inpaths = args
 
+    if opts.include_from and (opts.exclude or opts.exclude_from):
+        parser.error("Cannot both include and exclude paths.")
+    if opts.exclude_from:
+        opts.exclude = True
+    try:
+        for filename in opts.include_from + opts.exclude_from:
+            inpaths.extend(read_patterns(filename))
+    except IOError, e:
+        parser.error("error reading paths: %s" % e)
+
     # Validate filter regular expressions
     try:
-        opts.filter_contents = [(re.compile(a), re.compile(b), c)
+        opts.filter_contents = [(re.compile(a), ContentFilter(b, c))
                                 for a,b,c in opts.filter_contents]
         opts.filter_logs = [(re.compile(a), b)
                             for a,b in opts.filter_logs]
     except Exception, e:
         parser.error("error parsing regular expression: %s" % str(e))
 
-    if opts.no_filter and not opts.repos:
+    if opts.split:
+        if inpaths:
+            parser.error("Paths cannot be given as arguments with --split.")
+        if opts.output:
+            parser.error("--output cannot be used with --split.")
+        try:
+            opts.split = read_split_map(opts.split)
+        except IOError, e:
+            parser.error("error reading split: %s" % e)
+        if not opts.split:
+            parser.error("No outputs in split file.")
+
+    if opts.jobs <= 0:
+        parser.error("Invalid number of jobs: %d" % opts.jobs)
+    if opts.jobs > 1:
+        if not opts.input:
+            parser.error("--jobs needs an --input file.")
+        if opts.pipeline:
+            parser.error("--jobs cannot be used with --pipeline.")
+        if opts.untangle_from_dump or opts.plan:
+            parser.error("--jobs cannot be used with --untangle-from-dump "
+                         "or --plan.")
+
+    if opts.index and not opts.input:
+        parser.error("--index needs an --input file.")
+
+    if opts.repos and opts.untangle_from_dump:
+        parser.error("Use either --untangle or --untangle-from-dump.")
+    untangle = opts.repos or opts.untangle_from_dump
+
+    if opts.no_filter and not untangle:
         parser.error("Both filtering and untangle are disabled.  "
                      "This filter will have no effect.")
 
-    if opts.repos and opts.ignore_missing:
+    if opts.plan and not untangle:
+        parser.error("--plan is only useful with --untangle.")
+
+    if opts.plan_jobs <= 0:
+        parser.error("Invalid number of jobs: %d" % opts.plan_jobs)
+    if opts.untangle_jobs <= 0:
+        parser.error("Invalid number of jobs: %d" % opts.untangle_jobs)
+
+    if untangle and opts.ignore_missing:
         parser.error("You don't need --ignore-missing if you're untangling.")
 
-    opts.skip_rev = set(opts.skip_rev)
+    try:
+        opts.untangle_cache_size = parse_size(opts.untangle_cache_size)
+    except ValueError:
+        parser.error("Invalid size: %s" % opts.untangle_cache_size)
+
+    if opts.progress is not None and opts.progress <= 0:
+        parser.error("Invalid progress interval: %s" % opts.progress)
+
+    if opts.summary_budget <= 0:
+        parser.error("Invalid summary budget: %d" % opts.summary_budget)
+
+    if opts.chunk_size <= 0:
+        parser.error("Invalid chunk size: %d" % opts.chunk_size)
 
-    for optname in 'drop-empty-revs', 'renumber-revs', 'preserve-revprops':
-        if getattr(opts, optname.replace('-', '_')):
-            parser.error("(Option '%s' not implemented)." % optname)
+    try:
+        opts.output_buffer = parse_size(opts.output_buffer)
+        opts.max_inflight = parse_size(opts.max_inflight)
+    except ValueError, e:
+        parser.error("Invalid size: %s" % e)
+    if opts.output_buffer <= 0:
+        parser.error("Invalid output buffer size: %d" % opts.output_buffer)
+    if opts.max_inflight < pipeline_min_inflight:
+        parser.error("Invalid max inflight size: %d (at least %d)" %
+                     (opts.max_inflight, pipeline_min_inflight))
+
+    try:
+        opts.skip_rev = RevisionRanges(opts.skip_rev)
+    except ValueError, e:
+        parser.error("Invalid revision range: %s" % e)
+
+    opts.rev_start, opts.rev_end = 0, None
+    if opts.revision:
+        try:
+            opts.rev_start, opts.rev_end = parse_revision_range(opts.revision)
+        except ValueError, e:
+            parser.error("Invalid revision range: %s" % e)
+
+    if opts.preserve_revprops:
+        parser.error("(Option 'preserve-revprops' not implemented).")
+
+    if opts.jobs > 1 and (opts.drop_empty_revs or opts.renumber_revs):
+        parser.error("--jobs cannot be used with --drop-empty-revs or "
+                     "--renumber-revs.")
 
     return opts, inpaths
 
-def main():
+
+class FilterOutput:
     """
-    Main program that just reads the lumps and copies them out.
+    One filtered dump being written: the paths it keeps, its untangling of the
+    copies from the paths it drops, and the record of what it dropped and
+    converted.  The lumps read from the input are routed to every output.
     """
-    opts, inpaths = parse_options()
+    def __init__(self, fw, paths, cache=None, store=None, name=None):
+        self.fw = fw
+        self.paths = paths
+        self.cache = cache
+        """Untangle backend of --untangle, or None."""
+        self.store = store
+        self.name = name
+        """Name of the output file, None for stdout."""
 
-    # Open in and out files.
-    fr = sys.stdin
-    fw = sys.stdout
-    flog = sys.stderr
+        self.format = None
+        """Format of the dump, once its header was written."""
 
-    # Track which base files are interesting, accepting regexps for input
-    # filenames.
-    if opts.exclude:
-        print >> flog, 'Excluding prefixes:'
-    else:
-        print >> flog, 'Including prefixes:'
-    for p in inpaths:
-        print >> flog, "   '/%s'" % p
-    print >> flog
-    if not inpaths:
-        opts.exclude = True
+        self.filtered = DroppedPaths(opts.summary_budget)
+        """Summary of the filtered paths."""
 
-    paths = InterestingPaths(inpaths, opts.exclude)
+        self.converted = []
+        """List of (srcpath, destpath, type, rev) tuples that describe the paths
+        that were converted from move/copy into additions."""
 
-    # Read the dumpfile header.
-    format, uuid, text = read_dump_header(fr)
-    fw.write(text)
+        self.skipping = False
+        """True while we are skipping a revision."""
 
-    if format not in __supported_versions__:
-        # Note: you could update this script easily to support other formats, it
-        # will probably be trivial to do so.
-        raise SystemExit("Error: dump file in format '%s' not supported." %
-                         format)
+        self.lastrev = None
+        """Number of the last revision read, written out or not."""
 
-    filtered = set()
-    """Set of filtered paths."""
+        self.revmap = None
+        """Map of the revision numbers of the input to the output, if they
+        can differ."""
+        if opts.renumber_revs or opts.drop_empty_revs:
+            self.revmap = RevisionMap()
 
-    converted = []
-    """List of (srcpath, destpath, type, rev) tuples that describe the paths
-    that were converted from move/copy into additions."""
+        self.pending = None
+        """Revision lump held back until its first node is written out."""
+
+        self.dropped = False
+        """True if nodes of the pending revision were filtered out."""
+
+    def write_header(self, text, format):
+        """
+        Write the dumpfile header.
+        """
+        self.fw.write(text)
+        self.format = format
+
+    def write_revision(self, lump, skip, flog):
+        """
+        Write revision 'lump', or start skipping its nodes if 'skip' is true.
+        With --drop-empty-revs, the revision is held back until its first node
+        is written out.
+        """
+        self.end_revision(flog)
+        self.lastrev = int(lump.hdrdict['Revision-number'])
+        self.skipping = skip
+        if skip:
+            return
+        self.pending = lump
+        self.dropped = False
+        if not opts.drop_empty_revs:
+            self.start_revision(flog)
+
+    def start_revision(self, flog):
+        """
+        Write out the pending revision, renumbered if needed.
+        """
+        lump, self.pending = self.pending, None
+        rev = int(lump.hdrdict['Revision-number'])
+        if self.revmap is not None:
+            new = rev
+            if opts.renumber_revs and self.revmap.last() is not None:
+                new = self.revmap.last() + 1
+            self.revmap.add(rev, new)
+            if new != rev:
+                # The lump may be written to other outputs as well.
+                lump = lump.clone()
+                lump.sethdr('Revision-number', str(new))
+            if not opts.quiet:
+                print >> flog, 'Revision %d committed as %d.' % (rev, new)
+        self.fw.revision()
+        write_lump(self.fw, lump)
+
+    def end_revision(self, flog):
+        """
+        Finish the current revision: if it is still held back, drop it if all
+        its nodes were filtered out, else write it out empty.
+        """
+        if self.pending is None:
+            return
+        if self.dropped:
+            if not opts.quiet:
+                print >> flog, ('Revision %s skipped.' %
+                                self.pending.hdrdict['Revision-number'])
+            self.pending = None
+        else:
+            self.start_revision(flog)
+
+    def keep(self, path, size=0):
+        """
+        Return true if node 'path' is to be written to this output, recording
+        it as filtered if not, along with its 'size'.
+        """
+        if self.skipping:
+            return False
+        if not self.paths.interesting(path):
+            self.filtered.add(path, 1, size)
+            self.dropped = True
+            return False
+        return True
+
+    def write_node(self, lump, flog):
+        """
+        Write node 'lump', which is to be kept, untangling it if it is a copy
+        from a filtered path.
+        """
+        path = lump.hdrdict['Node-path']
+        if self.pending is not None:
+            self.start_revision(flog)
+
+        # If this is not a move/copy.
+        if "Node-copyfrom-path" not in lump.hdrdict:
+            # Just pass through.
+            write_lump(self.fw, lump)
+            return
+
+        # This is a move/copy.
+        srcrev = int(lump.hdrdict["Node-copyfrom-rev"])
+        srcpath = lump.hdrdict["Node-copyfrom-path"]
+
+        # Check if the copy's source comes from a filtered path.
+        if self.paths.interesting(srcpath):
+            # If it comes from an included path, just pass through, from the
+            # source revision as numbered in the output.
+            if self.revmap is not None:
+                newrev = self.revmap.get(srcrev)
+                if newrev is not None and newrev != srcrev:
+                    lump = lump.clone()
+                    lump.sethdr("Node-copyfrom-rev", str(newrev))
+            write_lump(self.fw, lump)
+            return
+
+        # Otherwise we deal with the case where the source comes from a
+        # filtered path.
+        if self.cache is None and self.store is None:
+            msg = ("%s: Invalid copy source path '%s'" %
+                   (progname, srcpath))
+            if opts.ignore_missing:
+                print >> flog, msg
+                return
+            else:
+                raise SystemExit(msg)
+
+        self.converted.append(
+            (srcpath, path, lump.hdrdict['Node-kind'], srcrev))
+
+        print >> flog, ("%s: Converting '%s' to a copy on '%s'" %
+                        (progname, srcpath, path))
+
+        if self.store is not None:
+            # Synthesize the additions from the node store.
+            self.store.fetch(srcrev, srcpath, path, self.fw, flog)
+        else:
+            # Fetch the old revision from the repository.
+            self.cache.fetch(srcrev, srcpath, path, self.fw, flog,
+                             self.format)
+
+        # We also check if the original lump includes a payload, and if
+        # it does, we need to add a change record providing the new
+        # contents.
+        if len(lump.text) > 0 and self.paths.interesting(path):
+            print >> flog, ("%s:    Added a change record for '%s' as "
+                            "well.") % (progname, path)
+            # The lump may be written to other outputs as well, do not modify
+            # it in place.
+            lump = lump.clone()
+            lump.sethdr("Node-action", "change")
+            lump.delhdr("Node-copyfrom-rev")
+            lump.delhdr("Node-copyfrom-path")
+            lump.delhdr("Text-copy-source-md5")
+            lump.delhdr("Text-copy-source-sha1")
+            write_lump(self.fw, lump)
+
+    def close(self):
+        """
+        Close the output file.
+        """
+        self.fw.close()
+
+    def print_summary(self, flog, detailed=False):
+        """
+        Print the summary of dropped and converted nodes, with the number of
+        nodes and bytes dropped at each path if 'detailed' is true.  The paths
+        that were rolled up end with '/...'.
+        """
+        if self.name is not None:
+            print >> flog, "Output '%s':" % self.name
+
+        # Print summary of dropped nodes.
+        entries = self.filtered.entries()
+        if detailed:
+            print >> flog, ('Dropped %d node(s), %d bytes, at %d path(s):' %
+                            (sum(e[1] for e in entries),
+                             sum(e[2] for e in entries), len(entries)))
+        elif self.filtered.maxdepth is not None:
+            print >> flog, ('Dropped nodes at %d path(s), rolled up past '
+                            'depth %d:' % (len(entries),
+                                           self.filtered.maxdepth))
+        else:
+            print >> flog, 'Dropped %d node(s):' % len(entries)
+        for path, count, size, rolled in entries:
+            if rolled:
+                path = path and path + '/...' or '...'
+            if detailed:
+                print >> flog, ("   '/%s'  %d node(s), %d bytes" %
+                                (path, count, size))
+            elif rolled:
+                print >> flog, "   '/%s'  (%d nodes)" % (path, count)
+            else:
+                print >> flog, "   '/%s'" % path
+        print >> flog
+
+        # Print summary of converted nodes.
+        print >> flog, ('%s nodes converted into additions(s).' %
+                        len(self.converted))
+        for srcpath, dstpath, typ, srcrev in sorted(self.converted):
+            print >> flog, ("   '/%s' to '/%s' (%s, revision %s)" %
+                            (srcpath, dstpath, typ, srcrev))
+        print >> flog
+
+
+class DroppedPathNode(object):
+    """
+    A node of the summary of the dropped paths: one path component.
+    """
+    __slots__ = ('count', 'size', 'children', 'rolled')
+
+    def __init__(self):
+        self.count = 0
+        """Number of nodes dropped at this path (and below it if rolled)."""
+        self.size = 0
+        """Number of bytes of the contents of these nodes."""
+        self.children = None
+        """Children by path component, None if there are none."""
+        self.rolled = False
+        """True if the paths below this one were rolled up into it."""
+
+
+class DroppedPaths:
+    """
+    The summary of the nodes dropped from an output: the number of nodes and
+    the bytes dropped at each path, in a tree of path components, so that
+    common prefixes are only stored once.  When the tree grows over 'budget'
+    nodes, its deepest level is rolled up into its parents, and the paths
+    added later are cut to the remaining depth, so that the summary of a huge
+    repository stays bounded in memory.
+    """
+    def __init__(self, budget=1 << 20):
+        self.budget = budget
+        self.root = DroppedPathNode()
+        self.nodes = 1
+        """Number of nodes in the tree."""
+        self.depths = [1]
+        """Number of tree nodes at each depth."""
+        self.maxdepth = None
+        """Depth past which the paths are rolled up, None until needed."""
+
+    def add(self, path, count=1, size=0, rolled=False):
+        """
+        Record 'count' nodes of 'size' bytes dropped at 'path', or below it if
+        'rolled' is true.
+        """
+        comps = splitpath(path)
+        if self.maxdepth is not None and len(comps) > self.maxdepth:
+            del comps[self.maxdepth:]
+            rolled = True
+        node = self.root
+        for depth, comp in enumerate(comps):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(comp)
+            if child is None:
+                child = node.children[comp] = DroppedPathNode()
+                if depth + 1 == len(self.depths):
+                    self.depths.append(0)
+                self.depths[depth + 1] += 1
+                self.nodes += 1
+            node = child
+        node.count += count
+        node.size += size
+        node.rolled = node.rolled or rolled
+        if self.nodes > self.budget:
+            self.rollup()
+
+    def rollup(self):
+        """
+        Roll the deepest levels of the tree up into their parents until it
+        fits in its budget.
+        """
+        while self.nodes > self.budget and len(self.depths) > 1:
+            depth = len(self.depths) - 2
+            nodes = [self.root]
+            for i in xrange(depth):
+                nodes = [child for node in nodes if node.children
+                         for child in node.children.itervalues()]
+            for node in nodes:
+                if node.children:
+                    for child in node.children.itervalues():
+                        node.count += child.count
+                        node.size += child.size
+                    node.children = None
+                    node.rolled = True
+            self.nodes -= self.depths.pop()
+            self.maxdepth = depth
+
+    def entries(self):
+        """
+        Return the sorted list of (path, count, size, rolled) of the paths
+        where nodes were dropped.
+        """
+        entries = []
+        stack = [('', self.root)]
+        while stack:
+            path, node = stack.pop()
+            if node.count:
+                entries.append((path, node.count, node.size, node.rolled))
+            if node.children:
+                for comp, child in node.children.iteritems():
+                    stack.append((path and path + '/' + comp or comp, child))
+        entries.sort()
+        return entries
+
+    def update(self, entries):
+        """
+        Add the (path, count, size, rolled) in list 'entries'.
+        """
+        for path, count, size, rolled in entries:
+            self.add(path, count, size, rolled)
+
+
+def read_split_map(filename):
+    """
+    Read the outputs of a split from a file.  Each line holds the name of an
+    output file followed by the paths to write to it, separated by whitespace.
+    Blank lines and lines starting with '#' are ignored.  Return a list of
+    (filename, paths) tuples.
+    """
+    split = []
+    f = open(filename)
+    try:
+        for line in f:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                split.append((fields[0], fields[1:]))
+    finally:
+        f.close()
+    return split
 
-    skipping = False
-    """True while we are skipping a revision."""
 
-    # Process the dump file.
+class FilterState:
+    """
+    The state of the filter saved between runs with --state, so that the
+    incremental dumps of a repository can be filtered one after the other into
+    the same filtered repositories, each run only reading the new revisions.
+    The state is a JSON file that holds the last revision filtered, the paths
+    dropped and converted by each output and its map of revision numbers (see
+    RevisionMap), and where the untangling context is kept across runs: the
+    node store of --untangle-from-dump, which records which paths exist in
+    each revision and is where copy sources are taken from, and the untangle
+    cache of --untangle, whose entries are keyed by the repository UUID.
+    """
+    version = 1
+
+    def __init__(self, filename):
+        try:
+            import json
+        except ImportError:
+            raise SystemExit("Error: --state needs the json module.")
+        self.json = json
+        self.filename = filename
+
+        self.uuid = None
+        """UUID of the repository of the dumps."""
+        self.lastrev = None
+        """Number of the last revision filtered, None at the first run."""
+        self.outputs = {}
+        """Map of output names ('' for the only one) to a dict with their
+        'filtered' and 'converted' lists."""
+        self.node_store = os.path.abspath(filename + '.store')
+        """Directory of the node store of --untangle-from-dump."""
+        self.untangle_cache = os.path.abspath(filename + '.cache')
+        """Directory of the untangle cache of --untangle."""
+
+        if os.path.exists(filename):
+            self.load()
+
+    def load(self):
+        """
+        Read the state from its file.
+        """
+        def encode(value):
+            # The JSON strings are read as unicode, paths are used as UTF-8.
+            if isinstance(value, unicode):
+                return value.encode('utf-8')
+            if isinstance(value, list):
+                return [encode(v) for v in value]
+            if isinstance(value, dict):
+                return dict((encode(k), encode(v)) for k, v in value.items())
+            return value
+
+        try:
+            f = open(self.filename)
+            try:
+                state = encode(self.json.load(f))
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            raise SystemExit("Error: Could not read state file '%s': %s" %
+                             (self.filename, e))
+        if state.get('version') != self.version:
+            raise SystemExit("Error: State file '%s' has an unsupported "
+                             "version." % self.filename)
+        self.uuid = state['uuid']
+        self.lastrev = state['last-revision']
+        self.outputs = state['outputs']
+        self.node_store = state['node-store']
+        self.untangle_cache = state['untangle-cache']
+
+    def check_uuid(self, uuid):
+        """
+        Make sure that the dump with UUID 'uuid' is from the same repository
+        as the previous runs.
+        """
+        if self.uuid is not None and uuid is not None and uuid != self.uuid:
+            raise SystemExit("Error: The dump is from repository %s, but state "
+                             "file '%s' is for repository %s." %
+                             (uuid, self.filename, self.uuid))
+        if uuid is not None:
+            self.uuid = uuid
+
+    def restore(self, output):
+        """
+        Restore what FilterOutput 'output' dropped and converted in the
+        previous runs.
+        """
+        state = self.outputs.get(output.name or '')
+        if state is not None:
+            output.filtered.update(state['filtered'])
+            output.converted.extend(tuple(c) for c in state['converted'])
+            if output.revmap is not None and 'revmap' in state:
+                output.revmap = RevisionMap(state['revmap'])
+
+    def save(self, outputs):
+        """
+        Write the state after filtering to 'outputs' to its file.  The file is
+        replaced atomically, so that an interrupted run leaves the state of the
+        previous one.
+        """
+        for o in outputs:
+            if o.lastrev is not None:
+                self.lastrev = max(self.lastrev, o.lastrev)
+            self.outputs[o.name or ''] = {
+                'filtered': o.filtered.entries(),
+                'converted': sorted(o.converted)}
+            if o.revmap is not None:
+                self.outputs[o.name or '']['revmap'] = o.revmap.runs()
+        state = {'version': self.version,
+                 'uuid': self.uuid,
+                 'last-revision': self.lastrev,
+                 'outputs': self.outputs,
+                 'node-store': self.node_store,
+                 'untangle-cache': self.untangle_cache}
+
+        tmpfn = '%s.%d.tmp' % (self.filename, os.getpid())
+        f = open(tmpfn, 'w')
+        try:
+            self.json.dump(state, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpfn, self.filename)
+
+
+def read_lumps(fr, pathslist, store, end=None, detach=False):
+    """
+    Generate the lumps read from DumpReader 'fr' up to offset 'end' (or the
+    end of the file), for outputs with the path filters in 'pathslist'.  The
+    revisions that are not written out come without their nodes, and the nodes
+    that no filter keeps without their contents, which are skipped rather than
+    read, unless node store 'store' is not None and has to record them.  If
+    'detach' is true, the lumps are made independent of 'fr', so that they can
+    still be used after the next one is read.
+    """
+    lump = None
+    skipping = False
     while 1:
-        # Read one lump at a time
-        lump = read_lump(fr)
+        # Skip whatever was not written out of the previous lump's text.
+        if lump is not None and not detach:
+            lump.discard()
+
+        # Read one lump at a time, its headers first.
+        lump = read_lump_headers(fr)
         if lump is None:
             break # At EOF
+        if end is not None and lump.offset >= end:
+            break # At the end of the range
+
+        d = lump.hdrdict
+        if 'Revision-number' in d:
+            rev = int(d['Revision-number'])
+            if opts.rev_end is not None and rev > opts.rev_end:
+                break # Past the last revision to write out
+
+            # Unless the node store needs them, the lumps of the revisions
+            # that are not written out are skipped without being read.
+            skipping = store is None and skipped_revision(rev)
+            if skipping:
+                skip_lump_body(fr, lump)
+                yield lump
+                continue
 
-        # Let the revisions pass through
-        if lump.hdrdict.has_key('Revision-number'):
+        elif skipping:
+            skip_lump_body(fr, lump)
+            continue
 
-            revno = lump.hdrdict['Revision-number']
-            if int(revno) in opts.skip_rev:
-                print >> flog, 'Revision %s filtered out.' % revno
-                skipping = True
+        elif store is None:
+            # Filter out the uninteresting nodes from their headers, without
+            # reading their contents.
+            path = d['Node-path']
+            if not [paths for paths in pathslist if paths.interesting(path)]:
+                skip_lump_body(fr, lump)
+                yield lump
                 continue
 
-            skipping = False
+        read_lump_body(fr, lump)
+        if detach:
+            lump.detach()
+        yield lump
+
+
+def filter_lumps(lumps, outputs, store, flog):
+    """
+    Route the lumps generated by 'lumps' (see read_lumps()) to the
+    FilterOutput's in 'outputs'.  Nodes are recorded in node store 'store' if
+    not None.
+    """
+    for lump in lumps:
+        d = lump.hdrdict
+
+        # Let the revisions pass through
+        if 'Revision-number' in d:
+
+            revno = d['Revision-number']
+            stats.progress(int(revno), flog)
+            if store is not None:
+                store.commit()
+            if skipped_revision(int(revno)):
+                if int(revno) in opts.skip_rev:
+                    print >> flog, 'Revision %s filtered out.' % revno
+                for o in outputs:
+                    o.write_revision(lump, True, flog)
+                continue
 
             # Filter svn:log property
             # JT Revision 0 may not have an svn:log entry, so we need do accommodate that
             #   (added if condition)
-            if lump.hdrdict.has_key('svn:log'):
+            if 'svn:log' in lump.propdict:
                 log = lump.propdict["svn:log"]
                 num_subs = 0
                 for rx_search, sub in opts.filter_logs:
-                    lump.propdict["svn:log"], subs = re.subn(rx_search, sub, lump.propdict["svn:log"])
+                    log, subs = re.subn(rx_search, sub, log)
                     num_subs += subs
                 if num_subs:
                     print >> flog, "log filtered: %d times" % num_subs
-                    lump.correct_headers()
+                    lump.setprop("svn:log", log)
 
-            write_lump(fw, lump)
-            if not opts.quiet:
+            for o in outputs:
+                o.write_revision(lump, False, flog)
+            if not opts.quiet and outputs[0].revmap is None:
                 print >> flog, 'Revision %s committed as %s.' % (revno, revno)
             continue
 
-        # If we're skipping this revision, go to the next lump
-        if skipping:
-            continue
-
         # Print some kind of progress information.
         if opts.debug:
-            d = lump.hdrdict
             print >> flog, (
                 '   %-10s %-10s %s' %
-                (d.get('Node-kind', ''), d['Node-action'], d['Node-path']))
+                (d.get('Node-kind', ''), d['Node-action'], d['Node-path'])),
+            if lump.offset is not None:
+                print >> flog, '(offset %d)' % lump.offset,
+            print >> flog
 
         # Filter out the uninteresting lumps
-        path = lump.hdrdict['Node-path']
-        if not paths.interesting(path):
-            filtered.add(path)
+        path = d['Node-path']
+        size = int(d.get('Content-length', 0))
+        keeping = [o for o in outputs if o.keep(path, size)]
+        if keeping:
+            stats.count('nodes-kept')
+        else:
+            stats.count('nodes-dropped')
+
+        # Keep track of all the nodes, to be able to untangle from them.
+        if store is not None:
+            store.record(lump, int(revno))
+        if not keeping:
             continue
 
         # See if any of the provided filters match against this file
-        num_subs = 0
-        for rx_file, rx_search, sub in opts.filter_contents:
-            if rx_file.search(path):
-                lump.text, subs = re.subn(rx_search, sub, lump.text)
-                num_subs += subs
+        num_subs = filter_contents(lump, path, store)
         if num_subs:
             print >> flog, "contents filtered: %d times" % num_subs
-            lump.correct_headers()
 
-        # If this is not a move/copy.
-        if not lump.hdrdict.has_key("Node-copyfrom-path"):
-            # Just pass through.
-            write_lump(fw, lump)
+        # A streamed text can only be read once from a pipe.
+        if len(keeping) > 1:
+            lump.spooltext()
 
-        else:
-            # This is a move/copy.
-            srcrev = int(lump.hdrdict["Node-copyfrom-rev"])
-            srcpath = lump.hdrdict["Node-copyfrom-path"]
+        for o in keeping:
+            o.write_node(lump, flog)
 
-            # Check if the copy's source comes from a filtered path.
-            if paths.interesting(srcpath):
-                # If it comes from an included path, just pass through.
-                write_lump(fw, lump)
+    for o in outputs:
+        o.end_revision(flog)
 
-            else:
-                # Otherwise we deal with the case where the source comes from a
-                # filtered path.
-                if not opts.repos:
-                    msg = ("%s: Invalid copy source path '%s'" %
-                           (progname, srcpath))
-                    if opts.ignore_missing:
-                        print >> flog, msg
-                        continue
+
+class ByteQueue:
+    """
+    A queue between two threads, bounded by the number of bytes of the items
+    in it rather than by their number.  An item larger than the bound is let
+    in when the queue is empty.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.items = collections.deque()
+        self.size = 0
+        self.cond = threading.Condition()
+
+    def put(self, item, size):
+        self.cond.acquire()
+        try:
+            while self.items and self.size + size > self.maxbytes:
+                self.cond.wait()
+            self.items.append((item, size))
+            self.size += size
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def get(self):
+        self.cond.acquire()
+        try:
+            while not self.items:
+                self.cond.wait()
+            item, size = self.items.popleft()
+            self.size -= size
+            self.cond.notifyAll()
+            return item
+        finally:
+            self.cond.release()
+
+
+def lump_size(lump):
+    """
+    Return the number of bytes held in memory by 'lump', roughly.
+    """
+    size = 256 + len(lump.rawhdr) + len(lump.prop)
+    if not isinstance(lump.text, LazyText):
+        size += len(lump.text)
+    return size
+
+
+pipeline_batch = 256
+"""Number of lumps passed at once between the threads of the pipelined mode,
+to keep the cost of the synchronization low."""
+
+pipeline_min_inflight = 1 << 16
+"""Smallest --max-inflight, below which the queues could not hold a batch of
+small lumps."""
+
+
+class WriterThread(threading.Thread):
+    """
+    The thread that writes out the lumps in the pipelined mode.  It takes
+    batches of (writer, lump, data) tuples from its queue: the lump is written
+    to the writer if not None, else the data, or the flush policy is applied
+    if both are None.
+    """
+    def __init__(self, maxbytes):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.queue = ByteQueue(maxbytes)
+        self.batch = []
+        self.batchsize = 0
+        """The batch being filled, and its size in bytes."""
+        self.error = None
+        """The exception that stopped the writes, if any."""
+
+    def run(self):
+        while 1:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                continue # Only drain the queue after an error.
+            try:
+                for fw, lump, data in batch:
+                    if lump is not None:
+                        write_lump(fw, lump)
+                    elif data is not None:
+                        fw.write(data)
                     else:
-                        raise SystemExit(msg)
+                        fw.revision()
+            except BaseException, e:
+                self.error = e
+
+    def put(self, fw, lump, data, size):
+        if self.error is not None:
+            raise self.error
+        self.batch.append((fw, lump, data))
+        self.batchsize += size
+        if (len(self.batch) >= pipeline_batch or
+            self.batchsize >= self.queue.maxbytes // 4):
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the batch being filled over to the thread.
+        """
+        if self.batch:
+            self.queue.put(self.batch, self.batchsize)
+            self.batch = []
+            self.batchsize = 0
 
-                converted.append(
-                    (srcpath, path, lump.hdrdict['Node-kind'], srcrev))
+    def stop(self):
+        """
+        Wait until everything queued was written out, and return the
+        exception that stopped the writes, if any.
+        """
+        self.flush()
+        self.queue.put(None, 0)
+        self.join()
+        return self.error
 
-                print >> flog, ("%s: Converting '%s' to a copy on '%s'" %
-                                (progname, srcpath, path))
 
-                # Fetch the old revision from the repository.
-                fetch_rev_rename(opts.repos, srcrev, srcpath, path,
-                                 fw, flog, format)
+class PipelineWriter:
+    """
+    A stand-in for the DumpWriter 'fw' of an output in the pipelined mode,
+    which hands what is written to it over to WriterThread 'thread'.  The
+    lumps are written out by the thread, so that the correction of their
+    headers and the hashing of their texts happen there too.
+    """
+    def __init__(self, fw, thread):
+        self.fw = fw
+        self.name = fw.name
+        self.thread = thread
 
-                # We also check if the original lump includes a payload, and if
-                # it does, we need to add a change record providing the new
-                # contents.
-                if len(lump.text) > 0 and paths.interesting(path):
-                    print >> flog, ("%s:    Added a change record for '%s' as "
-                                    "well.") % (progname, path)
-                    lump.sethdr("Node-action", "change")
-                    lump.delhdr("Node-copyfrom-rev")
-                    lump.delhdr("Node-copyfrom-path")
-                    write_lump(fw, lump)
+    def putlump(self, lump):
+        """
+        Queue a copy of 'lump' to be written out, independent of its input.
+        """
+        lump = lump.clone()
+        lump.detach()
+        self.thread.put(self.fw, lump, None, lump_size(lump))
 
-    fr.close()
-    fw.close()
+    def write(self, data):
+        self.thread.put(self.fw, None, data, len(data))
 
-    if not opts.quiet:
-        # Print summary of dropped nodes.
-        print >> flog, 'Dropped %d node(s):' % len(filtered)
-        for path in sorted(filtered):
-            print >> flog, "   '/%s'" % path
-        print >> flog
+    def revision(self):
+        self.thread.put(self.fw, None, None, 0)
 
-        # Print summary of converted nodes.
-        print >> flog, '%s nodes converted into additions(s).' % len(converted)
-        for srcpath, dstpath, typ, srcrev in sorted(converted):
-            print >> flog, ("   '/%s' to '/%s' (%s, revision %s)" %
-                            (srcpath, dstpath, typ, srcrev))
-        print >> flog
+
+def queue_lumps(queue, lumps):
+    """
+    Put the lumps generated by 'lumps' in ByteQueue 'queue' in batches,
+    followed by None, or by the exception that stopped them.
+    """
+    batch, size = [], 0
+    try:
+        for lump in lumps:
+            batch.append(lump)
+            size += lump_size(lump)
+            if len(batch) >= pipeline_batch or size >= queue.maxbytes // 4:
+                queue.put(batch, size)
+                batch, size = [], 0
+    except BaseException, e:
+        queue.put(batch, size)
+        queue.put(e, 0)
+        return
+    queue.put(batch, size)
+    queue.put(None, 0)
+
+
+def dequeue_lumps(queue):
+    """
+    Generate the lumps put in ByteQueue 'queue' by queue_lumps().
+    """
+    while 1:
+        batch = queue.get()
+        if batch is None:
+            break
+        if isinstance(batch, BaseException):
+            raise batch
+        for lump in batch:
+            yield lump
+
+
+def filter_pipelined(fr, outputs, store, flog):
+    """
+    Filter the lumps of DumpReader 'fr' like filter_lumps(), in three stages
+    that run concurrently: a thread reads the lumps, the current thread
+    filters them, and a WriterThread corrects their headers and writes them
+    out.  The stages are connected by queues that share the --max-inflight
+    bound on the bytes held between them.
+    """
+    readq = ByteQueue(opts.max_inflight // 2)
+    lumps = read_lumps(fr, [o.paths for o in outputs], store, detach=True)
+    reader = threading.Thread(target=queue_lumps, args=(readq, lumps))
+    reader.setDaemon(True)
+    reader.start()
+
+    writer = WriterThread(opts.max_inflight // 2)
+    writer.start()
+    writers = [o.fw for o in outputs]
+    for o in outputs:
+        o.fw = PipelineWriter(o.fw, writer)
+    try:
+        filter_lumps(dequeue_lumps(readq), outputs, store, flog)
+    finally:
+        # Write out what was filtered, even after an error.
+        for o, fw in zip(outputs, writers):
+            o.fw = fw
+        error = writer.stop()
+    # Not reached if the filter failed, whose error comes first.
+    if error is not None:
+        raise error
+
+
+def revision_offsets(f, index=None):
+    """
+    Return the list of (rev, offset) of the revisions in the dump in seekable
+    file 'f', from its current position, and rewind it.  The offsets are taken
+    from DumpIndex 'index' if not None.
+    """
+    start = f.tell()
+    if index is not None:
+        offsets = [(rev, offset) for rev, offset in index.revisions
+                   if offset >= start]
+    else:
+        offsets = [(int(d['Revision-number']), offset)
+                   for d, offset in dump_headers(f)
+                   if 'Revision-number' in d]
+    f.seek(start)
+    return offsets
+
+
+def filter_range(job):
+    """
+    Filter the revisions between two offsets of the input file into temporary
+    files, in a worker process.  'job' is a (start, end, tmpprefix, split,
+    cachedir) tuple, where 'split' is the list of (filename, paths) of the
+    outputs.  Return a tuple of the log, of a list of (filename, filtered,
+    converted, lastrev) for each output, where 'filtered' is the list of
+    entries of its DroppedPaths, and of the exported Stats of the job, or a
+    tuple of None, an error message and None.
+    """
+    start, end, tmpprefix, split, cachedir = job
+    try:
+        # The worker may have run other jobs already.
+        stats.reset()
+        fr = DumpReader(open(opts.input, 'rb'))
+        format, uuid, text = read_dump_header(fr)
+        fr.seek(start)
+
+        cache = None
+        if opts.repos:
+            cache = open_untangle_backend(cachedir)
+
+        flog = StringIO.StringIO()
+        outputs = []
+        for i, (filename, outpaths) in enumerate(split):
+            paths = InterestingPaths(outpaths, opts.exclude or not outpaths)
+            fw = open_output('%s.%d' % (tmpprefix, i))
+            o = FilterOutput(fw, paths, cache, None, filename)
+            o.format = format
+            outputs.append(o)
+
+        lumps = read_lumps(fr, [o.paths for o in outputs], None, end)
+        filter_lumps(lumps, outputs, None, flog)
+
+        fr.close()
+        for o in outputs:
+            o.close()
+        stats.count('bytes-in', fr.nread)
+        return flog.getvalue(), [(o.fw.name, o.filtered.entries(),
+                                  o.converted, o.lastrev) for o in outputs], \
+               stats.export()
+    except SystemExit, e:
+        return None, str(e), None
+
+
+def filter_parallel(fr, outputs, split, cache, flog, index=None):
+    """
+    Filter the dump in seekable file 'fr', from its current position, with a
+    pool of worker processes.  The dump is partitioned in ranges of contiguous
+    revisions which are filtered independently, and the results are appended
+    to 'outputs' in order.  'split' is the list of (filename, paths) of the
+    outputs, and 'cache' the untangle cache to share with the workers.  The
+    revisions are found in DumpIndex 'index' if not None.
+    """
+    try:
+        import multiprocessing
+    except ImportError:
+        raise SystemExit("Error: --jobs needs the multiprocessing module.")
+
+    # Only hand out the revisions in the range to write out, the range ending
+    # at the first revision past it or at the end of the dump.
+    revisions = revision_offsets(fr, index)
+    fr.seek(0, 2)
+    offsets = []
+    end = fr.tell()
+    for rev, offset in revisions:
+        if opts.rev_end is not None and rev > opts.rev_end:
+            end = offset
+            break
+        if rev >= opts.rev_start:
+            offsets.append(offset)
+    if not offsets:
+        return
+    offsets.append(end)
+
+    # Cut ranges of roughly equal size, a few per worker to balance the load.
+    size = (offsets[-1] - offsets[0]) // (opts.jobs * 4) + 1
+    bounds = [offsets[0]]
+    for offset in offsets[1:-1]:
+        if offset - bounds[-1] >= size:
+            bounds.append(offset)
+    bounds.append(offsets[-1])
+
+    tmpdir = tempfile.mkdtemp(prefix='svndumpfilter3-')
+    cachedir = None
+    if cache is not None:
+        cachedir = cache.directory
+    jobs = [(bounds[i], bounds[i+1], os.path.join(tmpdir, str(i)), split,
+             cachedir) for i in xrange(len(bounds) - 1)]
+
+    pool = multiprocessing.Pool(opts.jobs)
+    try:
+        for log, results, jobstats in pool.imap(filter_range, jobs):
+            if log is None:
+                raise SystemExit(results)
+            flog.write(log)
+            stats.merge(jobstats)
+            for o, (filename, filtered, converted, lastrev) in \
+                    zip(outputs, results):
+                fin = open(filename, 'rb')
+                shutil.copyfileobj(fin, o.fw, opts.chunk_size)
+                fin.close()
+                os.remove(filename)
+                o.filtered.update(filtered)
+                o.converted.extend(converted)
+                if lastrev is not None:
+                    o.lastrev = lastrev
+    finally:
+        pool.terminate()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def open_output(filename=None):
+    """
+    Open output file 'filename' (stdout if None) as a DumpWriter, according to
+    the options, compressing it if its extension is that of a compressed
+    file.
+    """
+    if filename is None:
+        # Write the dump through the descriptor of stdout.
+        sys.stdout.flush()
+        f = sys.stdout
+    else:
+        f = open(filename, 'wb')
+
+        # Compress according to the extension of the file.
+        codec = codec_suffixes.get(os.path.splitext(filename)[1])
+        if codec in codec_commands:
+            f = CodecProcess(f, codec, True)
+        elif codec is not None:
+            f = CompressWriter(f, codec)
+    return DumpWriter(f, opts.output_buffer, opts.flush, opts.direct)
+
+
+def filter_dump(fr, outputs, split, cache, store, flog, index=None):
+    """
+    Filter the dump read from 'fr', past its header, to 'outputs', in the way
+    selected by the options.
+    """
+    if opts.jobs > 1:
+        filter_parallel(fr, outputs, split, cache, flog, index)
+        return
+
+    # Jump straight to the first revision to write out when the index knows
+    # where it is, unless the node store has to see all of them.
+    if index is not None and opts.rev_start > 0 and store is None:
+        offset = index.revision_offset(opts.rev_start)
+        if offset is None:
+            fr.seek(0, 2)
+        else:
+            fr.seek(offset)
+    if opts.pipeline:
+        filter_pipelined(fr, outputs, store, flog)
+    else:
+        lumps = read_lumps(fr, [o.paths for o in outputs], store)
+        filter_lumps(lumps, outputs, store, flog)
+
+
+def main():
+    """
+    Main program that just reads the lumps and copies them out.
+    """
+    opts, inpaths = parse_options()
+    if opts.stats_json or opts.profile:
+        stats.instrument()
+
+    # Open in and out files.
+    fr = open_input(opts.input)
+    flog = sys.stderr
+    stats.reader = fr
+    stats.interval = opts.progress
+    if tell(fr) is None and (opts.jobs > 1 or opts.index):
+        raise SystemExit("Error: --jobs and --index need a seekable, "
+                         "uncompressed input file.")
+
+    # Carry on from where the previous run stopped.
+    state = None
+    if opts.state:
+        state = FilterState(opts.state)
+        if state.lastrev is not None:
+            print >> flog, ("Continuing after revision %d from state file "
+                            "'%s'." % (state.lastrev, opts.state))
+            print >> flog
+            opts.rev_start = max(opts.rev_start, state.lastrev + 1)
+        if opts.untangle_cache is None:
+            opts.untangle_cache = state.untangle_cache
+        if opts.node_store is None:
+            opts.node_store = state.node_store
+        state.untangle_cache = os.path.abspath(opts.untangle_cache)
+        state.node_store = os.path.abspath(opts.node_store)
+
+    cache = None
+    if opts.repos:
+        cache = open_untangle_backend(opts.untangle_cache)
+
+    store = None
+    if opts.untangle_from_dump:
+        store = NodeStore(opts.node_store)
+
+    # Track which base files are interesting, accepting regexps for input
+    # filenames.
+    if opts.split:
+        split = opts.split
+    else:
+        split = [(None, inpaths)]
+    outputs = []
+    try:
+        for filename, outpaths in split:
+            if filename is not None:
+                print >> flog, "Output '%s':" % filename
+            if opts.exclude:
+                print >> flog, 'Excluding prefixes:'
+            else:
+                print >> flog, 'Including prefixes:'
+            for p in outpaths:
+                print >> flog, "   '/%s'" % p
+            print >> flog
+
+            paths = InterestingPaths(outpaths, opts.exclude or not outpaths)
+            fw = open_output(filename or opts.output)
+            outputs.append(FilterOutput(fw, paths, cache, store, filename))
+            if state is not None:
+                state.restore(outputs[-1])
+
+        index = None
+        if opts.index:
+            index = open_index(opts.index, fr, opts.input, flog)
+
+        # Find the copies to untangle up front and start fetching their
+        # sources.
+        if opts.plan:
+            if tell(fr) is None:
+                raise SystemExit("Error: --plan needs a seekable input file.")
+            plan, copies = plan_untangle(fr, [o.paths for o in outputs], index)
+            print >> flog, ("Planned %d copies to untangle, from %d "
+                            "revision(s)." %
+                            (len(plan), len(set(p[0] for p in plan))))
+            print >> flog
+            if cache is not None:
+                cache.prefetch([srcrev for srcrev, srcpath, dstpath in plan],
+                               opts.plan_jobs, flog)
+            # The later runs may copy from anything the store records, and
+            # the deltas to filter may be against any text.
+            if (store is not None and state is None and
+                not (opts.filter_contents and dump_format(fr) == '3')):
+                store.setplan(plan, copies)
+
+        # Read the dumpfile header.
+        format, uuid, text = read_dump_header(fr)
+        if state is not None:
+            state.check_uuid(uuid)
+        for o in outputs:
+            o.write_header(text, format)
+
+        if format not in __supported_versions__:
+            # Note: you could update this script easily to support other
+            # formats, it will probably be trivial to do so.
+            raise SystemExit("Error: dump file in format '%s' not "
+                             "supported." % format)
+
+        # The deltas to filter the contents of are expanded against the full
+        # texts of a node store, which then has to record all the nodes.
+        if format == '3' and opts.filter_contents and store is None:
+            if opts.jobs > 1:
+                raise SystemExit("Error: --filter-contents on a dump with "
+                                 "deltas cannot be used with --jobs.")
+            store = NodeStore(opts.node_store)
+
+        # Process the dump file.
+        if opts.profile:
+            run_profiled(opts.profile, flog, filter_dump,
+                         fr, outputs, split, cache, store, flog, index)
+        else:
+            filter_dump(fr, outputs, split, cache, store, flog, index)
+    finally:
+        # Remove the temporary cache and store, and write out what was
+        # buffered, even after an error.
+        if cache is not None:
+            cache.close()
+        if store is not None:
+            store.close()
+        for o in outputs:
+            o.close()
+            stats.count('bytes-out', o.fw.nwritten)
+        stats.count('bytes-in', fr.nread)
+        if opts.stats_json:
+            stats.write_json(opts.stats_json)
+        fr.close()
+
+    if state is not None:
+        state.save(outputs)
+
+    if opts.summary:
+        f = open(opts.summary, 'w')
+        try:
+            for o in outputs:
+                o.print_summary(f, True)
+        finally:
+            f.close()
+    elif not opts.quiet:
+        for o in outputs:
+            o.print_summary(flog)
 
 
 if __name__ == '__main__':
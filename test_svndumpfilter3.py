@@ -0,0 +1,757 @@
+#!/usr/bin/env python
+#
+#  Tests of svndumpfilter3, run with 'python test_svndumpfilter3.py'.
+
+import sys, os, re, bz2, zlib, hashlib, shutil, tempfile, subprocess, unittest
+import StringIO
+
+topdir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, topdir)
+sys.path.insert(0, os.path.join(topdir, 'bench'))
+import svndumpfilter3, gendump
+
+
+class DecompressReaderTest(unittest.TestCase):
+    """
+    Reading the inputs made of several concatenated compressed streams.
+    """
+    def decompress(self, data, codec, blocksize):
+        f = svndumpfilter3.DecompressReader(StringIO.StringIO(data), codec,
+                                            blocksize=blocksize)
+        parts = []
+        while 1:
+            data = f.read(1000)
+            if not data:
+                break
+            parts.append(data)
+        f.close()
+        return ''.join(parts)
+
+    def test_bzip2_streams(self):
+        first = bz2.compress('a' * 5000)
+        second = bz2.compress('b' * 7000)
+        for blocksize in (100, len(first) - 1, len(first) + 1, 1 << 20):
+            self.assertEqual(self.decompress(first + second, 'bzip2',
+                                             blocksize),
+                             'a' * 5000 + 'b' * 7000)
+
+    def test_bzip2_stream_ends_on_block_boundary(self):
+        # Nothing is left over from the block after the end of the first
+        # stream to start the second one with.
+        first = bz2.compress('a' * 5000)
+        second = bz2.compress('b' * 7000)
+        self.assertEqual(self.decompress(first + second, 'bzip2', len(first)),
+                         'a' * 5000 + 'b' * 7000)
+
+    def gzip(self, data):
+        c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(data) + c.flush()
+
+    def test_gzip_members(self):
+        first = self.gzip('a' * 5000)
+        second = self.gzip('b' * 7000)
+        for blocksize in (100, len(first), 1 << 20):
+            self.assertEqual(self.decompress(first + second, 'gzip',
+                                             blocksize),
+                             'a' * 5000 + 'b' * 7000)
+
+    def test_truncated(self):
+        first = self.gzip('a' * 5000)
+        second = self.gzip('b' * 7000)
+        data = bz2.compress('a' * 5000) + bz2.compress('b' * 7000)
+        for data, codec in ((first + second[:20], 'gzip'),
+                            (first[:-8], 'gzip'),
+                            (data[:-10], 'bzip2')):
+            for blocksize in (100, len(first), 1 << 20):
+                self.assertRaises(SystemExit, self.decompress, data, codec,
+                                  blocksize)
+
+    def codec_process(self, data, codec):
+        fn = os.path.join(tempfile.mkdtemp(prefix='svndumpfilter3-test-'),
+                          'input')
+        try:
+            f = open(fn, 'wb')
+            f.write(data)
+            f.close()
+            # Like open_input, which reads the magic bytes first.
+            f = open(fn, 'rb')
+            f = svndumpfilter3.CodecProcess(f, codec, False, f.read(6))
+            while f.read(1000):
+                pass
+            f.close()
+        finally:
+            shutil.rmtree(os.path.dirname(fn))
+
+    def test_truncated_xz(self):
+        try:
+            p = subprocess.Popen(['xz', '-c'], stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE)
+        except OSError:
+            return
+        data = p.communicate('a' * 5000)[0]
+        self.codec_process(data, 'xz')
+        self.assertRaises(SystemExit, self.codec_process, data[:-12], 'xz')
+
+
+def parse_options(*args):
+    """
+    Parse the command line 'args', and return the options and paths, or the
+    error message printed by optparse.
+    """
+    argv, stderr = sys.argv, sys.stderr
+    sys.argv = ['svndumpfilter3.py'] + list(args)
+    sys.stderr = StringIO.StringIO()
+    try:
+        try:
+            return svndumpfilter3.parse_options()
+        except SystemExit:
+            return sys.stderr.getvalue()
+    finally:
+        sys.argv, sys.stderr = argv, stderr
+
+
+class RevisionRangesTest(unittest.TestCase):
+    """
+    Parsing the revisions of -r and --skip-rev.
+    """
+    def test_parse_revision_range(self):
+        parse = svndumpfilter3.parse_revision_range
+        self.assertEqual(parse('5'), (5, 5))
+        self.assertEqual(parse('3:7'), (3, 7))
+        self.assertEqual(parse(' 3 : 7 '), (3, 7))
+        self.assertEqual(parse('190:'), (190, None))
+        self.assertEqual(parse('4:HEAD'), (4, None))
+        self.assertEqual(parse('0:0'), (0, 0))
+        for s in ('', 'a', ':5', '5:3', '-1', '-3:4', '1:x', '1:2:3'):
+            self.assertRaises(ValueError, parse, s)
+
+    def test_ranges(self):
+        skip = svndumpfilter3.RevisionRanges(['1:5,7,190:'])
+        for rev in (1, 2, 5, 7, 190, 191, 10 ** 9):
+            self.assert_(rev in skip)
+        for rev in (0, 6, 8, 189):
+            self.failIf(rev in skip)
+        self.failIf(svndumpfilter3.RevisionRanges())
+        self.assert_(skip)
+
+    def test_merged_ranges(self):
+        # Overlapping and adjacent ranges, given in any order, are merged.
+        skip = svndumpfilter3.RevisionRanges(['3:5', '6', '1:2', '12:20',
+                                              '10:', '4'])
+        self.assertEqual(skip.starts, [1, 10])
+        self.assertEqual(skip.ends, [6, None])
+        skip = svndumpfilter3.RevisionRanges(['2:9', '4:5', '11'])
+        self.assertEqual(skip.starts, [2, 11])
+        self.assertEqual(skip.ends, [9, 11])
+
+    def test_options(self):
+        opts, paths = parse_options('-r', '10:20', '--skip-rev', '1:5,7',
+                                    '--skip-rev', '190:', 'a')
+        self.assertEqual((opts.rev_start, opts.rev_end), (10, 20))
+        self.assertEqual(opts.skip_rev.starts, [1, 7, 190])
+        self.assertEqual(opts.skip_rev.ends, [5, 7, None])
+        opts, paths = parse_options('-r', '10:', 'a')
+        self.assertEqual((opts.rev_start, opts.rev_end), (10, None))
+        opts, paths = parse_options('a')
+        self.assertEqual((opts.rev_start, opts.rev_end), (0, None))
+        self.failIf(opts.skip_rev)
+
+        for args in (['-r', '20:10'], ['-r', 'x'], ['--skip-rev', '1,,2'],
+                     ['--skip-rev', '5:1']):
+            self.assert_('Invalid revision range' in
+                         parse_options(*(args + ['a'])))
+
+
+def make_dump(revisions):
+    """
+    Return a dump (format 2) of the 'revisions', each one a list of nodes,
+    given as (path, kind, action, text, copyfrom), where 'text' is None for
+    no text and 'copyfrom' a (path, rev) pair or None.
+    """
+    parts = ['SVN-fs-dump-format-version: 2\n\n'
+             'UUID: 6b5d6c3a-8a32-4f0e-9d3b-0c1f2e3d4c5b\n\n']
+    for rev, nodes in enumerate([[]] + revisions):
+        props = ('K 7\nsvn:log\nV %d\nr%d\nPROPS-END\n' %
+                 (len(str(rev)) + 1, rev))
+        parts.append('Revision-number: %d\nProp-content-length: %d\n'
+                     'Content-length: %d\n\n%s\n' %
+                     (rev, len(props), len(props), props))
+        for path, kind, action, text, copyfrom in nodes:
+            hdrs = ['Node-path: %s' % path]
+            if kind is not None:
+                hdrs.append('Node-kind: %s' % kind)
+            hdrs.append('Node-action: %s' % action)
+            if copyfrom is not None:
+                hdrs.append('Node-copyfrom-rev: %d' % copyfrom[1])
+                hdrs.append('Node-copyfrom-path: %s' % copyfrom[0])
+            body = ''
+            if action == 'add' and copyfrom is None:
+                body = 'PROPS-END\n'
+                hdrs.append('Prop-content-length: %d' % len(body))
+            if text is not None:
+                hdrs.append('Text-content-length: %d' % len(text))
+                hdrs.append('Text-content-md5: %s' %
+                            hashlib.md5(text).hexdigest())
+                body += text
+            if body:
+                hdrs.append('Content-length: %d' % len(body))
+            parts.append('\n'.join(hdrs) + '\n\n' + body + '\n\n')
+    return ''.join(parts)
+
+def run_filter(data, *args):
+    """
+    Filter the dump 'data' with the options 'args', and return the output.
+    """
+    p = subprocess.Popen([sys.executable,
+                          os.path.join(topdir, 'svndumpfilter3.py')] +
+                         list(args), stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate(data)
+    if p.returncode != 0:
+        raise AssertionError("svndumpfilter3 failed: %s" % err)
+    return out
+
+
+class RevisionMapTest(unittest.TestCase):
+    """
+    The renumbering of the revisions by --drop-empty-revs and
+    --renumber-revs.
+    """
+    def setUp(self):
+        self.dump = make_dump([
+            [('a', 'dir', 'add', None, None),
+             ('a/f', 'file', 'add', 'one\n', None)],
+            [('b', 'dir', 'add', None, None),
+             ('b/g', 'file', 'add', 'other\n', None)],
+            [('a/f', 'file', 'change', 'two\n', None)],
+            [('b/h', 'file', 'add', 'other\n', None)],
+            # Copied from revision 4, which only touches b.
+            [('a/f2', 'file', 'add', None, ('a/f', 4))]])
+
+    def filter(self, *args):
+        out = run_filter(self.dump, '--quiet', *(args + ('a',)))
+        return (map(int, re.findall('^Revision-number: (\d+)$', out, re.M)),
+                map(int, re.findall('^Node-copyfrom-rev: (\d+)$', out,
+                                    re.M)))
+
+    def test_runs(self):
+        m = svndumpfilter3.RevisionMap()
+        self.assertEqual(m.last(), None)
+        self.assertEqual(m.get(3), None)
+        # Revisions 0-2 and 5-6 written out as 0-4, 4 dropped, 7-8 as 5-6.
+        for rev, new in ((0, 0), (1, 1), (2, 2), (5, 3), (6, 4), (7, 5),
+                         (8, 6)):
+            m.add(rev, new)
+        self.assertEqual(m.runs(), [(0, 0, 3), (5, 3, 4)])
+        self.assertEqual(m.last(), 6)
+        for rev, new in ((0, 0), (2, 2), (5, 3), (8, 6)):
+            self.assertEqual(m.get(rev), new)
+
+        # The dropped revisions map to the last one written before them.
+        self.assertEqual(m.get(3), 2)
+        self.assertEqual(m.get(4), 2)
+        self.assertEqual(m.get(100), 6)
+
+        self.assertEqual(svndumpfilter3.RevisionMap(m.runs()).runs(),
+                         m.runs())
+
+    def test_runs_without_renumbering(self):
+        # With --drop-empty-revs alone, the revisions keep their numbers.
+        m = svndumpfilter3.RevisionMap()
+        for rev in (0, 1, 3, 4, 5, 9):
+            m.add(rev, rev)
+        self.assertEqual(m.runs(), [(0, 0, 2), (3, 3, 3), (9, 9, 1)])
+        self.assertEqual(m.get(2), 1)
+        self.assertEqual(m.get(7), 5)
+
+    def test_filter(self):
+        self.assertEqual(self.filter(), ([0, 1, 2, 3, 4, 5], [4]))
+        self.assertEqual(self.filter('--drop-empty-revs'),
+                         ([0, 1, 3, 5], [3]))
+        self.assertEqual(self.filter('--renumber-revs'),
+                         ([0, 1, 2, 3, 4, 5], [4]))
+        self.assertEqual(self.filter('--drop-empty-revs', '--renumber-revs'),
+                         ([0, 1, 2, 3], [2]))
+
+
+class DroppedPathsTest(unittest.TestCase):
+    """
+    The summary of the dropped paths, bounded by rolling up its deepest
+    levels.
+    """
+    def test_entries(self):
+        dropped = svndumpfilter3.DroppedPaths()
+        dropped.add('a/b/c', 1, 10)
+        dropped.add('a/b/c', 2, 5)
+        dropped.add('a', 1, 0)
+        self.assertEqual(dropped.entries(), [('a', 1, 0, False),
+                                             ('a/b/c', 3, 15, False)])
+
+    def test_rollup(self):
+        dropped = svndumpfilter3.DroppedPaths(budget=6)
+        dropped.add('a/b/c', 1, 1)
+        dropped.add('a/b/d', 1, 2)
+        dropped.add('a/e/f', 1, 4)
+        # The root, a, b, c, d, e and f are over the budget: c, d and f are
+        # rolled up into their parents.
+        self.assertEqual(dropped.nodes, 4)
+        self.assertEqual(dropped.maxdepth, 2)
+        self.assertEqual(dropped.entries(), [('a/b', 2, 3, True),
+                                             ('a/e', 1, 4, True)])
+
+        # The paths added later are cut to the remaining depth.
+        dropped.add('x/y/z', 1, 8)
+        self.assertEqual(dropped.nodes, 6)
+        self.assertEqual(dropped.entries()[-1], ('x/y', 1, 8, True))
+
+        dropped.add('q', 1, 16)
+        self.assert_(dropped.nodes <= 6)
+        self.assertEqual(dropped.maxdepth, 1)
+        self.assertEqual(dropped.entries(), [('a', 3, 7, True),
+                                             ('q', 1, 16, False),
+                                             ('x', 1, 8, True)])
+
+    def test_update(self):
+        # The entries saved in a state file are added back as they were.
+        dropped = svndumpfilter3.DroppedPaths(budget=6)
+        for path in 'a/b/c', 'a/b/d', 'a/e/f', 'g':
+            dropped.add(path, 1, 1)
+        copy = svndumpfilter3.DroppedPaths(budget=6)
+        copy.update(dropped.entries())
+        self.assertEqual(copy.entries(), dropped.entries())
+
+
+class PipelineTest(unittest.TestCase):
+    """
+    The options and the writer thread of --pipeline.
+    """
+    def test_max_inflight(self):
+        opts, paths = parse_options('--max-inflight', '64K', 'a')
+        self.assertEqual(opts.max_inflight, 1 << 16)
+        for size in ('0', '-1M', '1K'):
+            self.assert_('Invalid max inflight size' in
+                         parse_options('--max-inflight', size, 'a'))
+
+    def test_writer_error(self):
+        class FailingWriter:
+            def write(self, data):
+                raise IOError("No space left on device")
+        writer = svndumpfilter3.WriterThread(1 << 16)
+        writer.start()
+        writer.put(FailingWriter(), None, 'data', 4)
+        error = writer.stop()
+        self.assert_(isinstance(error, IOError))
+
+        # The writes queued after the error fail with it.
+        self.assertRaises(IOError, writer.put, FailingWriter(), None,
+                          'data', 4)
+
+
+class ContentFilterTest(unittest.TestCase):
+    """
+    The substitutions of --filter-contents, on texts in memory and streamed
+    in chunks.
+    """
+    text = ''.join('line %d: secret%d and secret%d\n' % (i, i, i * 7)
+                   for i in xrange(200))
+
+    def chunks(self, text, size):
+        return [text[i:i + size] for i in xrange(0, len(text), size)]
+
+    def test_required_literal(self):
+        for pattern, literal in ((r'secret[0-9]+', 'secret'),
+                                 (r'a(bcd)+e', 'bcd'),
+                                 (r'(ab)*cd', 'cd'),
+                                 (r'x*', None),
+                                 (r'foo|bar', None)):
+            self.assertEqual(svndumpfilter3.ContentFilter(pattern,
+                                                          'X').literal,
+                             literal)
+        self.assertEqual(svndumpfilter3.ContentFilter('(?i)secret',
+                                                      'X').literal, None)
+
+    def test_maxwidth(self):
+        for pattern, width in ((r'secret[0-9]{1,3}', 9), (r'abc', 3),
+                               (r'secret[0-9]+', None), (r'^secret', None),
+                               (r'secret(?=1)', None), (r'x*', None)):
+            self.assertEqual(svndumpfilter3.ContentFilter(pattern,
+                                                          'X').maxwidth,
+                             width)
+
+    def test_contains_literal(self):
+        cfilter = svndumpfilter3.ContentFilter(r'secret[0-9]{1,3}', 'X')
+        self.assert_(cfilter.contains_literal(['xxsec', 'ret1']))
+        self.assert_(cfilter.contains_literal(['xxs', 'e', 'cr', 'et1']))
+        self.assert_(cfilter.contains_literal(['xxsecret', '1']))
+        self.failIf(cfilter.contains_literal(['xxsec', 'xret1']))
+
+    def test_substream(self):
+        # The matches that straddle two chunks are replaced once, like in
+        # the whole text.
+        for pattern, sub in ((r'secret[0-9]{1,3}', 'XXX'),
+                             (r'(secret)([0-9])', r'\2\1'),
+                             (r'd [a-z]{1,5}', '')):
+            cfilter = svndumpfilter3.ContentFilter(pattern, sub)
+            expected = cfilter.rx.subn(sub, self.text)
+            for size in (1, 2, 5, 7, 10, 64, 1000, len(self.text)):
+                parts = []
+                count = cfilter.substream(self.chunks(self.text, size),
+                                          parts.append)
+                self.assertEqual((''.join(parts), count), expected)
+
+    def test_filter(self):
+        binary = 'secret1\0' + self.text
+        dump = make_dump([[('a', 'dir', 'add', None, None),
+                           ('a/f.txt', 'file', 'add', self.text, None),
+                           ('a/g.bin', 'file', 'add', binary, None)]])
+        expected = re.sub(r'secret[0-9]{1,3}', 'XXX', self.text)
+        for size in ('16', '1048576'):
+            out = run_filter(dump, '--quiet', '--chunk-size', size,
+                             '--filter-contents', r'.', r'secret[0-9]{1,3}',
+                             'XXX', 'a')
+            self.assert_('Text-content-length: %d\n' % len(expected) in out)
+            self.assert_(expected in out)
+            self.assert_(binary in out)
+            self.assertEqual(out.count('secret'), binary.count('secret'))
+
+
+class SvndiffTest(unittest.TestCase):
+    """
+    Applying hand-built svndiff0 and svndiff1 deltas.
+    """
+    source = 'abcdefgh'
+
+    def section(self, data, version, compress=True):
+        if version == 0:
+            return data
+        if compress:
+            return gendump.varint(len(data)) + zlib.compress(data)
+        return gendump.varint(len(data)) + data
+
+    def window(self, sview, tview_len, instructions, newdata, version=0,
+               compress=True):
+        instructions = self.section(instructions, version, compress)
+        newdata = self.section(newdata, version, compress)
+        return (gendump.varint(sview[0]) + gendump.varint(sview[1]) +
+                gendump.varint(tview_len) + gendump.varint(len(instructions)) +
+                gendump.varint(len(newdata)) + instructions + newdata)
+
+    def apply(self, delta, source=None, size=None):
+        if size is None:
+            chunks = [delta]
+        else:
+            chunks = [delta[i:i + size] for i in xrange(0, len(delta), size)]
+        if source is not None:
+            source = StringIO.StringIO(source)
+        parts = []
+        svndumpfilter3.svndiff_apply(chunks, source, parts.append)
+        return ''.join(parts)
+
+    def windows(self, version, compress=True):
+        # 'cde' from the source view at offset 2 in the source, 'XY' new,
+        # then 7 bytes from the start of the target, which overlap the bytes
+        # they produce.
+        first = self.window((2, 3), 12,
+                            chr(0x00 | 3) + gendump.varint(0) +
+                            chr(0x80 | 2) +
+                            chr(0x40 | 7) + gendump.varint(0),
+                            'XY', version, compress)
+        # 100 new bytes, whose length does not fit in the instruction.
+        second = self.window((0, 0), 100,
+                             chr(0x80) + gendump.varint(100),
+                             'z' * 100, version, compress)
+        return 'SVN' + chr(version), first, second
+
+    def test_svndiff0(self):
+        self.assertEqual(self.apply('SVN\0' + self.window((0, 0), 5,
+                                                          chr(0x80 | 5),
+                                                          'hello')),
+                         'hello')
+        self.assertEqual(self.apply('SVN\0'), '')
+        delta = ''.join(self.windows(0))
+        for size in (None, 1, 3, 17):
+            self.assertEqual(self.apply(delta, self.source, size),
+                             'cdeXYcdeXYcd' + 'z' * 100)
+
+    def test_svndiff1(self):
+        for compress in (True, False):
+            delta = ''.join(self.windows(1, compress))
+            for size in (None, 1, 5):
+                self.assertEqual(self.apply(delta, self.source, size),
+                                 'cdeXYcdeXYcd' + 'z' * 100)
+
+    def test_truncated(self):
+        header, first, second = self.windows(0)
+        delta = header + first + second
+        for end in xrange(len(delta)):
+            if end in (len(header), len(header) + len(first)):
+                continue # A shorter, valid delta.
+            try:
+                self.apply(delta[:end], self.source)
+            except SystemExit, e:
+                self.assert_('Truncated svndiff data' in str(e), str(e))
+            else:
+                self.fail("Delta truncated at %d applied." % end)
+
+        # An instruction cut within its window.
+        delta = 'SVN\0' + self.window((0, 3), 3, chr(0x00 | 3), '')
+        try:
+            self.apply(delta, self.source)
+        except SystemExit, e:
+            self.assert_('Truncated svndiff data' in str(e), str(e))
+        else:
+            self.fail("Truncated instruction applied.")
+
+    def test_invalid(self):
+        for delta in ('SVN\2', 'XYZ\0', 'SVN\0' + self.window((0, 0), 2,
+                                                               chr(0xc2),
+                                                               'ab')):
+            self.assertRaises(SystemExit, self.apply, delta)
+        # A source view without a source.
+        self.assertRaises(SystemExit, self.apply,
+                          'SVN\0' + self.window((0, 3), 3, chr(0x00 | 3) +
+                                                gendump.varint(0), ''))
+
+
+class DumpIndexTest(unittest.TestCase):
+    """
+    The index of the revisions and nodes of a dump file, used by --plan and
+    --jobs instead of a scan.
+    """
+    keys = ('Node-path', 'Node-action', 'Node-kind', 'Prop-content-length',
+            'Text-content-length', 'Node-copyfrom-rev', 'Node-copyfrom-path')
+    """The headers of the nodes recorded in the index."""
+
+    def recorded(self, d):
+        """
+        Return the headers of dict 'd' that the index records.
+        """
+        if 'Revision-number' in d:
+            return {'Revision-number': d['Revision-number']}
+        return dict((k, v) for k, v in d.items() if k in self.keys)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='svndumpfilter3-test-')
+        self.dump = os.path.join(self.tmpdir, 'repos.dump')
+        self.index = os.path.join(self.tmpdir, 'repos.index')
+        subprocess.check_call([sys.executable,
+                               os.path.join(topdir, 'bench', 'gendump.py'),
+                               '-o', self.dump, '--revisions', '60',
+                               '--copy-density', '0.5', '--seed', '5',
+                               '--check'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def open_index(self):
+        """
+        Open the index, building it if needed, and return it with whether it
+        was built.
+        """
+        f = svndumpfilter3.DumpReader(open(self.dump, 'rb'))
+        flog = StringIO.StringIO()
+        try:
+            index = svndumpfilter3.open_index(self.index, f, self.dump, flog)
+        finally:
+            f.close()
+        return index, 'Building index' in flog.getvalue()
+
+    def test_headers(self):
+        index, built = self.open_index()
+        self.assert_(built)
+        f = svndumpfilter3.DumpReader(open(self.dump, 'rb'))
+        try:
+            svndumpfilter3.read_dump_header(f)
+            scanned = [(self.recorded(d), offset)
+                       for d, offset in svndumpfilter3.dump_headers(f)]
+        finally:
+            f.close()
+        self.assertEqual(list(index.headers()), scanned)
+        self.assert_([d for d, offset in scanned
+                      if 'Node-copyfrom-path' in d])
+        self.assertEqual(index.revisions,
+                         [(int(d['Revision-number']), offset)
+                          for d, offset in scanned
+                          if 'Revision-number' in d])
+
+    def test_stale(self):
+        index, built = self.open_index()
+        self.assert_(built)
+        index, built = self.open_index()
+        self.failIf(built)
+
+        # A dump of another size.
+        f = open(self.dump, 'ab')
+        f.write('\n')
+        f.close()
+        index, built = self.open_index()
+        self.assert_(built)
+        index, built = self.open_index()
+        self.failIf(built)
+
+        # A dump of the same size, modified later.
+        st = os.stat(self.dump)
+        os.utime(self.dump, (st.st_atime, st.st_mtime + 10))
+        index, built = self.open_index()
+        self.assert_(built)
+
+    def test_plan(self):
+        # --plan reads the same copies from the index as from a scan.
+        parse_options('-r', '10:50', 'proj0')
+        index, built = self.open_index()
+        paths = [svndumpfilter3.InterestingPaths(['proj0'], False)]
+        f = svndumpfilter3.DumpReader(open(self.dump, 'rb'))
+        try:
+            scanned = svndumpfilter3.plan_untangle(f, paths)
+            indexed = svndumpfilter3.plan_untangle(f, paths, index)
+        finally:
+            f.close()
+        self.assert_(scanned[0])
+        self.assertEqual(indexed, scanned)
+
+        output = os.path.join(self.tmpdir, 'out.dump')
+        outputs = []
+        for args in ([], ['--index', self.index]):
+            run_filter('', '-i', self.dump, '-o', output, '--quiet',
+                       '-U', '--plan', 'proj0', *args)
+            f = open(output, 'rb')
+            outputs.append(f.read())
+            f.close()
+        self.assertEqual(outputs[0], outputs[1])
+
+
+class FilterStateTest(unittest.TestCase):
+    """
+    Filtering the incremental dumps of a repository one after the other with
+    --state.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='svndumpfilter3-test-')
+        self.dump = os.path.join(self.tmpdir, 'repos.dump')
+        subprocess.check_call([sys.executable,
+                               os.path.join(topdir, 'bench', 'gendump.py'),
+                               '-o', self.dump, '--revisions', '80',
+                               '--copy-density', '0.5', '--seed', '11',
+                               '--check'])
+        f = open(self.dump, 'rb')
+        self.data = f.read()
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def split(self, rev):
+        """
+        Split the dump into two incremental dumps, before revision 'rev'.
+        """
+        header = self.data[:self.data.index('Revision-number: 0\n')]
+        pos = self.data.index('Revision-number: %d\n' % rev)
+        return self.data[:pos], header + self.data[pos:]
+
+    def test_incremental(self):
+        state = os.path.join(self.tmpdir, 'filter.state')
+        for args in (['-U'], ['-U', '--drop-empty-revs', '--renumber-revs'],
+                     ['-e', '-U', '--drop-empty-revs']):
+            args = ['--quiet'] + args + ['proj0', 'proj1/trunk']
+            full = run_filter(self.data, *args)
+            self.assert_('svn:untangled' in full)
+            for rev in (1, 37, 80):
+                if os.path.exists(state):
+                    os.remove(state)
+                shutil.rmtree(state + '.store', ignore_errors=True)
+                first, second = self.split(rev)
+                out1 = run_filter(first, '--state', state, *args)
+                out2 = run_filter(second, '--state', state, *args)
+                # The second output has its own header.
+                out2 = out2[out2.index('Revision-number: '):]
+                self.assertEqual(out1 + out2, full)
+
+    def test_uuid(self):
+        state = os.path.join(self.tmpdir, 'filter.state')
+        first, second = self.split(40)
+        run_filter(first, '--state', state, '-U', 'proj0')
+        second = second.replace(gendump.UUID,
+                                '00000000-0000-0000-0000-000000000000', 1)
+        p = subprocess.Popen([sys.executable,
+                              os.path.join(topdir, 'svndumpfilter3.py'),
+                              '--state', state, '-U', 'proj0'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        err = p.communicate(second)[1]
+        self.assertNotEqual(p.returncode, 0)
+        self.assert_('is from repository 00000000-' in err, err)
+
+
+class UntangleBackendTest(unittest.TestCase):
+    """
+    Untangling with the svnadmin and svnlook backends, against a repository
+    faked from a generated dump by bench/fakesvn.py.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='svndumpfilter3-test-')
+        self.dump = os.path.join(self.tmpdir, 'repos.dump')
+        subprocess.check_call([sys.executable,
+                               os.path.join(topdir, 'bench', 'gendump.py'),
+                               '-o', self.dump, '--revisions', '120',
+                               '--nodes', '4', '--copy-density', '0.3',
+                               '--seed', '7'])
+
+        # All the copies are from paths that exist in their source revision.
+        f = open(self.dump, 'rb')
+        try:
+            self.assertEqual(gendump.CopyChecker().check(f), [])
+        finally:
+            f.close()
+
+        # Make 'svnadmin' and 'svnlook' run the fake.
+        bindir = os.path.join(self.tmpdir, 'bin')
+        os.mkdir(bindir)
+        for cmd in 'svnadmin', 'svnlook':
+            fn = os.path.join(bindir, cmd)
+            f = open(fn, 'w')
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' %
+                    (sys.executable,
+                     os.path.join(topdir, 'bench', 'fakesvn.py'), cmd))
+            f.close()
+            os.chmod(fn, 0755)
+        self.env = dict(os.environ)
+        self.env['PATH'] = bindir + os.pathsep + self.env.get('PATH', '')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def filter(self, name, *args):
+        """
+        Filter the dump with the options 'args', and return the output.
+        """
+        output = os.path.join(self.tmpdir, name + '.dump')
+        ferr = open(os.path.join(self.tmpdir, name + '.log'), 'w')
+        try:
+            subprocess.check_call(
+                [sys.executable, os.path.join(topdir, 'svndumpfilter3.py'),
+                 '-i', self.dump, '-o', output] + list(args),
+                env=self.env, stderr=ferr)
+        finally:
+            ferr.close()
+        f = open(output, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_backends_agree(self):
+        for args in (['proj0'], ['proj1/trunk', 'proj2'],
+                     ['--untangle-jobs', '1', 'proj1/trunk', 'proj2']):
+            svnadmin = self.filter('svnadmin', '-u', self.dump,
+                                   '--untangle-backend', 'svnadmin', *args)
+            svnlook = self.filter('svnlook', '-u', self.dump,
+                                  '--untangle-backend', 'svnlook', *args)
+            self.assert_('svn:untangled' in svnadmin)
+            self.assertEqual(svnadmin, svnlook)
+
+            # The copy sources taken from the dump itself are the same.
+            self.assertEqual(self.filter('store', '-U', *args), svnadmin)
+
+
+if __name__ == '__main__':
+    unittest.main()